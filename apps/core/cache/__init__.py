@@ -1,2 +1,3 @@
-from apps.core.cache.base import cache, produce_class_func_cache_key
-__all__ = ["cache", "produce_class_func_cache_key"]
+from apps.core.cache.base import (MISS, cache, cached,
+                                   produce_class_func_cache_key)
+__all__ = ["MISS", "cache", "cached", "produce_class_func_cache_key"]
@@ -0,0 +1,341 @@
+# coding=utf-8
+"""
+基于asyncio原生客户端的RedisCache，接口和apps.core.cache.redis.RedisCache一样
+options.cache_engine = "apps.core.cache.asyncredis.AsyncRedisCache"
+需要IOLoop跑在asyncio上(tornado.platform.asyncio.AsyncIOMainLoop)
+值直接以bytes收发，不需要latin-1转换
+"""
+
+from apps.core.cache.base import CacheBase, DEFAULT_TIMEOUT
+from apps.core.cache.metrics import instrument
+from apps.core.cache.serializers import CacheSerializer
+from apps.core.cache.redislist import (RedisListMixin, to_str_list,
+                                       pop_command, pop_result,
+                                       tag_commands, batches)
+from tools_lib.asyncredis import ConnectionPool, ReplyError
+import tornado.platform.asyncio  # noqa 让tornado协程可以await asyncio的Future
+import logging
+import time
+logger = logging.getLogger("tornado.application")
+
+
+def _identity(result):
+    return result
+
+
+def _to_bool(result):
+    return bool(result)
+
+
+def _is_ok(result):
+    return result == b"OK"
+
+
+class AsyncRedisCache(RedisListMixin, CacheBase):
+    LIST_CHUNK_SIZE = 1000
+
+    @classmethod
+    def configurable_base(cls):
+        return AsyncRedisCache
+
+    @classmethod
+    def configurable_default(cls):
+        return AsyncRedisCache
+
+    @classmethod
+    def configured_class(cls):
+        return cls
+
+    def initialize(self, io_loop, defaults=None):
+        super(AsyncRedisCache, self).initialize(io_loop, defaults)
+        defaults = self.defaults if defaults is None else defaults
+        logger.info("async redis cache initialize:%s:%s",
+                    defaults.get("host", "localhost"),
+                    defaults.get("port", 6379))
+        self.serializer = CacheSerializer.from_options(defaults)
+        self.list_chunk_size = defaults.get("list_chunk_size",
+                                            self.LIST_CHUNK_SIZE)
+        self.pool = ConnectionPool(
+            max_connections=defaults.get("max_connections", 200),
+            host=defaults.get("host", "localhost"),
+            port=defaults.get("port", 6379),
+            password=defaults.get("passwd"),
+            db=defaults.get("db", 0),
+            connect_timeout=10)
+
+    def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        elif timeout == 0:
+            # ticket 21147 - avoid time.time() related precision issues
+            timeout = -1
+
+        return None if timeout is None else timeout
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def _loads(self, result):
+        if result is not None:
+            return self.serializer.loads(result)
+        return result
+
+    def _set_command(self, key, value, timeout, version):
+        key = self._make_key(key, version)
+        expired_time = self.get_backend_timeout(
+            self._value_timeout(value, timeout))
+        value = self.serializer.dumps(value)
+        if expired_time is None:
+            return ("SET", key, value)
+        return ("SETEX", key, expired_time, value)
+
+    async def _execute(self, *args):
+        async with self.pool.lease() as connection:
+            return await connection.execute(*args)
+
+    def pipeline(self):
+        """用法同RedisCache.pipeline"""
+        return AsyncRedisPipeline(self)
+
+    @instrument("get", lookup="one")
+    async def get(self, key, default=None, version=None, callback=None):
+        result = await self._execute("GET", self._make_key(key, version))
+        if result is None:
+            return default
+        return self._loads(result)
+
+    @instrument("set")
+    async def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+                  callback=None, tags=None):
+        if tags:
+            result, = await self.pipeline().set(
+                key, value, timeout, version, tags).execute()
+            return result
+        result = await self._execute(*self._set_command(key, value,
+                                                        timeout, version))
+        return result == b"OK"
+
+    @instrument("add")
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """SET NX，key不存在时才写入，返回是否写入了"""
+        command = ["SET", self._make_key(key, version),
+                   self.serializer.dumps(value), "NX"]
+        expired_time = self.get_backend_timeout(
+            self._value_timeout(value, timeout))
+        if expired_time is not None:
+            command.extend(("EX", expired_time))
+        return await self._execute(*command) is not None
+
+    @instrument("delete")
+    async def delete(self, key, version=None):
+        return await self._execute("DEL", self._make_key(key, version))
+
+    @instrument("lrange")
+    async def lrange(self, key, start, stop, version=None):
+        key = self._make_key(key, version)
+        return to_str_list(await self._execute("LRANGE", key, start, stop))
+
+    @instrument("llen")
+    async def llen(self, key, version=None):
+        return await self._execute("LLEN", self._make_key(key, version))
+
+    @instrument("rpush")
+    async def rpush(self, key, data_list, version=None, chunk_size=None):
+        """用法同RedisCache.rpush，很长的data_list拆成多条RPUSH一次发出"""
+        chunk_size = chunk_size or self.list_chunk_size
+        if len(data_list) <= chunk_size:
+            key = self._make_key(key, version)
+            return await self._execute("RPUSH", key, *data_list)
+        pipe = self.pipeline()
+        for i in range(0, len(data_list), chunk_size):
+            pipe.rpush(key, data_list[i:i + chunk_size], version)
+        results = await pipe.execute()
+        return results[-1]
+
+    @instrument("lpop")
+    async def lpop(self, key, count=None, version=None):
+        """count为None时返回一个元素或None，否则返回最多count个元素的list"""
+        command = pop_command("LPOP", self._make_key(key, version), count)
+        return pop_result(await self._execute(*command), count)
+
+    @instrument("rpop")
+    async def rpop(self, key, count=None, version=None):
+        command = pop_command("RPOP", self._make_key(key, version), count)
+        return pop_result(await self._execute(*command), count)
+
+    @instrument("ltrim")
+    async def ltrim(self, key, start, stop, version=None):
+        key = self._make_key(key, version)
+        return _is_ok(await self._execute("LTRIM", key, start, stop))
+
+    @instrument("expire")
+    async def expire(self, key, expire, version=None):
+        key = self._make_key(key, version)
+        return bool(await self._execute("EXPIRE", key, expire))
+
+    @instrument("get_many", lookup="many")
+    async def get_many(self, keys, version=None):
+        """MGET，返回命中的{key: value}"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        new_keys = [self._make_key(key, version) for key in keys]
+        results = await self._execute("MGET", *new_keys)
+        return {key: self._loads(result)
+                for key, result in zip(keys, results) if result is not None}
+
+    @instrument("set_many")
+    async def set_many(self, mapping, timeout=DEFAULT_TIMEOUT, version=None,
+                       tags=None):
+        if not mapping:
+            return []
+        pipe = self.pipeline()
+        for key, value in mapping.items():
+            pipe.set(key, value, timeout, version=version, tags=tags)
+        return await pipe.execute()
+
+    @instrument("delete_many")
+    async def delete_many(self, keys, version=None):
+        keys = [self._make_key(key, version) for key in keys]
+        if not keys:
+            return 0
+        return await self._execute("DEL", *keys)
+
+    async def invalidate_tags(self, *tags):
+        """返回删掉的key(_make_key之后的)"""
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        if not tag_keys:
+            return []
+        # 已经过期的不用删
+        now = time.time()
+        commands = [("ZRANGEBYSCORE", tag_key, now, "+inf")
+                    for tag_key in tag_keys]
+        commands.append(("DEL",) + tuple(tag_keys))
+        async with self.pool.lease() as connection:
+            results = await connection.execute_many(commands)
+            for result in results:
+                if isinstance(result, ReplyError):
+                    raise result
+            keys = sorted(set().union(*results[:-1]))
+            if keys:
+                # 分批DEL，一条命令删太多会卡住redis
+                results = await connection.execute_many(
+                    [("DEL",) + tuple(batch) for batch in batches(keys)])
+                for result in results:
+                    if isinstance(result, ReplyError):
+                        raise result
+        return to_str_list(keys)
+
+    async def invalidate_prefix(self, prefix, version=None):
+        """SCAN出匹配的key分批删掉，返回删掉的key(_make_key之后的)"""
+        pattern = "%s*" % self._make_key(prefix, version)
+        keys = []
+        cursor = b"0"
+        async with self.pool.lease() as connection:
+            while True:
+                cursor, batch = await connection.execute(
+                    "SCAN", cursor, "MATCH", pattern, "COUNT", 1000)
+                if batch:
+                    await connection.execute("DEL", *batch)
+                    keys.extend(batch)
+                if cursor == b"0":
+                    break
+        return to_str_list(keys)
+
+
+class AsyncRedisPipeline(object):
+    """execute时所有命令一次写出、一次读回"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._commands = []
+        self._parsers = []
+        self.results = None
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _queue(self, parser, *args):
+        self._commands.append(args)
+        self._parsers.append(parser)
+        return self
+
+    def get(self, key, version=None):
+        return self._queue(self.cache._loads, "GET",
+                           self.cache._make_key(key, version))
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+            tags=None):
+        command = self.cache._set_command(key, value, timeout, version)
+        self._queue(_is_ok, *command)
+        expired_time = command[2] if command[0] == "SETEX" else None
+        for tag in tags or ():
+            # 记录tag的命令不出现在results里
+            for tag_command in tag_commands(self.cache._tag_key(tag),
+                                            command[1], expired_time,
+                                            self.cache.tag_timeout):
+                self._queue(None, *tag_command)
+        return self
+
+    def mget(self, keys, version=None):
+        keys = [self.cache._make_key(key, version) for key in keys]
+        return self._queue(
+            lambda results: [self.cache._loads(r) for r in results],
+            "MGET", *keys)
+
+    def delete(self, *keys, version=None):
+        keys = [self.cache._make_key(key, version) for key in keys]
+        return self._queue(_identity, "DEL", *keys)
+
+    def expire(self, key, expire, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(_to_bool, "EXPIRE", key, expire)
+
+    def lrange(self, key, start, stop, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(to_str_list, "LRANGE", key, start, stop)
+
+    def llen(self, key, version=None):
+        return self._queue(_identity, "LLEN",
+                           self.cache._make_key(key, version))
+
+    def rpush(self, key, data_list, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(_identity, "RPUSH", key, *data_list)
+
+    def lpop(self, key, count=None, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(lambda result: pop_result(result, count),
+                           *pop_command("LPOP", key, count))
+
+    def rpop(self, key, count=None, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(lambda result: pop_result(result, count),
+                           *pop_command("RPOP", key, count))
+
+    def ltrim(self, key, start, stop, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(_is_ok, "LTRIM", key, start, stop)
+
+    def publish(self, channel, message):
+        return self._queue(_identity, "PUBLISH", channel, message)
+
+    async def execute(self):
+        commands, self._commands = self._commands, []
+        parsers, self._parsers = self._parsers, []
+        async with self.cache.pool.lease() as connection:
+            results = await connection.execute_many(commands)
+        for result in results:
+            if isinstance(result, ReplyError):
+                raise result
+        self.results = [parser(result)
+                        for parser, result in zip(parsers, results)
+                        if parser is not None]
+        return self.results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.execute()
@@ -9,9 +9,39 @@ import weakref
 from tornado.util import import_object
 from tornado.options import options
 from tornado.locks import Lock
+from tornado.concurrent import Future
+from tornado.gen import sleep
+from functools import wraps
+import copy
+import math
+import random
+import time
+from apps.core.cache.metrics import CacheMetrics
 DEFAULT_TIMEOUT = object()
 
 
+class _Miss(object):
+    """get没取到时的返回值，和缓存住的None(负缓存)区分开
+    >>> value = yield cache.get(key, MISS)
+    >>> if value is MISS:
+    ...     value = yield query()  # 不存在时value是None，也缓存起来
+    ...     yield cache.set(key, value)
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "MISS"
+
+    def __reduce__(self):
+        return "MISS"
+
+
+MISS = _Miss()
+
+
 def default_key_func(key, key_prefix, version):
     """
     Default function to generate keys.
@@ -89,6 +119,18 @@ class CacheBase(Configurable):
 
         return None if timeout is None else self.io_loop.time() + timeout
 
+    def _tag_key(self, tag):
+        """tag不分version，bump version后invalidate_tags也能删掉旧的key
+        redis里是zset，以前是set的"tag:"不能再用
+        """
+        return "%s:ztag:%s" % (self.key_prefix, tag)
+
+    def _value_timeout(self, value, timeout=DEFAULT_TIMEOUT):
+        """没指定timeout时，None(负缓存)用negative_timeout"""
+        if value is None and timeout is DEFAULT_TIMEOUT:
+            return self.negative_timeout
+        return timeout
+
     def get(self, key, default=None, version=None):
         raise NotImplementedError(
             'subclasses of BaseCache must provide an add() method')
@@ -105,10 +147,28 @@ class CacheBase(Configurable):
         raise NotImplementedError(
             'subclasses of BaseCache must provide a set_sync() method')
 
+    def delete_sync(self, key, version=None):
+        raise NotImplementedError(
+            'subclasses of BaseCache must provide a delete_sync() method')
+
     def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
         raise NotImplementedError(
             'subclasses of BaseCache must provide an add() method')
 
+    def invalidate_tags(self, *tags):
+        """删掉set(..., tags=[...])时带了这些tag的key
+        >>> yield cache.set("user:1", user, tags=["user"])
+        >>> yield cache.invalidate_tags("user")
+        """
+        raise NotImplementedError(
+            'subclasses of BaseCache must provide an invalidate_tags() method')
+
+    def invalidate_prefix(self, prefix, version=None):
+        """删掉key以prefix开头的，只对default_key_func这种前缀不变的key_func有效"""
+        raise NotImplementedError(
+            'subclasses of BaseCache must provide an '
+            'invalidate_prefix() method')
+
     def initialize(self, io_loop, defaults=None):
         self.io_loop = io_loop
         self.key_func = get_key_func(getattr(options, 'key_func', None))
@@ -119,6 +179,16 @@ class CacheBase(Configurable):
         self._lock = Lock()
         if defaults is not None:
             self.defaults.update(defaults)
+        # 缓存None表示"不存在"，用较短的过期时间，免得数据建出来之后还一直读到None
+        self.negative_timeout = self.defaults.get("negative_timeout", 30)
+        # redis里tag的key集合的过期时间，要不短于带tag的key的过期时间
+        self.tag_timeout = self.defaults.get("tag_timeout", 86400)
+        self.metrics = CacheMetrics.from_options(self.__class__.__name__,
+                                                 self.defaults)
+
+    def stats(self):
+        """按操作和key前缀的次数、耗时分布和命中率"""
+        return self.metrics.stats()
 
     def lock(self, timeout=500):
         return self._lock.acquire()
@@ -130,6 +200,14 @@ class CacheBase(Configurable):
     def configurable_base(cls):
         return CacheBase
 
+    def __init_subclass__(cls, **kwargs):
+        """具体的engine各自是自己的configurable base，configured_class返回自己，
+        MemoryCache(...)建出来的一定是MemoryCache，不管CacheBase.configure选了谁
+        Configurable的impl参数是按类属性找的，这里断开，不继承CacheBase.configure的参数
+        """
+        super(CacheBase, cls).__init_subclass__(**kwargs)
+        cls._Configurable__impl_kwargs = None
+
 
 class CacheProxy(object):
     """cache代理
@@ -187,6 +265,230 @@ def produce_class_func_cache_key(func, instance, *args, **kwargs):
     return cache_key
 
 
+def cached(timeout=DEFAULT_TIMEOUT, lock=False, lock_timeout=10,
+           lock_wait=0.05, beta=1.0, cache_engine=None):
+    """协程结果缓存，key由produce_class_func_cache_key生成
+    >>> class CategoryService(BaseService):
+    ...     @classmethod
+    ...     @cached(timeout=60)
+    ...     async def category_tree(cls, root_id):
+    ...         ...
+
+    1. 同一进程内同一个key同时只有一个在算，其他的等它的结果
+    2. lock=True时用cache.add(SET NX)加分布式锁，
+       别的进程在算的时候有旧值用旧值，没有就等它写回，最多等lock_timeout秒
+    3. 过期前按概率提前刷新(XFetch)，算得越久、离过期越近，越容易提前刷新，
+       beta越大越积极，0则不提前
+    缓存的是(value, 耗时, 过期时间)，所以None也会被缓存
+    """
+    def decorator(func):
+        inflight = {}  # key->Future
+
+        def is_fresh(entry):
+            value, delta, expire_at = entry
+            if expire_at is None:
+                return True
+            return (time.time() - delta * beta * math.log(1 - random.random())
+                    < expire_at)
+
+        async def compute(engine, key, entry, args, kwargs):
+            acquired = False
+            if lock:
+                lock_key = "%s:lock" % key
+                acquired = await engine.add(lock_key, 1, lock_timeout)
+                if not acquired:
+                    if entry is not None:  # 别的进程在刷新，先用旧值
+                        return entry[0]
+                    deadline = time.time() + lock_timeout
+                    while time.time() < deadline:
+                        await sleep(lock_wait)
+                        entry = await engine.get(key)
+                        if entry is not None:
+                            return entry[0]
+                    # 等超时了就自己算
+            try:
+                start = time.time()
+                value = await func(*args, **kwargs)
+                delta = time.time() - start
+                backend_timeout = (engine.default_timeout
+                                   if timeout is DEFAULT_TIMEOUT else timeout)
+                expire_at = (None if backend_timeout is None
+                             else time.time() + backend_timeout)
+                await engine.set(key, (value, delta, expire_at), timeout)
+            finally:
+                if acquired:
+                    await engine.delete(lock_key)
+            return value
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            engine = cache if cache_engine is None else cache_engine
+            if args:
+                key = produce_class_func_cache_key(func, args[0], *args[1:],
+                                                   **kwargs)
+            else:
+                key = produce_class_func_cache_key(func, func.__module__,
+                                                   **kwargs)
+            entry = await engine.get(key)
+            if entry is not None and is_fresh(entry):
+                return entry[0]
+            future = inflight.get(key)
+            if future is not None:
+                return await future
+            future = inflight[key] = Future()
+            try:
+                value = await compute(engine, key, entry, args, kwargs)
+            except Exception as e:
+                future.set_exception(e)
+                # 没人等的时候不要打印exception never retrieved
+                future.exception()
+                raise
+            else:
+                future.set_result(value)
+            finally:
+                del inflight[key]
+            return value
+        return wrapper
+    return decorator
+
+
 class ModelCache(object):
-    def get(self, model_id):
-        pass
+    """ModelBase子类的主键行缓存
+    进程内的MemoryCache里存每行的列值，取出来用session.merge(load=False)
+    挂回session，不发SQL，改了之后照常save_updates
+    >>> user = User.row_cache().get(1)
+    >>> users = User.row_cache().get_many([1, 2, 3])  # 没命中的一条IN查询
+    1. 不存在的主键也缓存，用较短的negative_timeout
+    2. save_object、save_updates、delete之后按主键删掉，bulk_insert之后按主键
+       或者整张表(tag)删掉
+    3. 进程之间不通知，别的进程写的最多timeout秒之后才读到，
+       所以只给能容忍这么久旧数据的表打开，见ModelBase.row_cache_timeout
+    """
+
+    def __init__(self, model_class, timeout=60, negative_timeout=30,
+                 max_size=10000):
+        mapper = model_class.__mapper__
+        self.model_class = model_class
+        self._mapper = mapper
+        self.timeout = timeout
+        self.negative_timeout = min(negative_timeout, timeout)
+        self.max_size = max_size
+        self.tag = model_class.__tablename__
+        self._manager = mapper.class_manager
+        self._pk_columns = mapper.primary_key
+        self._pk_attrs = [mapper.get_property_by_column(column).key
+                          for column in mapper.primary_key]
+        self._attrs = [prop.key for prop in mapper.column_attrs]
+        self.engine = None
+
+    def _engine(self):
+        # 和CacheProxy一样，ioloop换了(单元测试)就重新建
+        io_loop = IOLoop.current()
+        if self.engine is None or self.engine.io_loop is not io_loop:
+            from apps.core.cache.memory import MemoryCache
+            self.engine = MemoryCache(io_loop, force_instance=True,
+                                      defaults={"max_size": self.max_size})
+        return self.engine
+
+    def _key(self, ident):
+        if not isinstance(ident, (tuple, list)):
+            ident = (ident,)
+        return "%s:%s" % (self.tag, "-".join(map(str, ident)))
+
+    def _in_session(self, ident, session):
+        """和query.get一样先看session的identity map，已经加载过的直接返回，
+        不然merge会把缓存里的旧值盖到还没保存的修改上
+        """
+        if not isinstance(ident, (tuple, list)):
+            ident = (ident,)
+        key = self._mapper.identity_key_from_primary_key(list(ident))
+        return session.identity_map.get(key)
+
+    def _query(self, session=None):
+        if session is None:
+            return self.model_class.query()
+        return self.model_class.query(session=session)
+
+    def _dump(self, obj):
+        return {attr: getattr(obj, attr) for attr in self._attrs}
+
+    def _load(self, row, session=None):
+        from sqlalchemy.orm import make_transient_to_detached
+        obj = self._manager.new_instance()
+        for attr, value in row.items():
+            if isinstance(value, (dict, list)):  # JSON列，不要和缓存共用
+                value = copy.deepcopy(value)
+            setattr(obj, attr, value)
+        make_transient_to_detached(obj)
+        if session is None:
+            session = self.model_class.get_session()
+        return session.merge(obj, load=False)
+
+    def _store(self, key, obj):
+        if obj is None:
+            self._engine().set_sync(key, None, self.negative_timeout,
+                                    tags=[self.tag])
+        else:
+            self._engine().set_sync(key, self._dump(obj), self.timeout,
+                                    tags=[self.tag])
+
+    def get(self, ident, session=None):
+        """同query().get(ident)，不存在返回None"""
+        if session is None:
+            session = self.model_class.get_session()
+        obj = self._in_session(ident, session)
+        if obj is not None:
+            return obj
+        key = self._key(ident)
+        row = self._engine().get_sync(key, MISS)
+        if row is MISS:
+            obj = self._query(session).get(ident)
+            self._store(key, obj)
+            return obj
+        if row is None:
+            return None
+        return self._load(row, session)
+
+    def get_many(self, idents, session=None):
+        """返回{ident: obj}，不存在的不在里面"""
+        if session is None:
+            session = self.model_class.get_session()
+        engine = self._engine()
+        result = {}
+        misses = []
+        for ident in idents:
+            obj = self._in_session(ident, session)
+            if obj is not None:
+                result[ident] = obj
+                continue
+            row = engine.get_sync(self._key(ident), MISS)
+            if row is MISS:
+                misses.append(ident)
+            elif row is not None:
+                result[ident] = self._load(row, session)
+        if not misses:
+            return result
+        query = self._query(session)
+        if len(self._pk_columns) == 1:
+            column, = self._pk_columns
+            query = query.filter(column.in_(misses))
+        else:
+            from sqlalchemy import tuple_
+            query = query.filter(tuple_(*self._pk_columns).in_(misses))
+        found = {}
+        for obj in query:
+            ident = tuple(getattr(obj, attr) for attr in self._pk_attrs)
+            found[self._key(ident)] = obj
+        for ident in misses:
+            key = self._key(ident)
+            obj = found.get(key)
+            self._store(key, obj)
+            if obj is not None:
+                result[ident] = obj
+        return result
+
+    def invalidate(self, ident):
+        self._engine().delete_sync(self._key(ident))
+
+    def invalidate_all(self):
+        self._engine().invalidate_tags(self.tag)
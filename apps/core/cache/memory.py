@@ -1,56 +1,96 @@
 # coding=utf-8
+"""
+进程内cache
+options.cache_options = {
+    "max_size": 1000,            # 按条数限制
+    "max_bytes": 64 * 1024 ** 2, # 或者按估计的字节数限制，设置了就不看max_size
+    "sizer": None,               # sizer(value)->字节数，默认estimate_size
+}
+淘汰用SLRU，只被读过一次的key(比如一次遍历)挤不掉反复被读的key
+"""
 
-from apps.core.cache.base import CacheBase, DEFAULT_TIMEOUT
+from apps.core.cache.base import CacheBase, DEFAULT_TIMEOUT, MISS
+from apps.core.cache.metrics import instrument
 from tornado.concurrent import Future
 from tornado import stack_context
-from collections import deque
+from collections import OrderedDict, defaultdict, deque
 from tornado.ioloop import IOLoop
+from tornado.util import import_object
+from itertools import chain
+import heapq
+import math
+import sys
 
+_MISSING = object()
 
-class LRUCache(dict):
+
+class LRUCache(OrderedDict):
+    """按调用先后淘汰的dict
+    OrderedDict底层是哈希表加双向链表，move_to_end和popitem都是O(1)，
+    命中、覆盖和删除的开销与maxsize无关
+    """
     # TODO:协程安全?
 
     def __init__(self, maxsize, *args, **kwargs):
-        super(LRUCache, self).__init__(*args, **kwargs)
-        # 把key保存起来,不用heapq的原因是实际上里面的元素顺序和值无关，
-        # 只和调用先后有关,
+        # 父类初始化时会调用__setitem__，maxsize要先设置
         self.maxsize = maxsize
-        self._lru = deque(self, maxlen=maxsize)
+        self.on_evict = None  # 被挤出时回调on_evict(key)
+        self.evictions = 0
+        super(LRUCache, self).__init__(*args, **kwargs)
 
     def get(self, key, default=None):
-        if key in self:
-            self._refresh(key)
-        return dict.get(self, key, default)
-
-    def _refresh(self, key, delete=False):
-        """提到最前"""
-        self._lru.remove(key)  # O(n)
-        if not delete:
-            self._lru.append(key)  # O(1)
+        value = OrderedDict.get(self, key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.move_to_end(key)  # 提到最前,O(1)
+        return value
 
     def __setitem__(self, key, value):
-        # deque达到maxlen之后，会自动挤出左边的数，
-        # 但是是静默的,没有同时处理dict本身
-        if key not in self:
-            if len(self) >= self.maxsize:
-                old_key = self._lru.popleft()
-                dict.__delitem__(self, old_key)
-            self._lru.append(key)
-            dict.__setitem__(self, key, value)
-        else:
-            self._refresh(key)
-            dict.__setitem__(self, key, value)
+        if key in self:
+            self.move_to_end(key)
+        elif len(self) >= self.maxsize:
+            # 挤出最久没用的。不用popitem，3.6-3.10的popitem在子类上会调
+            # 重载过的__getitem__，先move_to_end再pop，抛KeyError
+            old_key = next(iter(self))
+            OrderedDict.__delitem__(self, old_key)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(old_key)
+        OrderedDict.__setitem__(self, key, value)
 
     def __getitem__(self, key):
-        value = dict.__getitem__(key)
+        value = OrderedDict.__getitem__(self, key)
         # 到这里起码没有异常了
-        self._refresh(key)
+        self.move_to_end(key)
         return value
 
-    def __delitem__(self, key):
-        dict.__delitem__(self, key)
-        # 到这里起码没有异常了
-        self._refresh(key, delete=True)
+    # 3.6-3.10的OrderedDict在子类上pop、popitem、copy会调重载过的__getitem__，
+    # move_to_end之后再删就抛KeyError，这几个都直接用OrderedDict的方法
+
+    def pop(self, key, default=_MISSING):
+        value = OrderedDict.get(self, key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        OrderedDict.__delitem__(self, key)
+        return value
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError("dictionary is empty")
+        key = next(reversed(self)) if last else next(iter(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            self[key] = default
+            return default
+        return value
+
+    def copy(self):
+        return self.__class__(self.maxsize, OrderedDict.items(self))
 
     def ttl(self, key):
         """
@@ -58,12 +98,259 @@ class LRUCache(dict):
         <=0:过期了
         """
         if key in self:
-            value, expired = dict.get(self, key)
+            value, expired = OrderedDict.get(self, key)
+            if expired is None:  # 永不过期
+                return float("inf")
             return expired - IOLoop.current().time()
         else:
             return -1
 
 
+def estimate_size(obj):
+    """粗略估计对象占的内存(字节)，容器连同里面的元素一起算，同一个对象只算一次"""
+    size = 0
+    seen = set()
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+    return size
+
+
+class SLRUCache(object):
+    """分段LRU，按权重(条数或者字节数)限制容量
+    新key(写入算第一次访问)进probation段，写入之后第一次被读到就升到protected段，
+    protected超过protected_ratio时最久没用的降回probation，淘汰先从probation淘汰。
+    写了没读过的key只会在probation里轮换，挤不掉protected里的热点
+    接口和LRUCache一样，key对应的值只能通过get/[]取，会调整顺序
+    """
+
+    def __init__(self, capacity, sizer=None, protected_ratio=0.8):
+        self.capacity = capacity
+        self.sizer = sizer  # sizer(key, value)->权重，None则每个key算1
+        self.protected_capacity = int(capacity * protected_ratio)
+        self._probation = OrderedDict()  # key->(value, weight)
+        self._protected = OrderedDict()
+        self.weight = 0
+        self.protected_weight = 0
+        self.evictions = 0
+        self.on_evict = None  # 被挤出时回调on_evict(key)
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def __contains__(self, key):
+        return key in self._probation or key in self._protected
+
+    def __iter__(self):
+        return chain(self._probation, self._protected)
+
+    def get(self, key, default=None):
+        entry = self._probation.pop(key, _MISSING)
+        if entry is not _MISSING:
+            # 写入之后第一次读到(写入算第一次访问)，升到protected
+            self._protected[key] = entry
+            self.protected_weight += entry[1]
+            self._demote()
+            return entry[0]
+        entry = self._protected.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        self._protected.move_to_end(key)
+        return entry[0]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        weight = 1 if self.sizer is None else self.sizer(key, value)
+        protected = key in self._protected
+        self._remove(key)
+        if weight > self.capacity:
+            # 比整个cache都大，不存
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key)
+            return
+        self.weight += weight
+        if protected:  # 覆盖写不降级
+            self._protected[key] = (value, weight)
+            self.protected_weight += weight
+            self._demote()
+        else:
+            self._probation[key] = (value, weight)
+        self._evict()
+
+    def __delitem__(self, key):
+        if self._remove(key) is _MISSING:
+            raise KeyError(key)
+
+    def pop(self, key, default=None):
+        entry = self._remove(key)
+        if entry is _MISSING:
+            return default
+        return entry[0]
+
+    def clear(self):
+        self._probation.clear()
+        self._protected.clear()
+        self.weight = self.protected_weight = 0
+
+    def _remove(self, key):
+        entry = self._probation.pop(key, _MISSING)
+        if entry is _MISSING:
+            entry = self._protected.pop(key, _MISSING)
+            if entry is _MISSING:
+                return entry
+            self.protected_weight -= entry[1]
+        self.weight -= entry[1]
+        return entry
+
+    def _demote(self):
+        while self.protected_weight > self.protected_capacity:
+            key, entry = self._protected.popitem(last=False)
+            self.protected_weight -= entry[1]
+            self._probation[key] = entry
+
+    def _evict(self):
+        while self.weight > self.capacity:
+            # probation里只剩刚写入的key时从protected淘汰，新key至少留一轮
+            if len(self._probation) > 1 or not self._protected:
+                key, (_, weight) = self._probation.popitem(last=False)
+            else:
+                key, (_, weight) = self._protected.popitem(last=False)
+                self.protected_weight -= weight
+            self.weight -= weight
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key)
+
+    def ttl(self, key):
+        """
+        >0:还可以存活
+        <=0:过期了
+        """
+        entry = self._probation.get(key) or self._protected.get(key)
+        if entry is None:
+            return -1
+        value, expired = entry[0]
+        if expired is None:  # 永不过期
+            return float("inf")
+        return expired - IOLoop.current().time()
+
+    def stats(self):
+        return {
+            "entries": len(self),
+            "weight": self.weight,
+            "capacity": self.capacity,
+            "protected": len(self._protected),
+            "probation": len(self._probation),
+            "evictions": self.evictions,
+        }
+
+
+class ExpiryWheel(object):
+    """分桶的过期回收
+    key按过期时间落到宽度为resolution秒的桶里，整个cache只挂一个定时器，
+    到点按桶批量回收，而不是每个key一个IOLoop.call_at。
+    每个key只在最后一次设置的桶里，覆盖写不会留下过期的定时器
+    """
+
+    def __init__(self, resolution=1.0, batch_size=1000, history=60):
+        self.resolution = resolution
+        self.batch_size = batch_size  # 每次最多回收的key数，剩下的下次接着回收
+        self._buckets = {}  # tick->set(key)
+        self._ticks = []  # tick的最小堆
+        self._key_ticks = {}  # key->tick
+        self.sweeps = 0
+        self.reclaimed = 0
+        self.history = deque(maxlen=history)  # 最近每次回收的个数
+
+    def __len__(self):
+        return len(self._key_ticks)
+
+    def add(self, key, expired_time):
+        # 向上取整，桶到期时桶里的key一定都过期了
+        tick = int(math.ceil(expired_time / self.resolution))
+        old_tick = self._key_ticks.get(key)
+        if old_tick == tick:
+            return
+        if old_tick is not None:
+            self._buckets[old_tick].discard(key)
+        self._key_ticks[key] = tick
+        bucket = self._buckets.get(tick)
+        if bucket is None:
+            bucket = self._buckets[tick] = set()
+            heapq.heappush(self._ticks, tick)
+        bucket.add(key)
+
+    def discard(self, key):
+        tick = self._key_ticks.pop(key, None)
+        if tick is not None:
+            self._buckets[tick].discard(key)
+
+    def next_deadline(self):
+        """最早一个桶的到期时间，没有则返回None"""
+        while self._ticks and not self._buckets[self._ticks[0]]:
+            del self._buckets[heapq.heappop(self._ticks)]
+        if self._ticks:
+            return self._ticks[0] * self.resolution
+        return None
+
+    def pop_expired(self, now):
+        """取出已到期的key，最多batch_size个"""
+        keys = []
+        while self._ticks and len(keys) < self.batch_size:
+            tick = self._ticks[0]
+            if tick * self.resolution > now:
+                break
+            bucket = self._buckets[tick]
+            while bucket and len(keys) < self.batch_size:
+                key = bucket.pop()
+                del self._key_ticks[key]
+                keys.append(key)
+            if not bucket:
+                heapq.heappop(self._ticks)
+                del self._buckets[tick]
+        return keys
+
+    def record(self, reclaimed):
+        self.sweeps += 1
+        self.reclaimed += reclaimed
+        self.history.append(reclaimed)
+
+    def stats(self):
+        return {
+            "sweeps": self.sweeps,
+            "reclaimed": self.reclaimed,
+            "last_reclaimed": self.history[-1] if self.history else 0,
+            "recent_reclaimed": list(self.history),
+            "pending": len(self),
+        }
+
+
+def _entry_sizer(sizer):
+    # 存的是(value, expired)，key和tuple本身也算上
+    overhead = sys.getsizeof((None, None))
+
+    def entry_size(key, entry):
+        return overhead + sys.getsizeof(key) + sizer(entry[0])
+    return entry_size
+
+
 class MemoryCache(CacheBase):
     """临时Cache和单元测试Cache实现"""
     DEFAULT_SIZE = 1000
@@ -72,6 +359,14 @@ class MemoryCache(CacheBase):
     def configurable_base(cls):
         return MemoryCache
 
+    @classmethod
+    def configurable_default(cls):
+        return MemoryCache
+
+    @classmethod
+    def configured_class(cls):
+        return cls
+
     def regiest_callback(self, future, callback):
         callback = stack_context.wrap(callback)
 
@@ -84,75 +379,149 @@ class MemoryCache(CacheBase):
             self.io_loop.add_callback(callback, response)
         future.add_done_callback(handle_future)
 
-    def get(self, key, default=None, version=None, callback=None):
+    def _resolved(self, result, callback=None):
+        """返回一个已经完成的Future，await/yield时不需要再等一轮IOLoop"""
         future = Future()
         if callback:
             self.regiest_callback(future, callback)
-        key = self._make_key(key, version)
-
-        def get_value():
-            value = self._cache.get(key)
-            if value is not None:
-                value, expired = value
-
-                if expired < self.io_loop.time():  # 已过期
-                    value = None
-                    del self._cache[key]
-            future.set_result(value)
-        self.io_loop.add_callback(get_value)
+        future.set_result(result)
         return future
 
+    def get(self, key, default=None, version=None, callback=None):
+        return self._resolved(self.get_sync(key, default, version), callback)
+
+    @instrument("get", lookup="one")
     def get_sync(self, key, default=None, version=None):
         key = self._make_key(key, version)
-        value = self._cache.get(key)
-        if value is not None:
-            value, expired = value
+        entry = self._cache.get(key)
+        if entry is None:
+            return default
+        value, expired = entry
+        if expired is not None and expired < self.io_loop.time():  # 已过期
+            self._discard(key)
+            return default
+        return value
 
-            if expired < self.io_loop.time():  # 已过期
-                value = None
+    def _store(self, key, value, expired_time, tags=None):
+        self._cache[key] = (value, expired_time)
+        self._untag(key)
+        if key not in self._cache:  # 比max_bytes还大，没存进去
+            self._expiry.discard(key)
+            return
+        if tags:
+            tags = frozenset(tags)
+            self._key_tags[key] = tags
+            for tag in tags:
+                self._tags[tag].add(key)
+        if expired_time is None:
+            self._expiry.discard(key)
+        else:
+            self._expiry.add(key, expired_time)
+            self._schedule_sweep()
+
+    def _schedule_sweep(self):
+        """只保留一个定时器，指向最早到期的桶"""
+        deadline = self._expiry.next_deadline()
+        if deadline is None:
+            return
+        if self._sweep_handle is not None:
+            if self._sweep_deadline <= deadline:
+                return
+            self.io_loop.remove_timeout(self._sweep_handle)
+        self._sweep_deadline = deadline
+        self._sweep_handle = self.io_loop.call_at(deadline,
+                                                  self._sweep_expired)
+
+    def _sweep_expired(self):
+        self._sweep_handle = None
+        now = self.io_loop.time()
+        reclaimed = 0
+        for key in self._expiry.pop_expired(now):
+            if key in self._cache and self._cache.ttl(key) <= 0:
                 del self._cache[key]
-        return value
+                self._untag(key)
+                reclaimed += 1
+        self._expiry.record(reclaimed)
+        self._schedule_sweep()
+
+    def size_stats(self):
+        """条数、字节数(设置了max_bytes时)和被挤出的次数"""
+        stats = self._cache.stats()
+        weight = stats.pop("weight")
+        capacity = stats.pop("capacity")
+        if self._cache.sizer is None:
+            stats.update(bytes=None, max_bytes=None, max_size=capacity)
+        else:
+            stats.update(bytes=weight, max_bytes=capacity, max_size=None)
+        return stats
 
-    def _examin_expired(self, key):  # TODO：加个锁吗。。
-        if key in self._cache and self._cache.ttl(key) <= 0:
-            del self._cache[key]
+    def clear(self):
+        self._cache.clear()
+        self._tags.clear()
+        self._key_tags.clear()
+        self._expiry = ExpiryWheel(self._expiry.resolution,
+                                   self._expiry.batch_size)
+
+    def expire_stats(self):
+        """过期回收的统计，recent_reclaimed是最近每次回收的个数"""
+        return self._expiry.stats()
 
     def set(self, key, value,
-            timeout=DEFAULT_TIMEOUT, version=None, callback=None):
-        future = Future()
-        if callback:
-            self.regiest_callback(future, callback)
-        key = self._make_key(key, version)
-        # if timeout
-        expired_time = self.get_backend_timeout(timeout)
-
-        def set_value():
-            self._cache[key] = (value, expired_time)
-            future.set_result(None)
-        self.io_loop.add_callback(set_value)
-        if expired_time and expired_time > 0:
-            self.io_loop.call_at(expired_time,
-                                 self._examin_expired,
-                                 key)
-        return future
+            timeout=DEFAULT_TIMEOUT, version=None, callback=None, tags=None):
+        self.set_sync(key, value, timeout, version, tags)
+        return self._resolved(None, callback)
 
     def delete(self, key, version=None, callback=None):
-        future = Future()
-        if callback:
-            self.regiest_callback(future, callback)
+        self.delete_sync(key, version)
+        return self._resolved(None, callback)
+
+    @instrument("set")
+    def set_sync(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+                 tags=None):
         key = self._make_key(key, version)
+        expired_time = self.get_backend_timeout(
+            self._value_timeout(value, timeout))
+        self._store(key, value, expired_time, tags)
 
-        def set_value():
-            del self._cache[key]
-            future.set_result(None)
-        self.io_loop.add_callback(set_value)
-        return future
+    @instrument("delete")
+    def delete_sync(self, key, version=None):
+        self._discard(self._make_key(key, version))
 
-    def set_sync(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
-        key = self._make_key(key, version)
-        # if timeout
-        expired_time = self.get_backend_timeout(timeout)
-        self._cache[key] = (value, expired_time)
+    def _discard(self, new_key):
+        """按_make_key之后的key删除"""
+        self._cache.pop(new_key, None)
+        self._forget(new_key)
+
+    def _forget(self, new_key):
+        """key已经不在_cache里了，清掉过期和tag的记录"""
+        self._expiry.discard(new_key)
+        self._untag(new_key)
+
+    def _untag(self, new_key):
+        tags = self._key_tags.pop(new_key, None)
+        if tags:
+            for tag in tags:
+                keys = self._tags[tag]
+                keys.discard(new_key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate_tags(self, *tags):
+        """删掉set时带了这些tag的key，返回删掉的key(_make_key之后的)"""
+        keys = set()
+        for tag in tags:
+            keys.update(self._tags.get(tag, ()))
+        for key in keys:
+            self._discard(key)
+        return self._resolved(sorted(keys))
+
+    def invalidate_prefix(self, prefix, version=None):
+        """删掉key以prefix开头的，返回删掉的key(_make_key之后的)"""
+        new_prefix = self._make_key(prefix, version)
+        keys = [key for key in self._cache if key.startswith(new_prefix)]
+        for key in keys:
+            self._discard(key)
+        return self._resolved(keys)
 
     def __contains__(self, key):
         """不附带删除、提到最前的副作用"""
@@ -160,11 +529,29 @@ class MemoryCache(CacheBase):
         return self._cache.ttl(key) > 0
 
     def add(self, key, value,
-            timeout=DEFAULT_TIMEOUT, version=None, callback=None):
-        pass
+            timeout=DEFAULT_TIMEOUT, version=None, callback=None, tags=None):
+        """key不存在时才写入，返回是否写入了"""
+        if self.get_sync(key, MISS, version) is not MISS:
+            return self._resolved(False, callback)
+        self.set_sync(key, value, timeout, version, tags)
+        return self._resolved(True, callback)
 
     def initialize(self, io_loop, defaults=None):
-        max_size = defaults.get(
-            'max_size', self.DEFAULT_SIZE) if defaults else self.DEFAULT_SIZE
-        self._cache = LRUCache(max_size)
         super(MemoryCache, self).initialize(io_loop, defaults)
+        max_bytes = self.defaults.get("max_bytes")
+        if max_bytes:
+            sizer = self.defaults.get("sizer") or estimate_size
+            if not callable(sizer):
+                sizer = import_object(sizer)
+            self._cache = SLRUCache(max_bytes, sizer=_entry_sizer(sizer))
+        else:
+            self._cache = SLRUCache(
+                self.defaults.get("max_size", self.DEFAULT_SIZE))
+        self._expiry = ExpiryWheel(
+            resolution=self.defaults.get("expire_resolution", 1.0),
+            batch_size=self.defaults.get("expire_batch_size", 1000))
+        self._tags = defaultdict(set)  # tag->set(key)
+        self._key_tags = {}  # key->frozenset(tag)
+        self._cache.on_evict = self._forget
+        self._sweep_handle = None
+        self._sweep_deadline = None
@@ -0,0 +1,184 @@
+# coding=utf-8
+"""
+cache的统计
+按操作和key前缀统计次数、耗时分布、命中率，慢操作打warning，
+其余的按trace_sample_rate抽样打info，不再每次调用都打日志
+cache_options = {
+    "slow_threshold": 0.1,     # 秒，超过的打warning
+    "trace_sample_rate": 0.0,  # 0~1，抽样打info的比例
+    "sync_sample_every": 16,   # 进程内的同步操作平均每N次统计一次，按N次记
+}
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+from tornado.concurrent import is_future
+import inspect
+import logging
+import random
+import time
+logger = logging.getLogger("tornado.application")
+
+# 耗时分布的上界(毫秒)
+BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float("inf"))
+
+
+def key_prefix(key):
+    """'user:1'->'user'，produce_class_func_cache_key生成的'A.func.1'->'A'"""
+    if not isinstance(key, str):
+        if isinstance(key, (list, tuple, set, dict)):
+            key = next(iter(key), "")
+        key = "%s" % key
+    # 第一个":"前面的部分里再找"."，就是第一个":"或"."之前的部分
+    return key.partition(":")[0].partition(".")[0]
+
+
+class OpStats(object):
+    __slots__ = ("count", "total", "max", "hits", "misses", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def record(self, cost, hits, misses, weight=1):
+        """weight是抽样时这一次代表的调用次数"""
+        self.count += weight
+        self.total += cost * weight
+        if cost > self.max:
+            self.max = cost
+        self.hits += hits * weight
+        self.misses += misses * weight
+        self.buckets[bisect_left(BUCKETS, cost * 1000)] += weight
+
+    def to_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / lookups if lookups else None,
+            "histogram_ms": dict(zip(("%g" % b for b in BUCKETS),
+                                     self.buckets)),
+        }
+
+
+class CacheMetrics(object):
+
+    def __init__(self, name, slow_threshold=0.1, sample_rate=0.0,
+                 sync_sample_every=16):
+        self.name = name
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.sync_sample_every = sync_sample_every
+        self._sync_sample_rate = 1.0 / sync_sample_every
+        self._ops = defaultdict(OpStats)  # (op, prefix)->OpStats
+
+    @classmethod
+    def from_options(cls, name, defaults):
+        return cls(name,
+                   slow_threshold=defaults.get("slow_threshold", 0.1),
+                   sample_rate=defaults.get("trace_sample_rate", 0.0),
+                   sync_sample_every=defaults.get("sync_sample_every", 16))
+
+    def sample_sync(self):
+        """进程内的同步操作本身只要几微秒，统计也不能每次都做，随机抽样"""
+        return (self.sync_sample_every == 1 or
+                random.random() < self._sync_sample_rate)
+
+    def record(self, op, key, cost, hits=0, misses=0, weight=1):
+        self._ops[(op, key_prefix(key))].record(cost, hits, misses, weight)
+        if cost >= self.slow_threshold:
+            logger.warning("slow cache %s %s key:%s %.1fms",
+                           self.name, op, key, cost * 1000)
+        elif self.sample_rate and random.random() < self.sample_rate:
+            logger.info("cache %s %s key:%s %.3fms",
+                        self.name, op, key, cost * 1000)
+
+    def stats(self):
+        """{op: {prefix: {...}}}"""
+        result = defaultdict(dict)
+        for (op, prefix), op_stats in self._ops.items():
+            result[op][prefix] = op_stats.to_dict()
+        return dict(result)
+
+    def reset(self):
+        self._ops.clear()
+
+
+def _count_hits(lookup, key, result, miss):
+    if lookup == "one":
+        return (0, 1) if result is miss else (1, 0)
+    if lookup == "many":
+        hits = len(result)
+        return hits, len(key) - hits
+    return 0, 0
+
+
+def _swap_default(args, kwargs, miss):
+    """把调用方的default(第二个参数)换成miss，返回(args, kwargs, 原来的default)
+    这样缓存住的None和default=None分得开
+    """
+    if args:
+        return (miss,) + args[1:], kwargs, args[0]
+    kwargs = dict(kwargs)
+    default = kwargs.get("default")
+    kwargs["default"] = miss
+    return args, kwargs, default
+
+
+def instrument(op, lookup=None):
+    """统计cache engine的一个方法，方法第一个参数是key
+    lookup="one"时default(第二个参数)换成MISS调用，返回MISS算未命中，再换回调用方的default；
+    lookup="many"时按返回的dict算命中个数
+    同步的方法(进程内的*_sync)按sync_sample_every抽样统计
+    """
+    # base.py导入了这个模块，MISS在用的时候再导入
+    from apps.core.cache.base import MISS
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(self, key, *args, **kwargs):
+                if lookup == "many":
+                    key = list(key)
+                if lookup == "one":
+                    args, kwargs, default = _swap_default(args, kwargs, MISS)
+                start = time.perf_counter()
+                result = await func(self, key, *args, **kwargs)
+                hits, misses = _count_hits(lookup, key, result, MISS)
+                self.metrics.record(op, key, time.perf_counter() - start,
+                                    hits, misses)
+                if lookup == "one" and result is MISS:
+                    return default
+                return result
+        else:
+            @wraps(func)
+            def wrapper(self, key, *args, **kwargs):
+                metrics = self.metrics
+                if not metrics.sample_sync():
+                    return func(self, key, *args, **kwargs)
+                if lookup == "many":
+                    key = list(key)
+                if lookup == "one":
+                    args, kwargs, default = _swap_default(args, kwargs, MISS)
+                start = time.perf_counter()
+                result = func(self, key, *args, **kwargs)
+                value = result
+                if is_future(result):
+                    # MemoryCache返回的是已完成的Future
+                    value = result.result() if result.done() else None
+                hits, misses = _count_hits(lookup, key, value, MISS)
+                metrics.record(op, key, time.perf_counter() - start,
+                               hits, misses, metrics.sync_sample_every)
+                if lookup == "one" and result is MISS:
+                    return default
+                return result
+        return wrapper
+    return decorator
@@ -1,21 +1,33 @@
 # coding=utf-8
 
 from apps.core.cache.base import CacheBase, DEFAULT_TIMEOUT
-from tornado.gen import Task, coroutine, Return
-from pickle import loads, dumps
-from tools_lib.redisclient import ReconnectClient
+from apps.core.cache.metrics import instrument
+from tornado.gen import Task
+from tools_lib.redisclient import ClientPool
 import logging
 from tools_lib.utils.encoding import str2bytes, bytes2str
-from tornadoredis.connection import ConnectionPool
+from apps.core.cache.serializers import CacheSerializer
+from apps.core.cache.redislist import (RedisListMixin, pop_command,
+                                       pop_result, tag_commands, batches)
+import time
 logger = logging.getLogger("tornado.application")
 
 
-class RedisCache(CacheBase):
+class RedisCache(RedisListMixin, CacheBase):
+    LIST_CHUNK_SIZE = 1000
 
     @classmethod
     def configurable_base(cls):
         return RedisCache
 
+    @classmethod
+    def configurable_default(cls):
+        return RedisCache
+
+    @classmethod
+    def configured_class(cls):
+        return cls
+
     def initialize(self, io_loop, defaults=None):
         super(RedisCache, self).initialize(io_loop, defaults)
         defaults = self.defaults if defaults is None else defaults
@@ -27,17 +39,24 @@ class RedisCache(CacheBase):
         logger.info("redis cache initialize:%r" % connect_kwargs)
         if "passwd" in defaults:
             connect_kwargs['password'] = defaults['passwd']
-        self.passwd = connect_kwargs.pop("password")
+        self.passwd = connect_kwargs.pop("password", None)
         self.selected_db = connect_kwargs.pop("selected_db")
+        self.connect_kwargs = connect_kwargs
+        self.serializer = CacheSerializer.from_options(defaults)
+        # lrange_iter每页、rpush每条命令的元素个数
+        self.list_chunk_size = defaults.get("list_chunk_size",
+                                            self.LIST_CHUNK_SIZE)
         # 单进程中只用一个连接池，实质用了多个连接
         # 最大连接数由实际并发决定，如果小于实际的并发，会导致一部分请求需要等待
         # 使用更多的连接数，会在高并发的时候占用redis连接，并且实质上也会造成redis压力
 
-        self.pool = ConnectionPool(
-            stop_after=10,
-            max_connections=200,
-            # wait_for_available=True,
+        # 连接借出去用完还回来，不关，AUTH和SELECT只在(重新)连接后发一次
+        self.pool = ClientPool(
             io_loop=io_loop,
+            max_clients=defaults.get("max_connections", 200),
+            stop_after=10,
+            password=self.passwd,
+            selected_db=self.selected_db,
             **connect_kwargs)
 
     def get_request_id(self, client):
@@ -62,102 +81,333 @@ class RedisCache(CacheBase):
 
         return None if timeout is None else timeout
 
+    def pool_stats(self):
+        """连接池状态:in_use,waiters,reconnects等"""
+        return self.pool.stats()
+
+    # tornadoredis只收发str(utf-8)，二进制只能经latin-1无损地转成str
+    def _dumps(self, value):
+        return bytes2str(self.serializer.dumps(value))
+
+    def _loads(self, value):
+        return self.serializer.loads(str2bytes(value))
+
+    def pipeline(self):
+        """把多条命令打包成一次写、一次读
+        >>> pipe = cache.pipeline()
+        >>> pipe.get("a")
+        >>> pipe.set("b", 1, 60)
+        >>> a, _ = await pipe.execute()
+        或者
+        >>> async with cache.pipeline() as pipe:
+        ...     pipe.get("a")
+        >>> a, = pipe.results
+        """
+        return RedisPipeline(self)
+
+    @instrument("get", lookup="one")
     async def get(self, key, default=None, version=None, callback=None):
         key = self._make_key(key, version)
-        # 从连接池里取一个新的connection
-        client = ReconnectClient(
-            io_loop=self.io_loop,
-            connection_pool=self.pool,
-            password=self.passwd,
-            selected_db=self.selected_db)
-        request_id = self.get_request_id(client)
-        logger.info("[%d]redis cache get key:%s", request_id, key)
-        result = await Task(client.get, key)
-        logger.info("[%d]redis cache get done", request_id)
-        if result:
-            return loads(str2bytes(result))
-        else:
+        async with self.pool.lease() as client:
+            result = await Task(client.get, key)
+        if result is None:
+            return default
+        return self._loads(result)
+
+    @instrument("set")
+    async def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+                  callback=None, tags=None):
+        if tags:
+            result, = await self.pipeline().set(
+                key, value, timeout, version, tags).execute()
             return result
+        key = self._make_key(key, version)
+        expired_time = self.get_backend_timeout(
+            self._value_timeout(value, timeout))
+        value = self._dumps(value)
+        async with self.pool.lease() as client:
+            result = await Task(client.setex, key, expired_time, value)
+        return result
 
-    @coroutine
-    def set(self, key, value,
-            timeout=DEFAULT_TIMEOUT, version=None, callback=None):
+    @instrument("add")
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """SET NX，key不存在时才写入，返回是否写入了"""
         key = self._make_key(key, version)
-        expired_time = self.get_backend_timeout(timeout)
-        value = dumps(value)
-        value = bytes2str(value)
-        client = ReconnectClient(
-            io_loop=self.io_loop,
-            connection_pool=self.pool,
-            password=self.passwd,
-            selected_db=self.selected_db)
-        request_id = self.get_request_id(client)
-        logger.info("[%d]redis cache set key:%s", request_id, key)
-        result = yield Task(client.setex, key, expired_time, value)
-        logger.info("[%d]redis cache set done,%s", request_id, type(result))
-        raise Return(result)
+        expired_time = self.get_backend_timeout(
+            self._value_timeout(value, timeout))
+        value = self._dumps(value)
+        async with self.pool.lease() as client:
+            result = await Task(client.set, key, value, expire=expired_time,
+                                only_if_not_exists=True)
+        return bool(result)
 
+    @instrument("delete")
     async def delete(self, key, version=None):
         key = self._make_key(key, version)
-        client = ReconnectClient(
-            io_loop=self.io_loop,
-            connection_pool=self.pool,
-            password=self.passwd,
-            selected_db=self.selected_db)
-        request_id = self.get_request_id(client)
-        logger.info("[%d]redis cache del key:%s", request_id, key)
-        result = await Task(client.delete, key)
-        logger.info("[%d]redis cache del done", request_id)
+        async with self.pool.lease() as client:
+            result = await Task(client.delete, key)
         return result
 
+    @instrument("lrange")
     async def lrange(self, key, start, stop, version=None):
         key = self._make_key(key, version)
-        client = ReconnectClient(
-            io_loop=self.io_loop,
-            connection_pool=self.pool,
-            password=self.passwd,
-            selected_db=self.selected_db)
-        request_id = self.get_request_id(client)
-        logger.info("[%d]redis cache lrange key:%s start:%s stop:%s", request_id, key, start, stop)
-        result = await Task(client.lrange, key, start, stop)
-        logger.info("[%s]redis cache lrange done", request_id)
+        async with self.pool.lease() as client:
+            result = await Task(client.lrange, key, start, stop)
         return result
 
+    @instrument("llen")
     async def llen(self, key, version=None):
         key = self._make_key(key, version)
-        client = ReconnectClient(
-            io_loop=self.io_loop,
-            connection_pool=self.pool,
-            password=self.passwd,
-            selected_db=self.selected_db)
-        request_id = self.get_request_id(client)
-        logger.info("[%d]redis cache llen key:%s", request_id, key)
-        result = await Task(client.llen, key)
-        logger.info("[%d]redis cache llen done", request_id)
+        async with self.pool.lease() as client:
+            result = await Task(client.llen, key)
         return int(result)
 
-    async def rpush(self, key, data_list, version=None):
+    @instrument("rpush")
+    async def rpush(self, key, data_list, version=None, chunk_size=None):
+        """很长的data_list拆成多条RPUSH放在一个pipeline里，返回列表长度
+        各条RPUSH之间不是原子的，别的客户端的写入可能插在中间
+        """
+        chunk_size = chunk_size or self.list_chunk_size
+        if len(data_list) <= chunk_size:
+            key = self._make_key(key, version)
+            async with self.pool.lease() as client:
+                result = await Task(client.rpush, key, *data_list)
+            return result
+        pipe = self.pipeline()
+        for i in range(0, len(data_list), chunk_size):
+            pipe.rpush(key, data_list[i:i + chunk_size], version)
+        results = await pipe.execute()
+        return results[-1]
+
+    @instrument("lpop")
+    async def lpop(self, key, count=None, version=None):
+        """count为None时返回一个元素或None，否则返回最多count个元素的list
+        (LPOP key count，需要redis 6.2)
+        """
         key = self._make_key(key, version)
-        client = ReconnectClient(
-            io_loop=self.io_loop,
-            connection_pool=self.pool,
-            password=self.passwd,
-            selected_db=self.selected_db)
-        request_id = self.get_request_id(client)
-        logger.info("[%d]redis cache rpush key:%s", request_id, key)
-        result = await Task(client.rpush, key, *data_list)
-        logger.info("[%d]redis cache rpush done", request_id)
+        async with self.pool.lease() as client:
+            result = await Task(client.execute_command,
+                                *pop_command("LPOP", key, count))
+        return pop_result(result, count)
+
+    @instrument("rpop")
+    async def rpop(self, key, count=None, version=None):
+        """同lpop，从右边弹出"""
+        key = self._make_key(key, version)
+        async with self.pool.lease() as client:
+            result = await Task(client.execute_command,
+                                *pop_command("RPOP", key, count))
+        return pop_result(result, count)
+
+    @instrument("ltrim")
+    async def ltrim(self, key, start, stop, version=None):
+        key = self._make_key(key, version)
+        async with self.pool.lease() as client:
+            result = await Task(client.ltrim, key, start, stop)
         return result
 
+    @instrument("expire")
     async def expire(self, key, expire, version=None):
         key = self._make_key(key, version)
-        client = ReconnectClient(
-            io_loop=self.io_loop,
-            connection_pool=self.pool,
-            password=self.passwd,
-            selected_db=self.selected_db)
-        request_id = self.get_request_id(client)
-        logger.info("[%d]redis key:%s set expire %s", request_id, key, expire)
-        result = await Task(client.expire, key, expire)
-        logger.info("[%d]redis cache expire one", request_id)
+        async with self.pool.lease() as client:
+            result = await Task(client.expire, key, expire)
         return result
+
+    @instrument("get_many", lookup="many")
+    async def get_many(self, keys, version=None):
+        """MGET，返回命中的{key: value}"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        new_keys = [self._make_key(key, version) for key in keys]
+        async with self.pool.lease() as client:
+            results = await Task(client.mget, new_keys)
+        return {key: self._loads(result)
+                for key, result in zip(keys, results) if result is not None}
+
+    @instrument("set_many")
+    async def set_many(self, mapping, timeout=DEFAULT_TIMEOUT, version=None,
+                       tags=None):
+        """不过期用MSET，否则在一个pipeline里逐个SETEX"""
+        if not mapping:
+            return []
+        expired_time = self.get_backend_timeout(timeout)
+        pipe = self.pipeline()
+        negative = (timeout is DEFAULT_TIMEOUT and
+                    any(value is None for value in mapping.values()))
+        if expired_time is None and not negative and not tags:
+            pipe.mset(mapping, version=version)
+        else:
+            for key, value in mapping.items():
+                pipe.set(key, value, timeout, version=version, tags=tags)
+        return await pipe.execute()
+
+    @instrument("delete_many")
+    async def delete_many(self, keys, version=None):
+        keys = [self._make_key(key, version) for key in keys]
+        if not keys:
+            return 0
+        async with self.pool.lease() as client:
+            result = await Task(client.delete, *keys)
+        return result
+
+    async def invalidate_tags(self, *tags):
+        """返回删掉的key(_make_key之后的)"""
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        if not tag_keys:
+            return []
+        now = time.time()
+        async with self.pool.lease() as client:
+            pipe = client.pipeline()
+            for tag_key in tag_keys:
+                # 已经过期的不用删
+                pipe.zrangebyscore(tag_key, now, "+inf")
+            pipe.delete(*tag_keys)
+            results = await Task(pipe.execute)
+            keys = sorted(set().union(*results[:-1]))
+            if keys:
+                # 分批DEL，一条命令删太多会卡住redis
+                pipe = client.pipeline()
+                for batch in batches(keys):
+                    pipe.delete(*batch)
+                await Task(pipe.execute)
+        return keys
+
+    async def invalidate_prefix(self, prefix, version=None):
+        """SCAN出匹配的key分批删掉，返回删掉的key(_make_key之后的)"""
+        pattern = "%s*" % self._make_key(prefix, version)
+        keys = []
+        cursor = 0
+        async with self.pool.lease() as client:
+            while True:
+                cursor, batch = await Task(client.scan, cursor,
+                                           count=1000, match=pattern)
+                if batch:
+                    await Task(client.delete, *batch)
+                    keys.extend(batch)
+                if int(cursor) == 0:
+                    break
+        return keys
+
+
+def _identity(result):
+    return result
+
+
+class RedisPipeline(object):
+    """RedisCache的pipeline
+    命令先放在tornadoredis的Pipeline里，execute时一次写出、一次读回，
+    key和序列化的处理和RedisCache一致
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._commands = []  # (method, args)，execute时才借连接
+        self._parsers = []
+        self.results = None
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _queue(self, parser, method, *args):
+        self._commands.append((method, args))
+        self._parsers.append(parser)
+        return self
+
+    def _loads(self, result):
+        if result is not None:
+            return self.cache._loads(result)
+        return result
+
+    def get(self, key, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(self._loads, "get", key)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+            tags=None):
+        key = self.cache._make_key(key, version)
+        expired_time = self.cache.get_backend_timeout(
+            self.cache._value_timeout(value, timeout))
+        value = self.cache._dumps(value)
+        if expired_time is None:
+            self._queue(_identity, "set", key, value)
+        else:
+            self._queue(_identity, "setex", key, expired_time, value)
+        for tag in tags or ():
+            # 记录tag的命令不出现在results里
+            for command in tag_commands(self.cache._tag_key(tag), key,
+                                        expired_time, self.cache.tag_timeout):
+                self._queue(None, "execute_command", *command)
+        return self
+
+    def mget(self, keys, version=None):
+        keys = [self.cache._make_key(key, version) for key in keys]
+        return self._queue(lambda results: [self._loads(r) for r in results],
+                           "mget", keys)
+
+    def mset(self, mapping, version=None):
+        mapping = {self.cache._make_key(key, version): self.cache._dumps(value)
+                   for key, value in mapping.items()}
+        return self._queue(_identity, "mset", mapping)
+
+    def delete(self, *keys, version=None):
+        keys = [self.cache._make_key(key, version) for key in keys]
+        return self._queue(_identity, "delete", *keys)
+
+    def expire(self, key, expire, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(_identity, "expire", key, expire)
+
+    def lrange(self, key, start, stop, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(_identity, "lrange", key, start, stop)
+
+    def llen(self, key, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(int, "llen", key)
+
+    def rpush(self, key, data_list, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(_identity, "rpush", key, *data_list)
+
+    def lpop(self, key, count=None, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(lambda result: pop_result(result, count),
+                           "execute_command",
+                           *pop_command("LPOP", key, count))
+
+    def rpop(self, key, count=None, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(lambda result: pop_result(result, count),
+                           "execute_command",
+                           *pop_command("RPOP", key, count))
+
+    def ltrim(self, key, start, stop, version=None):
+        key = self.cache._make_key(key, version)
+        return self._queue(_identity, "ltrim", key, start, stop)
+
+    def publish(self, channel, message):
+        return self._queue(_identity, "publish", channel, message)
+
+    async def execute(self):
+        if not self._parsers:
+            self.results = []
+            return self.results
+        commands, self._commands = self._commands, []
+        parsers, self._parsers = self._parsers, []
+        async with self.cache.pool.lease() as client:
+            pipe = client.pipeline()
+            for method, args in commands:
+                getattr(pipe, method)(*args)
+            results = await Task(pipe.execute)
+        self.results = [parser(result)
+                        for parser, result in zip(parsers, results)
+                        if parser is not None]
+        return self.results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.execute()
@@ -0,0 +1,81 @@
+# coding=utf-8
+"""
+RedisCache和AsyncRedisCache共用的列表和tag操作
+"""
+import time
+
+TAG_DELETE_BATCH = 1000  # invalidate_tags每条DEL的key个数
+
+
+def tag_commands(tag_key, key, expired_time, tag_timeout):
+    """记录key带了tag的命令
+    tag是按key的过期时间(unix时间)打分的zset，写的时候顺便删掉已经过期的，
+    不会一直变大
+    """
+    now = time.time()
+    score = "+inf" if expired_time is None else now + expired_time
+    return [("ZADD", tag_key, score, key),
+            ("ZREMRANGEBYSCORE", tag_key, "-inf", now),
+            ("EXPIRE", tag_key, tag_timeout)]
+
+
+def batches(keys, size=TAG_DELETE_BATCH):
+    for i in range(0, len(keys), size):
+        yield keys[i:i + size]
+
+
+def to_str(result):
+    return result.decode("utf-8") if isinstance(result, bytes) else result
+
+
+def to_str_list(results):
+    return [to_str(result) for result in results]
+
+
+def normalize_range(length, start, stop):
+    """把负数下标换成正的，stop=-1保持不变表示到末尾"""
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < -1:
+        stop = length + stop
+    return start, stop
+
+
+def pop_command(command, key, count):
+    if count is None:
+        return (command, key)
+    return (command, key, count)
+
+
+def pop_result(result, count):
+    # 带count时返回list，列表不存在时是nil
+    if count is None:
+        return to_str(result)
+    return to_str_list(result or [])
+
+
+class RedisListMixin(object):
+    """需要engine提供llen、lrange和list_chunk_size"""
+
+    async def lrange_iter(self, key, start=0, stop=-1, chunk_size=None,
+                          version=None):
+        """按页LRANGE，每次yield一页(list)，不用一次把整个列表读进来
+        >>> async for items in cache.lrange_iter("queue", chunk_size=500):
+        ...     handle(items)
+        遍历期间列表被改了的话，和分页查询一样可能重复或漏掉
+        """
+        chunk_size = chunk_size or self.list_chunk_size
+        if start < 0 or stop < -1:
+            start, stop = normalize_range(await self.llen(key, version),
+                                          start, stop)
+        while stop == -1 or start <= stop:
+            end = start + chunk_size - 1
+            if stop != -1:
+                end = min(end, stop)
+            items = await self.lrange(key, start, end, version)
+            if not items:
+                break
+            yield items
+            if len(items) < end - start + 1:
+                break
+            start += len(items)
@@ -0,0 +1,170 @@
+# coding=utf-8
+"""
+cache值的序列化
+每个值前面带1个字节的格式标记，换了序列化方式之后旧值依然可读:
+    b'P' pickle
+    b'M' msgpack
+    b'J' orjson
+压缩过的值在格式标记前面再加1个字节的压缩标记:
+    b'Z' zlib
+    b'L' lz4
+没有标记、以b'\\x80'开头的是以前直接pickle.dumps的值
+"""
+
+import pickle
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+
+
+class PickleSerializer(object):
+    tag = b'P'
+
+    def __init__(self, protocol=PICKLE_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return pickle.dumps(value, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackSerializer(object):
+    tag = b'M'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack is required for msgpack serializer")
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class OrjsonSerializer(object):
+    tag = b'J'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson is required for orjson serializer")
+
+    def dumps(self, value):
+        return orjson.dumps(value)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class ZlibCompressor(object):
+    tag = b'Z'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Lz4Compressor(object):
+    tag = b'L'
+
+    def __init__(self):
+        if lz4 is None:
+            raise ImportError("lz4 is required for lz4 compressor")
+
+    def compress(self, data):
+        return lz4.compress(data)
+
+    def decompress(self, data):
+        return lz4.decompress(data)
+
+
+SERIALIZERS = {
+    "pickle": PickleSerializer,
+    "msgpack": MsgpackSerializer,
+    "orjson": OrjsonSerializer,
+}
+
+COMPRESSORS = {
+    "zlib": ZlibCompressor,
+    "lz4": Lz4Compressor,
+}
+
+
+class CacheSerializer(object):
+    """按cache_options组装的序列化器
+    cache_options = {
+        "serializer": "pickle",      # pickle/msgpack/orjson
+        "compress": "zlib",          # None/zlib/lz4
+        "compress_threshold": 1024,  # 超过这么多字节才压缩
+    }
+    """
+
+    def __init__(self, serializer="pickle", compress=None,
+                 compress_threshold=1024):
+        if serializer not in SERIALIZERS:
+            raise ValueError("unknown cache serializer:%s" % serializer)
+        self.serializer = SERIALIZERS[serializer]()
+        if compress is not None and compress not in COMPRESSORS:
+            raise ValueError("unknown cache compressor:%s" % compress)
+        self.compressor = COMPRESSORS[compress]() if compress else None
+        self.compress_threshold = compress_threshold
+        # 读的时候不管当前配置，按标记找
+        self._serializers = {self.serializer.tag: self.serializer}
+        self._compressors = {}
+        if self.compressor is not None:
+            self._compressors[self.compressor.tag] = self.compressor
+
+    @classmethod
+    def from_options(cls, defaults):
+        return cls(serializer=defaults.get("serializer", "pickle"),
+                   compress=defaults.get("compress"),
+                   compress_threshold=defaults.get("compress_threshold",
+                                                   1024))
+
+    def dumps(self, value):
+        data = self.serializer.tag + self.serializer.dumps(value)
+        if (self.compressor is not None and
+                len(data) > self.compress_threshold):
+            data = self.compressor.tag + self.compressor.compress(data)
+        return data
+
+    def _get(self, registry, factories, tag):
+        try:
+            return registry[tag]
+        except KeyError:
+            for factory in factories.values():
+                if factory.tag == tag:
+                    registry[tag] = factory()
+                    return registry[tag]
+            raise ValueError("unknown cache value tag:%r" % tag)
+
+    def loads(self, data):
+        tag = data[:1]
+        if tag == b'\x80':  # 没有标记的旧值
+            return pickle.loads(data)
+        if tag in (ZlibCompressor.tag, Lz4Compressor.tag):
+            compressor = self._get(self._compressors, COMPRESSORS, tag)
+            data = compressor.decompress(memoryview(data)[1:])
+            tag = data[:1]
+        serializer = self._get(self._serializers, SERIALIZERS, tag)
+        # memoryview切片不复制
+        return serializer.loads(memoryview(data)[1:])
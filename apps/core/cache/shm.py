@@ -0,0 +1,348 @@
+# coding=utf-8
+"""
+同一台机器上多个进程共用的cache，放在mmap的文件里(默认/dev/shm下)
+options.cache_engine = "apps.core.cache.shm.SharedMemoryCache"
+options.cache_options = {
+    "path": "/dev/shm/tanglu.cache",  # 默认按key_prefix生成
+    "buckets": 1024,                  # 桶数
+    "ways": 8,                        # 每个桶的slot数
+    "slot_size": 1024,                # 每个slot的字节数，key+tag+值放不下就不存
+    "serializer": "pickle",           # 同RedisCache
+}
+文件大小是buckets*ways*slot_size，所有进程的这几项要一样，不一样时后打开的会重建文件
+1. key按blake2b哈希到桶，只在桶里的ways个slot里找，不用探测链
+2. 每个桶一把fcntl字节范围锁，读加共享锁，写加排他锁，不同桶互不影响
+3. 桶满了先覆盖已过期的，没有则覆盖最早过期的
+4. 过期时间用time.time()，进程之间可比
+5. fcntl锁是按进程的，同一进程里不互斥，所以只能在IOLoop线程里用
+"""
+
+from apps.core.cache.base import CacheBase, DEFAULT_TIMEOUT
+from apps.core.cache.metrics import instrument
+from apps.core.cache.serializers import CacheSerializer
+from tornado.concurrent import Future
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+logger = logging.getLogger("tornado.application")
+
+MAGIC = b"TGSHM001"
+# magic, buckets, ways, slot_size
+HEADER = struct.Struct("<8sIII")
+HEADER_SIZE = 64
+# state, key_len, tags_len, value_len, expire_at(0永不过期), key_hash
+SLOT = struct.Struct("<BHHIdQ")
+EMPTY, USED = 0, 1
+_NEVER = float("inf")
+
+
+def _hash_key(key):
+    # hash()每个进程的种子不一样，不能用
+    return int.from_bytes(
+        hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class SlotTable(object):
+    """mmap上的定长slot哈希表，key和值都是bytes"""
+
+    def __init__(self, path, buckets=1024, ways=8, slot_size=1024):
+        if slot_size <= SLOT.size:
+            raise ValueError("slot_size must be larger than %d" % SLOT.size)
+        self.path = path
+        self.buckets = buckets
+        self.ways = ways
+        self.slot_size = slot_size
+        self.bucket_size = ways * slot_size
+        self.size = HEADER_SIZE + buckets * self.bucket_size
+        self.evictions = 0  # 本进程覆盖掉没过期的值的次数
+        self.oversize = 0  # 本进程放不下没存的次数
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._open()
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _open(self):
+        header = HEADER.pack(MAGIC, self.buckets, self.ways, self.slot_size)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            current = os.pread(self._fd, HEADER.size, 0)
+            if (current != header or
+                    os.fstat(self._fd).st_size != self.size):
+                if current[:len(MAGIC)] == MAGIC:
+                    logger.warning("shared cache %s layout changed, rebuild",
+                                   self.path)
+                # 截成0再扩开，内容全是0，即全部slot为EMPTY
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, header, 0)
+            self._mm = mmap.mmap(self._fd, self.size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    def close(self):
+        if self._fd is not None:
+            self._mm.close()
+            os.close(self._fd)
+            self._fd = None
+
+    @contextmanager
+    def _locked(self, bucket, shared=False):
+        start = HEADER_SIZE + bucket * self.bucket_size
+        fcntl.lockf(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX,
+                    self.bucket_size, start)
+        try:
+            yield start
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.bucket_size, start)
+
+    def _slots(self, start):
+        for offset in range(start, start + self.bucket_size, self.slot_size):
+            yield offset, SLOT.unpack_from(self._mm, offset)
+
+    def _find(self, start, key, key_hash):
+        for offset, slot in self._slots(start):
+            state, key_len, _, _, _, slot_hash = slot
+            if state == USED and slot_hash == key_hash:
+                key_start = offset + SLOT.size
+                if self._mm[key_start:key_start + key_len] == key:
+                    return offset, slot
+        return None, None
+
+    def get(self, key, now):
+        """返回(值, 过期时间)，没有或者过期了返回None"""
+        key_hash = _hash_key(key)
+        with self._locked(key_hash % self.buckets, shared=True) as start:
+            offset, slot = self._find(start, key, key_hash)
+            if offset is None:
+                return None
+            _, key_len, tags_len, value_len, expire_at, _ = slot
+            if expire_at and expire_at <= now:
+                return None
+            value_start = offset + SLOT.size + key_len + tags_len
+            return (self._mm[value_start:value_start + value_len],
+                    expire_at or None)
+
+    def set(self, key, value, expire_at, now, tags=b"", only_new=False):
+        """写入，放不下返回False，only_new=True时已存在(没过期)也返回False"""
+        if SLOT.size + len(key) + len(tags) + len(value) > self.slot_size:
+            self.oversize += 1
+            self.delete(key)  # 旧值也不能留着
+            return False
+        key_hash = _hash_key(key)
+        with self._locked(key_hash % self.buckets) as start:
+            offset, slot = self._find(start, key, key_hash)
+            if offset is not None:
+                if only_new and not (slot[4] and slot[4] <= now):
+                    return False
+            else:
+                offset = self._victim(start, now)
+            header = SLOT.pack(USED, len(key), len(tags), len(value),
+                               expire_at or 0.0, key_hash)
+            self._mm[offset:offset + SLOT.size] = header
+            data_start = offset + SLOT.size
+            data = key + tags + value
+            self._mm[data_start:data_start + len(data)] = data
+        return True
+
+    def _victim(self, start, now):
+        victim, victim_expire = None, None
+        for offset, slot in self._slots(start):
+            state, expire_at = slot[0], slot[4]
+            if state == EMPTY or (expire_at and expire_at <= now):
+                return offset
+            expire_at = expire_at or _NEVER
+            if victim is None or expire_at < victim_expire:
+                victim, victim_expire = offset, expire_at
+        self.evictions += 1
+        return victim
+
+    def delete(self, key):
+        key_hash = _hash_key(key)
+        with self._locked(key_hash % self.buckets) as start:
+            offset, _ = self._find(start, key, key_hash)
+            if offset is None:
+                return False
+            self._mm[offset] = EMPTY
+        return True
+
+    def delete_where(self, predicate):
+        """逐个桶删掉predicate(key, tags)为真的，返回删掉的key"""
+        deleted = []
+        for bucket in range(self.buckets):
+            with self._locked(bucket) as start:
+                for offset, slot in self._slots(start):
+                    state, key_len, tags_len = slot[:3]
+                    if state != USED:
+                        continue
+                    key_start = offset + SLOT.size
+                    key = self._mm[key_start:key_start + key_len]
+                    tags = self._mm[key_start + key_len:
+                                    key_start + key_len + tags_len]
+                    if predicate(key, tags):
+                        self._mm[offset] = EMPTY
+                        deleted.append(key)
+        return deleted
+
+    def clear(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 0, HEADER_SIZE)
+        try:
+            self._mm[HEADER_SIZE:] = bytes(self.size - HEADER_SIZE)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 0, HEADER_SIZE)
+
+    def stats(self, now):
+        used = expired = 0
+        for bucket in range(self.buckets):
+            with self._locked(bucket, shared=True) as start:
+                for _, slot in self._slots(start):
+                    if slot[0] != USED:
+                        continue
+                    if slot[4] and slot[4] <= now:
+                        expired += 1
+                    else:
+                        used += 1
+        return {
+            "slots": self.buckets * self.ways,
+            "used": used,
+            "expired": expired,
+            "bytes": self.size,
+            "evictions": self.evictions,
+            "oversize": self.oversize,
+        }
+
+
+def _resolved(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class SharedMemoryCache(CacheBase):
+    """同一台机器上各个worker共用的cache，get/set不经过网络
+    和MemoryCache一样有*_sync方法，异步方法返回已经完成的Future
+    """
+    DEFAULT_BUCKETS = 1024
+    DEFAULT_WAYS = 8
+    DEFAULT_SLOT_SIZE = 1024
+
+    @classmethod
+    def configurable_base(cls):
+        return SharedMemoryCache
+
+    @classmethod
+    def configurable_default(cls):
+        return SharedMemoryCache
+
+    @classmethod
+    def configured_class(cls):
+        return cls
+
+    def initialize(self, io_loop, defaults=None):
+        super(SharedMemoryCache, self).initialize(io_loop, defaults)
+        path = self.defaults.get("path")
+        if path is None:
+            directory = ("/dev/shm" if os.path.isdir("/dev/shm")
+                         else tempfile.gettempdir())
+            path = os.path.join(directory, "%s.cache" % self.key_prefix)
+        self.serializer = CacheSerializer.from_options(self.defaults)
+        self.table = SlotTable(
+            path,
+            buckets=self.defaults.get("buckets", self.DEFAULT_BUCKETS),
+            ways=self.defaults.get("ways", self.DEFAULT_WAYS),
+            slot_size=self.defaults.get("slot_size", self.DEFAULT_SLOT_SIZE))
+
+    def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
+        """绝对时间，用time.time()，其他进程的IOLoop.time()不一定可比"""
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        elif timeout == 0:
+            timeout = -1
+        # 0表示永不过期，已经过期的也要是正数
+        return None if timeout is None else max(time.time() + timeout, 1e-6)
+
+    def _encode_key(self, key, version=None):
+        return self._make_key(key, version).encode("utf-8")
+
+    def get(self, key, default=None, version=None):
+        return _resolved(self.get_sync(key, default, version))
+
+    @instrument("get", lookup="one")
+    def get_sync(self, key, default=None, version=None):
+        entry = self.table.get(self._encode_key(key, version), time.time())
+        if entry is None:
+            return default
+        return self.serializer.loads(entry[0])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+            tags=None):
+        return _resolved(self.set_sync(key, value, timeout, version, tags))
+
+    @instrument("set")
+    def set_sync(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+                 tags=None):
+        """值太大放不下时返回False"""
+        return self._store(key, value, timeout, version, tags)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+            tags=None):
+        """key不存在时才写入，返回是否写入了，同一个桶的锁里判断，进程之间也是原子的"""
+        return _resolved(self.add_sync(key, value, timeout, version, tags))
+
+    @instrument("add")
+    def add_sync(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+                 tags=None):
+        return self._store(key, value, timeout, version, tags, only_new=True)
+
+    def _store(self, key, value, timeout, version, tags, only_new=False):
+        expire_at = self.get_backend_timeout(
+            self._value_timeout(value, timeout))
+        tags = "\0".join(sorted(tags)).encode("utf-8") if tags else b""
+        return self.table.set(self._encode_key(key, version),
+                              self.serializer.dumps(value), expire_at,
+                              time.time(), tags, only_new)
+
+    def delete(self, key, version=None):
+        return _resolved(self.delete_sync(key, version))
+
+    @instrument("delete")
+    def delete_sync(self, key, version=None):
+        return self.table.delete(self._encode_key(key, version))
+
+    def invalidate_tags(self, *tags):
+        """删掉set时带了这些tag的key，要扫一遍所有的桶"""
+        tags = set(tag.encode("utf-8") for tag in tags)
+
+        def match(key, key_tags):
+            return bool(key_tags) and not tags.isdisjoint(
+                key_tags.split(b"\0"))
+        keys = self.table.delete_where(match)
+        return _resolved(sorted(key.decode("utf-8") for key in keys))
+
+    def invalidate_prefix(self, prefix, version=None):
+        """删掉key以prefix开头的，要扫一遍所有的桶"""
+        new_prefix = self._encode_key(prefix, version)
+        keys = self.table.delete_where(
+            lambda key, key_tags: key.startswith(new_prefix))
+        return _resolved([key.decode("utf-8") for key in keys])
+
+    def __contains__(self, key):
+        return self.table.get(self._encode_key(key), time.time()) is not None
+
+    def clear(self):
+        """所有进程的都清掉"""
+        self.table.clear()
+
+    def slot_stats(self):
+        """slot的使用情况，evictions和oversize只是本进程的"""
+        return self.table.stats(time.time())
+
+    def close(self):
+        self.table.close()
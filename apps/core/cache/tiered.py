@@ -0,0 +1,286 @@
+# coding=utf-8
+"""
+两级cache：进程内的MemoryCache挡在RedisCache前面
+options.cache_engine = "apps.core.cache.tiered.TieredCache"
+options.cache_options = {
+    "host": "localhost",
+    ...                     # RedisCache的配置
+    "local": {              # 进程内一级cache的配置
+        "max_size": 10000,
+        "timeout": 5,       # 一级cache的过期时间，比redis的短
+    },
+}
+写和删除的时候通过redis pub/sub通知其他进程删掉一级cache里的key，
+消息丢了的话，最多脏local timeout秒
+pub/sub连接断开后清空一级cache，按退避重新订阅，不用的时候await cache.close()
+"""
+
+from apps.core.cache.base import CacheBase, DEFAULT_TIMEOUT, MISS
+from apps.core.cache.metrics import instrument
+from apps.core.cache.memory import MemoryCache
+from apps.core.cache.redis import RedisCache
+from tools_lib.redisclient import ReconnectClient
+from tornado.gen import Task, with_timeout
+from datetime import timedelta
+import logging
+import os
+logger = logging.getLogger("tornado.application")
+
+
+class TieredCache(CacheBase):
+    DEFAULT_LOCAL_TIMEOUT = 5
+    RESUBSCRIBE_DELAY = 0.5  # 秒，断开后第一次重新订阅的等待，之后翻倍
+    RESUBSCRIBE_MAX_DELAY = 30
+
+    @classmethod
+    def configurable_base(cls):
+        return TieredCache
+
+    @classmethod
+    def configurable_default(cls):
+        return TieredCache
+
+    @classmethod
+    def configured_class(cls):
+        return cls
+
+    def initialize(self, io_loop, defaults=None):
+        super(TieredCache, self).initialize(io_loop, defaults)
+        local_defaults = dict(self.defaults.get("local", {}))
+        self.local_timeout = local_defaults.pop("timeout",
+                                                self.DEFAULT_LOCAL_TIMEOUT)
+        self.local = MemoryCache(io_loop, force_instance=True,
+                                 defaults=local_defaults)
+        self.remote = RedisCache(io_loop, force_instance=True,
+                                 defaults=self.defaults)
+        self.channel = "%s:invalidate" % self.key_prefix
+        # 自己发的消息不用处理
+        self.sender_id = "%d.%d" % (os.getpid(), id(self))
+        self.local_hits = self.local_misses = 0
+        self.remote_hits = self.remote_misses = 0
+        if hasattr(self, "_subscriber"):
+            # CacheProxy会对同一个实例再initialize一次，再订阅的话前一个
+            # client没人引用，listen里的weakref就失效了
+            return
+        self._subscriber = None
+        self._retries = 0
+        self._resubscribe_handle = None
+        self._closed = False
+        io_loop.add_callback(self._subscribe)
+
+    def __getattr__(self, attr):
+        # lrange、pipeline这些没有一级cache的操作直接交给redis
+        if attr in ("remote", "local"):
+            raise AttributeError(attr)
+        return getattr(self.remote, attr)
+
+    async def _subscribe(self):
+        self._resubscribe_handle = None
+        if self._closed:
+            return
+        client = ReconnectClient(io_loop=self.io_loop,
+                                 password=self.remote.passwd,
+                                 **self.remote.connect_kwargs)
+        self._subscriber = client
+        try:
+            await Task(client.subscribe, self.channel)
+        except Exception:
+            logger.exception("tiered cache subscribe failed")
+            self._drop_subscriber()
+            self._schedule_resubscribe()
+            return
+        if self._closed:  # 订阅的时候close了
+            self._drop_subscriber()
+            return
+        if self._retries:
+            # 断开到重新订阅上之间的消息收不到了
+            self.local.clear()
+            self._retries = 0
+        client.listen(self._on_message)
+
+    def _schedule_resubscribe(self):
+        if self._closed or self._resubscribe_handle is not None:
+            return
+        delay = min(self.RESUBSCRIBE_DELAY * 2 ** self._retries,
+                    self.RESUBSCRIBE_MAX_DELAY)
+        self._retries += 1
+        self._resubscribe_handle = self.io_loop.call_later(
+            delay, lambda: self.io_loop.spawn_callback(self._subscribe))
+
+    def _drop_subscriber(self):
+        client, self._subscriber = self._subscriber, None
+        if client is not None:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+    def _on_message(self, msg):
+        if msg.kind == "message":
+            sender_id, _, key = msg.body.partition("|")
+            if sender_id != self.sender_id:
+                self.local._discard(key)
+        elif msg.kind == "disconnect":
+            if self._closed:
+                return
+            # 断开期间收不到消息，清空一级cache，重新订阅
+            logger.warning("tiered cache invalidation channel disconnected")
+            self.local.clear()
+            self._drop_subscriber()
+            self._schedule_resubscribe()
+
+    async def close(self):
+        """退订并断开pub/sub连接，不再重新订阅"""
+        self._closed = True
+        if self._resubscribe_handle is not None:
+            self.io_loop.remove_timeout(self._resubscribe_handle)
+            self._resubscribe_handle = None
+        client = self._subscriber
+        if client is not None and client.subscribed:
+            try:
+                # 退订后listen循环自己结束
+                await with_timeout(timedelta(seconds=1),
+                                   Task(client.unsubscribe, self.channel))
+            except Exception:
+                logger.warning("tiered cache unsubscribe failed")
+        self._drop_subscriber()
+
+    def _local_timeout(self, timeout):
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return self.local_timeout
+        return min(timeout, self.local_timeout)
+
+    def _invalidate(self, pipe, keys, version=None):
+        self._notify(pipe, [self._make_key(key, version) for key in keys])
+
+    def _notify(self, pipe, new_keys):
+        for new_key in new_keys:
+            pipe.publish(self.channel, "%s|%s" % (self.sender_id, new_key))
+
+    def tier_stats(self):
+        """各级的命中率"""
+        def ratio(hits, misses):
+            total = hits + misses
+            return float(hits) / total if total else 0.0
+        return {
+            "local_hits": self.local_hits,
+            "local_misses": self.local_misses,
+            "local_hit_ratio": ratio(self.local_hits, self.local_misses),
+            "remote_hits": self.remote_hits,
+            "remote_misses": self.remote_misses,
+            "remote_hit_ratio": ratio(self.remote_hits, self.remote_misses),
+        }
+
+    @instrument("get", lookup="one")
+    async def get(self, key, default=None, version=None):
+        value = self.local.get_sync(key, MISS, version)
+        if value is not MISS:
+            self.local_hits += 1
+            return value
+        self.local_misses += 1
+        value = await self.remote.get(key, MISS, version)
+        if value is MISS:
+            self.remote_misses += 1
+            return default
+        self.remote_hits += 1
+        self.local.set_sync(key, value, self.local_timeout, version)
+        return value
+
+    @instrument("set")
+    async def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None,
+                  tags=None):
+        pipe = self.remote.pipeline()
+        pipe.set(key, value, timeout, version, tags)
+        self._invalidate(pipe, [key], version)
+        result, _ = await pipe.execute()
+        self.local.set_sync(
+            key, value,
+            self._local_timeout(self._value_timeout(value, timeout)), version)
+        return result
+
+    @instrument("add")
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # 只有redis能保证跨进程的原子性，不进一级cache
+        return await self.remote.add(key, value, timeout, version)
+
+    @instrument("delete")
+    async def delete(self, key, version=None):
+        pipe = self.remote.pipeline()
+        pipe.delete(key, version=version)
+        self._invalidate(pipe, [key], version)
+        result, _ = await pipe.execute()
+        self.local.delete_sync(key, version)
+        return result
+
+    @instrument("get_many", lookup="many")
+    async def get_many(self, keys, version=None):
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.local.get_sync(key, MISS, version)
+            if value is not MISS:
+                result[key] = value
+            else:
+                missing.append(key)
+        self.local_hits += len(result)
+        self.local_misses += len(missing)
+        if missing:
+            found = await self.remote.get_many(missing, version)
+            self.remote_hits += len(found)
+            self.remote_misses += len(missing) - len(found)
+            for key, value in found.items():
+                self.local.set_sync(key, value, self.local_timeout, version)
+            result.update(found)
+        return result
+
+    @instrument("set_many")
+    async def set_many(self, mapping, timeout=DEFAULT_TIMEOUT, version=None,
+                       tags=None):
+        if not mapping:
+            return []
+        pipe = self.remote.pipeline()
+        for key, value in mapping.items():
+            pipe.set(key, value, timeout, version, tags)
+        self._invalidate(pipe, mapping, version)
+        results = await pipe.execute()
+        for key, value in mapping.items():
+            self.local.set_sync(
+                key, value,
+                self._local_timeout(self._value_timeout(value, timeout)),
+                version)
+        return results[:len(mapping)]
+
+    @instrument("delete_many")
+    async def delete_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return 0
+        pipe = self.remote.pipeline()
+        pipe.delete(*keys, version=version)
+        self._invalidate(pipe, keys, version)
+        results = await pipe.execute()
+        for key in keys:
+            self.local.delete_sync(key, version)
+        return results[0]
+
+    async def invalidate_tags(self, *tags):
+        # 一级cache里从redis读回来的key不知道tag，按redis删掉的key通知
+        keys = await self.remote.invalidate_tags(*tags)
+        await self._discard_everywhere(keys)
+        return keys
+
+    async def invalidate_prefix(self, prefix, version=None):
+        keys = await self.remote.invalidate_prefix(prefix, version)
+        await self._discard_everywhere(keys)
+        self.local.invalidate_prefix(prefix, version)
+        return keys
+
+    async def _discard_everywhere(self, new_keys):
+        if new_keys:
+            pipe = self.remote.pipeline()
+            self._notify(pipe, new_keys)
+            await pipe.execute()
+        for new_key in new_keys:
+            self.local._discard(new_key)
@@ -1,6 +1,8 @@
 import hashlib
+import os
 import random
 import time
+from tornado.ioloop import IOLoop
 from tornado.options import options
 try:
     random = random.SystemRandom()
@@ -12,15 +14,47 @@ except NotImplementedError:
     using_sysrandom = False
 
 
-def get_random_string(length=12,
-                      allowed_chars='abcdefghijklmnopqrstuvwxyz'
-                                    'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'):
+ALPHANUMERIC = ('abcdefghijklmnopqrstuvwxyz'
+                'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+_translations = {}  # allowed_chars->(table, deletechars)
+
+
+def _translation(allowed_chars):
+    """把随机字节映射成allowed_chars的bytes.translate参数
+    只留下小于len(allowed_chars)整数倍的字节，取模后没有偏差
+    """
+    translation = _translations.get(allowed_chars)
+    if translation is None:
+        chars = allowed_chars.encode("ascii")
+        limit = 256 - 256 % len(chars)
+        translation = _translations[allowed_chars] = (
+            bytes(chars[i % len(chars)] for i in range(256)),
+            bytes(range(limit, 256)))
+    return translation
+
+
+def _urandom_string(length, allowed_chars):
+    # 一次os.urandom，过滤和映射都在bytes.translate里做
+    table, deletechars = _translation(allowed_chars)
+    result = b''
+    while len(result) < length:
+        need = length - len(result)
+        # 多取一些，被过滤掉的(62个字符时是8/256)基本不用再取第二次
+        data = os.urandom(need + need // 8 + 8)
+        result += data.translate(table, deletechars)
+    return result[:length].decode("ascii")
+
+
+def get_random_string(length=12, allowed_chars=ALPHANUMERIC):
     """
     Returns a securely generated random string.
 
     The default length of 12 with the a-z, A-Z, 0-9 character set returns
     a 71-bit value. log_2((26+26+10)^12) =~ 71 bits
     """
+    if (using_sysrandom and 0 < len(allowed_chars) <= 256 and
+            allowed_chars.isascii()):
+        return _urandom_string(length, allowed_chars)
     if not using_sysrandom:
         # This is ugly, and a hack, but it makes things better than
         # the alternative of predictability. This re-seeds the PRNG
@@ -36,3 +70,57 @@ def get_random_string(length=12,
                     options.secret)).encode('utf-8')
             ).digest())
     return ''.join(random.choice(allowed_chars) for i in range(length))
+
+
+class TokenPool(object):
+    """预先生成的随机字符串，取的时候只是list.pop
+    少于low_water个时在下一轮IOLoop里一次os.urandom补满，池空了就现生成。
+    fork之后子进程不能用父进程生成的，按pid丢掉
+    >>> token = session_key_pool.get()
+    """
+
+    def __init__(self, length=32, size=1024, low_water=256,
+                 allowed_chars=ALPHANUMERIC):
+        self.length = length
+        self.size = size
+        self.low_water = low_water
+        self.allowed_chars = allowed_chars
+        self._tokens = []
+        self._pid = None
+        self._refilling = False
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def get(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._tokens = []
+            self._refilling = False
+        if self._tokens:
+            token = self._tokens.pop()
+        else:
+            token = get_random_string(self.length, self.allowed_chars)
+        if len(self._tokens) < self.low_water and not self._refilling:
+            self._refilling = True
+            IOLoop.current().add_callback(self.refill)
+        return token
+
+    def refill(self):
+        self._refilling = False
+        if self._pid != os.getpid():
+            return
+        need = self.size - len(self._tokens)
+        if need <= 0:
+            return
+        data = get_random_string(need * self.length, self.allowed_chars)
+        self._tokens.extend(data[i:i + self.length]
+                            for i in range(0, len(data), self.length))
+
+
+session_key_pool = TokenPool(32)
+
+
+def get_session_key():
+    """32位的session key，从session_key_pool里取"""
+    return session_key_pool.get()
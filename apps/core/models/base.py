@@ -8,7 +8,9 @@ from tools_lib.transwrap.model import ModelBaseClass
 from tools_lib.transwrap.db import (Session, Engine,
                                     clean_db_session, VerticalShardedQuery)
 
-from sqlalchemy.orm import object_mapper, ColumnProperty
+from sqlalchemy.orm import object_mapper, ColumnProperty, Query
+from sqlalchemy import inspect, type_coerce
+from sqlalchemy.types import TypeDecorator, Numeric
 from sqlalchemy.ext.declarative import declared_attr
 from tornado.options import options
 from pytz import UTC
@@ -16,7 +18,15 @@ from datetime import datetime
 import logging
 import enum
 from decimal import Decimal
+from functools import partial
+from itertools import islice
 from sqlalchemy.exc import IntegrityError
+from tornado.escape import json_encode, utf8
+from apps.core.cache.base import ModelCache
+
+_row_caches = {}  # model class->ModelCache
+_dump_plans = {}  # (mapper, show_time)->(keys, attrs, converters, skipped)
+_SKIP = object()  # to_dict里不输出的值
 
 
 class WithSession(object):
@@ -76,6 +86,8 @@ class ModelBase(ModelBaseClass):
     __table_initialized__ = False
     shards = None
     shard_id = "default" #通过shared_id来判断连接的是何种数据库
+    # 主键查询的进程内缓存的过期时间(秒)，0不缓存，见ModelCache
+    row_cache_timeout = 0
 
     @classmethod
     def get_bind(cls):
@@ -119,6 +131,26 @@ class ModelBase(ModelBaseClass):
         cls.ensure_bind()
         return WithSession()
 
+    @classmethod
+    def row_cache(cls):
+        """row_cache_timeout>0时返回这个model的ModelCache，否则None"""
+        if not cls.row_cache_timeout:
+            return None
+        row_cache = _row_caches.get(cls)
+        if row_cache is None:
+            row_cache = _row_caches[cls] = ModelCache(
+                cls, timeout=cls.row_cache_timeout)
+        return row_cache
+
+    def invalidate_row_cache(self, identity=None):
+        row_cache = self.row_cache()
+        if row_cache is None:
+            return
+        if identity is None:
+            identity = inspect(self).identity
+        if identity is not None:  # 还没flush的新对象没有主键
+            row_cache.invalidate(identity)
+
     def save_object(self, session=None, commit=True):
         """Save a new object"""
         if session is None:
@@ -131,6 +163,7 @@ class ModelBase(ModelBaseClass):
                 session.rollback()
                 # clean_db_session()
                 raise
+        self.invalidate_row_cache()
 
     def update(self, **kwargs):
         """
@@ -147,6 +180,7 @@ class ModelBase(ModelBaseClass):
         session.add(new_instance)
         try:
             session.commit()
+            new_instance.invalidate_row_cache()
         except:
             session.rollback()
             raise
@@ -163,16 +197,20 @@ class ModelBase(ModelBaseClass):
         except:
             session.rollback()
             raise
+        self.invalidate_row_cache()
 
     def delete(self, session=None):
         if session is None:
             session = ModelBase.get_session()
+        # 删掉之后就取不到主键了
+        identity = inspect(self).identity
         session.delete(self)
         try:
             session.commit()
         except:
             session.rollback()
             raise
+        self.invalidate_row_cache(identity)
 
     def add(self, session=None):
         if session is None:
@@ -215,8 +253,23 @@ class ModelBase(ModelBaseClass):
         except:
             session.rollback()
             raise
+        cls._invalidate_inserted(mappings)
         return ret
 
+    @classmethod
+    def _invalidate_inserted(cls, mappings):
+        """新插入的主键可能有负缓存，没给主键(自增)的只能整张表删掉"""
+        row_cache = cls.row_cache()
+        if row_cache is None:
+            return
+        pk_attrs = row_cache._pk_attrs
+        for mapping in mappings:
+            if not all(attr in mapping for attr in pk_attrs):
+                row_cache.invalidate_all()
+                return
+        for mapping in mappings:
+            row_cache.invalidate(tuple(mapping[attr] for attr in pk_attrs))
+
     def __setitem__(self, key, value):
         setattr(self, key, value)
 
@@ -360,17 +413,170 @@ class ModelBase(ModelBaseClass):
             return "%ss_tbl" % class_name
 
 
+def _convert_value(value, show_time):
+    """和to_dict一样按值判断，列类型看不出python类型时用"""
+    if isinstance(value, datetime):
+        return value.isoformat() if show_time else _SKIP
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, Decimal):
+        return float(value)
+    if not isinstance(value, (str, int, list, dict, float)):
+        return r'%s' % value
+    return value
+
+
+def _to_str(value):
+    return r'%s' % value
+
+
+def _skip(value):
+    return _SKIP
+
+
+def _column_converter(column_type, show_time):
+    """按列类型事先定好怎么转换，不用转换的返回None"""
+    if isinstance(column_type, TypeDecorator):
+        # process_result_value可能换了类型
+        return partial(_convert_value, show_time=show_time)
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return partial(_convert_value, show_time=show_time)
+    if issubclass(python_type, datetime):
+        return datetime.isoformat if show_time else _skip
+    if issubclass(python_type, enum.Enum):
+        # 查表比每个值走一次name的描述符快
+        return {member: member.name for member in python_type}.__getitem__
+    if issubclass(python_type, Decimal):
+        return float
+    if issubclass(python_type, (str, int, list, dict, float)):
+        return None
+    return _to_str
+
+
+def _dump_plan(mapper, show_time):
+    """每个mapper算一次: 列名、要查的列、要转换的列的下标、不输出的列"""
+    plan = _dump_plans.get((mapper, show_time))
+    if plan is None:
+        keys, attrs, converters, skipped = [], [], [], []
+        for index, prop in enumerate(mapper.column_attrs):
+            attr = getattr(mapper.class_, prop.key)
+            column_type = prop.columns[0].type
+            if isinstance(column_type, Numeric) and column_type.asdecimal:
+                # 反正要转成float，直接按float取，省掉中间的Decimal
+                attr = type_coerce(attr, Numeric(asdecimal=False))
+                column_type = attr.type
+            keys.append(prop.key)
+            attrs.append(attr)
+            convert = _column_converter(column_type, show_time)
+            if convert is not None:
+                converters.append((index, convert))
+            if convert is _skip or isinstance(convert, partial):
+                # 转换后可能是_SKIP，这些key要逐行看一下
+                skipped.append(prop.key)
+        plan = _dump_plans[(mapper, show_time)] = (keys, attrs, converters,
+                                                   skipped)
+    return plan
+
+
+def _entity_mapper(query):
+    """query只查一个ModelBase，没有继承时返回它的mapper，否则None"""
+    if not isinstance(query, Query):
+        return None
+    descriptions = query.column_descriptions
+    if len(descriptions) != 1:
+        return None
+    entity = descriptions[0]["expr"]
+    if not (isinstance(entity, type) and issubclass(entity, ModelBase)):
+        return None
+    mapper = inspect(entity)
+    if mapper.polymorphic_map:
+        return None
+    return mapper
+
+
+def _row_chunks(query, chunk_size):
+    """按chunk_size行一批取出tuple"""
+    if isinstance(query, VerticalShardedQuery):
+        fetchmany = query.execute_rows().fetchmany
+    else:
+        rows = iter(query)
+
+        def fetchmany(size):
+            return list(islice(rows, size))
+    while True:
+        chunk = fetchmany(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _dict_chunks(query, mapper, show_time, chunk_size):
+    """按chunk_size行一批，每批是和to_dict一样的dict的list"""
+    keys, attrs, converters, skipped = _dump_plan(mapper, show_time)
+    for rows in _row_chunks(query.with_entities(*attrs), chunk_size):
+        if converters:
+            # 按列整列转换，不用每个值都查一遍要不要转
+            columns = list(zip(*rows))
+            for index, convert in converters:
+                columns[index] = [None if value is None else convert(value)
+                                  for value in columns[index]]
+            rows = zip(*columns)
+        items = [dict(zip(keys, row)) for row in rows]
+        for key in skipped:
+            for item in items:
+                if item[key] is _SKIP:
+                    del item[key]
+        yield items
+
+
+def iter_dicts(query, show_time=False, chunk_size=1000):
+    """按列查出tuple，不建model实例也不进identity map，逐行转成和to_dict一样的dict
+    query要只查一个model，不是的时候退回to_dict
+    """
+    mapper = _entity_mapper(query)
+    if mapper is None:
+        for i in query:
+            yield dump_item(i, show_time)
+        return
+    for items in _dict_chunks(query, mapper, show_time, chunk_size):
+        yield from items
+
+
+def dump_json(query, show_time=False):
+    """dump_query的结果直接编码成JSON bytes"""
+    return utf8(json_encode(dump_query(query, show_time)))
+
+
+def dump_value(value, show_time=False):
+    """to_dict里的一个值，show_time为False时datetime返回_SKIP"""
+    if value is None:
+        return None
+    return _convert_value(value, show_time)
+
+
+def dump_item(i, show_time=False):
+    """dump_query里的一个元素，dict原样返回"""
+    if isinstance(i, ModelBase):
+        return i.to_dict(show_time=show_time)
+    elif isinstance(i, dict):
+        return i
+    elif isinstance(i, list):
+        return dump_query(i)
+    elif hasattr(i, "_asdict"):  # sqlalchemy.util._collections.result
+        # 两个model的tuple也在这里，没想好怎么处理，丢出去吧
+        return i._asdict()
+    else:
+        logging.error("type %s is not implemented" % type(i))
+        raise NotImplementedError("type %s is not implemented" % type(i))
+
+
 def dump_query(query, show_time=False):
-    result = []
-    for i in query:
-        if isinstance(i, ModelBase):
-            result.append(i.to_dict(show_time=show_time))
-        elif isinstance(i, list):
-            result.append(dump_query(i))
-        elif hasattr(i, "_asdict"):  # sqlalchemy.util._collections.result
-            # 两个model的tuple也在这里，没想好怎么处理，丢出去吧
-            result.append(i._asdict())
-        else:
-            logging.error("type %s is not implemented" % type(i))
-            raise NotImplementedError("type %s is not implemented" % type(i))
-    return result
+    mapper = _entity_mapper(query)
+    if mapper is not None:
+        result = []
+        for items in _dict_chunks(query, mapper, show_time, 1000):
+            result.extend(items)
+        return result
+    return [dump_item(i, show_time) for i in query]
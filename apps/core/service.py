@@ -1,44 +1,355 @@
 # coding=utf-8
 from __future__ import unicode_literals, absolute_import
 from apps.core.models import ModelBase
-from typing import Union, Tuple  # 类型注解
+from apps.core.models.base import dump_value
+from typing import Union, Tuple, List, Optional  # 类型注解
 from sqlalchemy.orm import Query
+from sqlalchemy import and_, or_, bindparam, func, literal_column
+from sqlalchemy.ext import baked
+from tornado.ioloop import IOLoop
+from datetime import date, datetime
+from decimal import Decimal
+import base64
+import enum
+import binascii
+import hashlib
+import json
+import logging
+import weakref
+logger = logging.getLogger("tornado.application")
+
+# list_model(count=...)的取值
+COUNT_EXACT = "exact"  # SELECT count(*)，同count=True
+COUNT_CACHED = "cached"  # 同样的SQL和参数COUNT_CACHE_TIMEOUT秒内只count一次
+COUNT_ESTIMATED = "estimated"  # mysql用EXPLAIN的rows估计，其他数据库退回cached
+COUNT_HAS_MORE = "has_more"  # 不count，多取一行判断有没有下一页
+
+_count_caches = weakref.WeakKeyDictionary()  # IOLoop->MemoryCache
 
 
 class ServiceError(Exception):
     pass
 
 
+def _cursor_value(value):
+    """和dump_item一样转换，Decimal转str，float会丢精度"""
+    if isinstance(value, Decimal):
+        return str(value)
+    return dump_value(value, show_time=True)
+
+
+def _from_cursor_value(value, column):
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    if python_type is Decimal:
+        return Decimal(value)
+    if issubclass(python_type, enum.Enum):
+        return python_type[value]
+    return value
+
+
+def encode_cursor(values):
+    """排序键的值编码成url安全的字符串"""
+    data = json.dumps([_cursor_value(value) for value in values],
+                      separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).rstrip(
+        b"=").decode("ascii")
+
+
+def decode_cursor(cursor, columns):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError, binascii.Error):
+        raise ServiceError("invalid cursor:%s" % cursor)
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ServiceError("invalid cursor:%s" % cursor)
+    try:
+        return [_from_cursor_value(value, column)
+                for value, column in zip(values, columns)]
+    except (ValueError, TypeError, KeyError, ArithmeticError):
+        raise ServiceError("invalid cursor:%s" % cursor)
+
+
+def _count_cache():
+    # 和ModelCache一样用进程内的MemoryCache，list_model是同步的
+    io_loop = IOLoop.current()
+    engine = _count_caches.get(io_loop)
+    if engine is None:
+        from apps.core.cache.memory import MemoryCache
+        engine = _count_caches[io_loop] = MemoryCache(
+            io_loop, force_instance=True, defaults={"max_size": 10000})
+    return engine
+
+
+def _params_signature(shape, params):
+    return hashlib.sha1(("%r|%r" % (shape, sorted(
+        (key, repr(value)) for key, value in params.items()))).encode(
+            "utf-8")).hexdigest()
+
+
+def _statement_signature(query):
+    """SQL和参数的摘要，filter一样的query签名一样"""
+    compiled = query.statement.compile()
+    params = sorted((key, repr(value))
+                    for key, value in compiled.params.items())
+    return hashlib.sha1(("%s|%r" % (compiled, params)).encode(
+        "utf-8")).hexdigest()
+
+
 class BaseService(object):
     model_classs = Union[ModelBase]
     REPLACE_ATTR_MAP = {
 
     }
+    COUNT_CACHE_TIMEOUT = 60
+    # True时list_model(不传query)的count和COUNT_HAS_MORE的那一页用baked query，
+    # 同样的filter key只编译一次SQL；子类改了_filter_query的不要打开
+    BAKED_QUERIES = False
+    BAKERY_SIZE = 200
 
     @classmethod
     def get_model(cls, pk) -> ModelBase:
+        row_cache = cls.model_classs.row_cache()
+        if row_cache is not None:
+            return row_cache.get(pk)
         return cls.model_classs.query().get(pk)
 
     @classmethod
-    def list_model(cls, filter_kwargs, query=None, count=True) -> Union[Query, Tuple[Query, int]]:
+    def _attr(cls, key):
+        return getattr(cls.model_classs, cls.REPLACE_ATTR_MAP.get(key, key))
+
+    @staticmethod
+    def _filter_shape(filter_kwargs):
+        """filter的key和值是否为None，决定了SQL的样子"""
+        return tuple(sorted((key, value is None)
+                            for key, value in filter_kwargs.items()))
+
+    @staticmethod
+    def _filter_params(filter_kwargs):
+        return {"f_" + key: value for key, value in filter_kwargs.items()
+                if value is not None}
+
+    @classmethod
+    def _filter_clause(cls, shape):
+        """一种shape对应的where，值都是bindparam，每个service每种shape只建一次"""
+        clauses = cls.__dict__.get("_filter_clauses")
+        if clauses is None:
+            clauses = cls._filter_clauses = {}
+        clause = clauses.get(shape)
+        if clause is None:
+            clause = clauses[shape] = and_(*[
+                cls._attr(key).is_(None) if is_none
+                else cls._attr(key) == bindparam("f_" + key)
+                for key, is_none in shape])
+        return clause
+
+    @classmethod
+    def _filter_query(cls, query, filter_kwargs):
+        shape = cls._filter_shape(filter_kwargs)
+        if not shape:
+            return query
+        return query.filter(cls._filter_clause(shape)).params(
+            **cls._filter_params(filter_kwargs))
+
+    @classmethod
+    def _bakery(cls):
+        # baked按lambda的代码缓存，不同的model不能共用一个bakery
+        bakery = cls.__dict__.get("_baked_bakery")
+        if bakery is None:
+            bakery = cls._baked_bakery = baked.bakery(size=cls.BAKERY_SIZE)
+        return bakery
+
+    @classmethod
+    def _baked_filter(cls, shape):
+        model_classs = cls.model_classs
+        bq = cls._bakery()(lambda session: session.query(
+            model_classs).set_shard(model_classs.shard_id))
+        if shape:
+            # shape是缓存key的一部分
+            bq.add_criteria(lambda q: q.filter(cls._filter_clause(shape)),
+                            shape)
+        return bq
+
+    @classmethod
+    def _list_baked(cls, filter_kwargs, size, offset, count):
+        """list_model自己执行的SQL(COUNT_HAS_MORE的这一页、count)用baked，
+        返回的query还是和不用baked时一样的Query
+        """
+        shape = cls._filter_shape(filter_kwargs)
+        params = cls._filter_params(filter_kwargs)
+        session = cls.model_classs.get_session()
+        bq = cls._baked_filter(shape)
+        if count == COUNT_HAS_MORE:
+            page = bq.with_criteria(lambda q: q.limit(
+                bindparam("_limit")).offset(bindparam("_offset")))
+            rows = page(session).params(_limit=size + 1, _offset=offset,
+                                        **params).all()
+            return rows[:size], len(rows) > size
+        query = cls._filter_query(cls.model_classs.query(), filter_kwargs)
+        result = query.limit(size).offset(offset)
+        if not count:
+            return result
+        if count == COUNT_ESTIMATED:
+            total = cls._estimate_count(query)
+            if total is not None:
+                return result, total
+            count = COUNT_CACHED
+        # 单表没有join，直接count(*)，不用包子查询
+        counter = bq.with_criteria(lambda q: q.with_entities(
+            func.count(literal_column("*"))))
+        if count == COUNT_CACHED:
+            engine = _count_cache()
+            key = "count:%s:%s" % (cls.model_classs.__tablename__,
+                                   _params_signature(shape, params))
+            total = engine.get_sync(key)
+            if total is None:
+                total, = counter(session).params(**params).one()
+                engine.set_sync(key, total, cls.COUNT_CACHE_TIMEOUT,
+                                tags=[cls.model_classs.__tablename__])
+            return result, total
+        if count not in (True, COUNT_EXACT):
+            raise ServiceError("unknown count strategy:%r" % count)
+        total, = counter(session).params(**params).one()
+        return result, total
+
+    @classmethod
+    def list_model(cls, filter_kwargs, query=None, count=True) -> Union[Query, Tuple[Query, int], Tuple[List[ModelBase], bool]]:
+        """按page、size分页
+        count按接口选:
+            True/COUNT_EXACT: 返回(query, 总数)
+            COUNT_CACHED: 同上，总数按SQL和参数缓存COUNT_CACHE_TIMEOUT秒
+            COUNT_ESTIMATED: 同上，总数是估计值
+            COUNT_HAS_MORE: 返回(这一页的list, 是否还有下一页)
+            False: 只返回query
+        """
         model_classs = cls.model_classs
         page = filter_kwargs.pop("page", 1)
         size = filter_kwargs.pop("size", 20)
         offset = (page - 1) * size
         offset = offset if offset > 0 else 0
         if query is None:
+            if cls.BAKED_QUERIES:
+                return cls._list_baked(filter_kwargs, size, offset, count)
             query = model_classs.query()
-        for key, value in list(filter_kwargs.items()):
-            if key in cls.REPLACE_ATTR_MAP:
-                query = query.filter(
-                    getattr(model_classs,
-                            cls.REPLACE_ATTR_MAP[key]) == value)
-            else:
-                query = query.filter(getattr(model_classs, key) == value)
+        query = cls._filter_query(query, filter_kwargs)
+        if count == COUNT_HAS_MORE:
+            rows = query.limit(size + 1).offset(offset).all()
+            return rows[:size], len(rows) > size
         if count:
-            total = query.count()
+            total = cls.count_query(query, count)
             query = query.limit(size).offset(offset)
             return query, total
         else:
             query = query.limit(size).offset(offset)
             return query
+
+    @classmethod
+    def count_query(cls, query, strategy=COUNT_EXACT) -> int:
+        if strategy == COUNT_ESTIMATED:
+            total = cls._estimate_count(query)
+            if total is not None:
+                return total
+            strategy = COUNT_CACHED
+        if strategy == COUNT_CACHED:
+            engine = _count_cache()
+            key = "count:%s:%s" % (cls.model_classs.__tablename__,
+                                   _statement_signature(query))
+            total = engine.get_sync(key)
+            if total is None:
+                total = cls._exact_count(query)
+                engine.set_sync(key, total, cls.COUNT_CACHE_TIMEOUT,
+                                tags=[cls.model_classs.__tablename__])
+            return total
+        if strategy not in (True, COUNT_EXACT):
+            raise ServiceError("unknown count strategy:%r" % strategy)
+        return cls._exact_count(query)
+
+    @classmethod
+    def invalidate_counts(cls):
+        """删掉这张表缓存的总数"""
+        _count_cache().invalidate_tags(cls.model_classs.__tablename__)
+
+    @staticmethod
+    def _exact_count(query):
+        # count不需要排序
+        return query.order_by(None).count()
+
+    @classmethod
+    def _estimate_count(cls, query):
+        """mysql的EXPLAIN里驱动表的rows，其他数据库返回None"""
+        model_classs = cls.model_classs
+        model_classs.ensure_bind()
+        engine = model_classs.get_bind()[model_classs.shard_id]
+        if engine.dialect.name != "mysql":
+            return None
+        try:
+            # 有的类型(比如datetime)不能literal_binds，编译失败也退回cached
+            statement = query.order_by(None).statement.compile(
+                dialect=engine.dialect,
+                compile_kwargs={"literal_binds": True})
+            row = engine.execute("EXPLAIN %s" % statement).first()
+            rows = None if row is None else row["rows"]
+        except Exception:
+            logger.exception("explain count failed")
+            return None
+        return None if rows is None else int(rows)
+
+    @classmethod
+    def _seek_keys(cls, order_by):
+        """[(属性, 是否倒序)]，最后补上主键，保证排序唯一"""
+        keys = [(cls._attr(name.lstrip("-")), name.startswith("-"))
+                for name in order_by]
+        mapper = cls.model_classs.__mapper__
+        names = set(attr.key for attr, _ in keys)
+        for column in mapper.primary_key:
+            name = mapper.get_property_by_column(column).key
+            if name not in names:
+                keys.append((getattr(cls.model_classs, name), False))
+        return keys
+
+    @classmethod
+    def seek_model(cls, filter_kwargs, order_by=("id",),
+                   query=None) -> Tuple[List[ModelBase], Optional[str]]:
+        """按游标(keyset)分页，翻到多深都只扫size+1行，大表用这个代替list_model
+        filter_kwargs里的after是上一页返回的游标，size是每页条数
+        order_by是属性名，"-"开头倒序，排序列不能有NULL
+        >>> rows, cursor = UserService.seek_model({"size": 20},
+        ...                                       order_by=("-created", "id"))
+        >>> rows, cursor = UserService.seek_model({"size": 20, "after": cursor},
+        ...                                       order_by=("-created", "id"))
+        cursor为None表示没有下一页
+        """
+        size = filter_kwargs.pop("size", 20)
+        after = filter_kwargs.pop("after", None)
+        keys = cls._seek_keys(order_by)
+        if query is None:
+            query = cls.model_classs.query()
+        query = cls._filter_query(query, filter_kwargs)
+        if after:
+            values = decode_cursor(after, [attr.property.columns[0]
+                                           for attr, _ in keys])
+            # (a, b) > (va, vb) 展开成 a > va OR (a = va AND b > vb)，方向可以不同
+            clauses = []
+            for i, (attr, desc) in enumerate(keys):
+                equals = [keys[j][0] == values[j] for j in range(i)]
+                beyond = attr < values[i] if desc else attr > values[i]
+                clauses.append(and_(*(equals + [beyond])))
+            query = query.filter(or_(*clauses))
+        query = query.order_by(*[attr.desc() if desc else attr.asc()
+                                 for attr, desc in keys])
+        rows = query.limit(size + 1).all()
+        if len(rows) <= size:
+            return rows, None
+        rows = rows[:size]
+        cursor = encode_cursor([getattr(rows[-1], attr.key)
+                                for attr, _ in keys])
+        return rows, cursor
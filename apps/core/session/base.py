@@ -2,10 +2,17 @@
 
 from tornado.options import options
 from apps.core import timezone
-from apps.core.crypto import get_random_string
+from apps.core.crypto import get_random_string, get_session_key
 from datetime import datetime, timedelta
 
 
+def _cookie_age_seconds():
+    """options.session_cookie_age由部署的配置定义，单位是天，
+    和CookieStore里set_secure_cookie的expires_days一致，这里换算成秒
+    """
+    return options.session_cookie_age * 86400
+
+
 class SessionBase(object):
     """
     Base class for all Session classes.
@@ -104,7 +111,7 @@ class SessionBase(object):
     def _get_new_session_key(self):
         "Returns session key that isn't being used."
         while True:
-            session_key = get_random_string(32)
+            session_key = get_session_key()
             if not self.exists(session_key):
                 break
         return session_key
@@ -155,7 +162,7 @@ class SessionBase(object):
             expiry = self.get('_session_expiry')
 
         if not expiry:   # Checks both None and 0 cases
-            return options.SESSION_COOKIE_AGE
+            return _cookie_age_seconds()
         if not isinstance(expiry, datetime):
             return expiry
         delta = expiry - modification
@@ -180,7 +187,7 @@ class SessionBase(object):
         if isinstance(expiry, datetime):
             return expiry
         if not expiry:   # Checks both None and 0 cases
-            expiry = options.session_cookie_age
+            expiry = _cookie_age_seconds()
         return modification + timedelta(seconds=expiry)
 
     def set_expiry(self, value):
@@ -281,3 +288,63 @@ class SessionBase(object):
         """
         raise NotImplementedError(
             'This backend does not support clear_expired().')
+
+
+class AsyncSessionBase(SessionBase):
+    """
+    存储要走网络的session，exists/create/save/delete/load/flush/cycle_key都是协程，
+    读写数据之前要先await load()，不在属性访问里阻塞IOLoop。
+    一般配合SessionHandlerMixin用，prepare里发起load，on_finish里改过才save
+    """
+
+    def _get_session(self, no_load=False):
+        self.accessed = True
+        try:
+            return self._session_cache
+        except AttributeError:
+            if self.session_key is None or no_load:
+                self._session_cache = {}
+                return self._session_cache
+            raise RuntimeError("call await session.load() before using it")
+
+    _session = property(_get_session)
+
+    def prepare_response(self):
+        """响应头发出之前调用，需要改cookie的(新建、换了key)在这里同步地改"""
+        pass
+
+    async def flush(self):
+        await self.load()
+        self.clear()
+        await self.delete()
+        self._session_key = None
+        self.modified = False
+
+    async def cycle_key(self):
+        """换一个session key，数据不变"""
+        data = await self.load()
+        key = self.session_key
+        await self.create()
+        self._session_cache = data
+        if key is not None:
+            await self.delete(key)
+
+    async def exists(self, session_key):
+        raise NotImplementedError(
+            'subclasses of AsyncSessionBase must provide an exists() method')
+
+    async def create(self):
+        raise NotImplementedError(
+            'subclasses of AsyncSessionBase must provide a create() method')
+
+    async def save(self):
+        raise NotImplementedError(
+            'subclasses of AsyncSessionBase must provide a save() method')
+
+    async def delete(self, session_key=None):
+        raise NotImplementedError(
+            'subclasses of AsyncSessionBase must provide a delete() method')
+
+    async def load(self):
+        raise NotImplementedError(
+            'subclasses of AsyncSessionBase must provide a load() method')
@@ -1,40 +1,66 @@
 # coding=utf-8
 
 from apps.core.session.base import SessionBase
-from pickle import dumps, loads
+from apps.core.session.serializers import serializer
 from tornado.options import options
 
 
 class CookieStore(object):
+    """session存在签名的cookie里
+    第一次读写时才验签、反序列化，没改过就不重新签名，也不发Set-Cookie
+    """
 
     def __init__(self, handler, _session_key):
         self.handler = handler
         self._session_key = _session_key
-        _session_str = self.handler.get_secure_cookie(
-            _session_key)
+        self._data = None
+        self.modified = False
+
+    def _get_store(self):
+        if self._data is None:
+            self._data = self._decode()
+        return self._data
+
+    _store = property(_get_store)
+
+    def _decode(self):
+        _session_str = self.handler.get_secure_cookie(self._session_key)
+        if not _session_str:
+            return {}
         try:
-            self._store = loads(_session_str)
-        except:
-            self._store = {}
+            return serializer.loads(_session_str)
+        except Exception:
+            # 签名对但格式不认识，当作空session
+            return {}
 
     def __contains__(self, key):
         return key in self._store
 
+    def __len__(self):
+        return len(self._store)
+
     def __getitem__(self, key):
         return self._store.get(key)
 
     def __setitem__(self, key, value):
         self._store[key] = value
+        self.modified = True
 
     def __delitem__(self, key):
         del self._store[key]
+        self.modified = True
 
     def get(self, key, default=None):
         return self._store.get(key, default)
 
     def pop(self, key, *args):
+        self.modified = self.modified or key in self._store
         return self._store.pop(key, *args)
 
+    def update(self, dict_):
+        self._store.update(dict_)
+        self.modified = True
+
     def has_key(self, key):
         return key in self._store
 
@@ -57,13 +83,20 @@ class CookieStore(object):
         return iter(self._store.items())
 
     def clear(self):
-        self.handler.clear_cookie(self._session_key)
-        return self._store.clear()
+        # 不用先解出旧的
+        self._data = {}
+        self.modified = True
 
     def save(self):
+        """没改过什么也不做，清空了就删掉cookie"""
+        if not self.modified:
+            return None
+        self.modified = False
+        if not self._store:
+            return self.handler.clear_cookie(self._session_key)
         return self.handler.set_secure_cookie(
             self._session_key,
-            dumps(self._store),
+            serializer.dumps(self._store),
             expires_days=options.session_cookie_age,
         )
 
@@ -71,8 +104,11 @@ class CookieStore(object):
 class CookieSessionStore(SessionBase):
 
     def load(self):
-        """返回一个store"""
+        """返回一个store，读cookie推迟到第一次访问"""
         return CookieStore(self.handler, self._session_key)
 
     def save(self):
+        if not self.modified:
+            return None
+        self.modified = False
         return self._session.save()
@@ -0,0 +1,54 @@
+# coding=utf-8
+
+from apps.core.session.redis import RedisSessionStore
+from tornado.gen import convert_yielded
+from tornado.ioloop import IOLoop
+import logging
+logger = logging.getLogger("tornado.application")
+
+
+class SessionHandlerMixin(object):
+    """RequestHandler的mixin，session_class要是AsyncSessionBase的子类
+    >>> class ProfileHandler(SessionHandlerMixin, JSONBaseHandler):
+    ...     async def get(self):
+    ...         session = await self.get_session()
+    ...         self.json_respon({"uid": session.get("uid")})
+    1. prepare里只发起load不等它，和子类prepare里其他的准备工作并发
+    2. finish之前同步地改cookie(新session、换了key)
+    3. on_finish里改过才写回，只读过的批量续期，都不耽误响应
+    """
+    session_class = RedisSessionStore
+    session = None
+
+    def prepare(self):
+        self.session = self.session_class.from_handler(self)
+        self._session_future = convert_yielded(self.session.load())
+        # 没人await的时候不要打印exception never retrieved
+        self._session_future.add_done_callback(_consume_exception)
+        return super(SessionHandlerMixin, self).prepare()
+
+    async def get_session(self):
+        await self._session_future
+        return self.session
+
+    def finish(self, chunk=None):
+        if self.session is not None:
+            self.session.prepare_response()
+        return super(SessionHandlerMixin, self).finish(chunk)
+
+    def on_finish(self):
+        session = self.session
+        if session is not None and (session.modified or session.accessed):
+            IOLoop.current().spawn_callback(_save_session, session)
+        super(SessionHandlerMixin, self).on_finish()
+
+
+def _consume_exception(future):
+    future.exception()
+
+
+async def _save_session(session):
+    try:
+        await session.save()
+    except Exception:
+        logger.exception("save session failed")
@@ -0,0 +1,168 @@
+# coding=utf-8
+"""
+存在redis里的session，cookie里只放session key
+redis的客户端是异步的，按AsyncSessionBase，load/save/exists/create/delete都是协程:
+>>> session = RedisSessionStore.from_handler(handler)
+>>> await session.load()  # 没有session key时不访问redis
+>>> session["uid"] = 1
+>>> await session.save()  # 改过才SETEX，没改过只续期
+默认用apps.core.cache.cache，options.cache_engine要是RedisCache或AsyncRedisCache，
+TieredCache的一级cache在别的进程改了session之后会读到旧的
+"""
+
+from apps.core.cache import cache
+from apps.core.crypto import get_session_key
+from apps.core.session.base import AsyncSessionBase
+from tornado.ioloop import IOLoop
+import logging
+import weakref
+logger = logging.getLogger("tornado.application")
+_refreshers = weakref.WeakKeyDictionary()  # IOLoop->ExpiryRefresher
+
+
+class ExpiryRefresher(object):
+    """没改过的session只需要续期，攒一批，每interval秒一个pipeline发EXPIRE"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._pending = {}  # engine->{key: age}
+        self._handle = None
+        self.flushes = 0
+
+    @classmethod
+    def current(cls):
+        """每个IOLoop一个"""
+        io_loop = IOLoop.current()
+        refresher = _refreshers.get(io_loop)
+        if refresher is None:
+            refresher = _refreshers[io_loop] = cls()
+        return refresher
+
+    def touch(self, engine, key, age):
+        self._pending.setdefault(engine, {})[key] = age
+        if self._handle is None:
+            self._handle = IOLoop.current().call_later(
+                self.interval, self._schedule_flush)
+
+    def _schedule_flush(self):
+        self._handle = None
+        IOLoop.current().spawn_callback(self.flush)
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for engine, ages in pending.items():
+            try:
+                pipe = engine.pipeline()
+                for key, age in ages.items():
+                    pipe.expire(key, age)
+                await pipe.execute()
+            except Exception:
+                # 续期失败最多是session早一点过期
+                logger.exception("refresh session expiry failed")
+        self.flushes += 1
+
+
+class RedisSessionStore(AsyncSessionBase):
+    cookie_name = "sessionid"
+    key_prefix = "session:"
+
+    def __init__(self, handler, session_key=None, engine=None):
+        super(RedisSessionStore, self).__init__(handler, session_key)
+        self.engine = cache if engine is None else engine
+        self._key_changed = False
+        self._must_create = False
+
+    @classmethod
+    def from_handler(cls, handler, engine=None):
+        session_key = handler.get_secure_cookie(cls.cookie_name)
+        if session_key is not None:
+            session_key = session_key.decode("utf-8")
+        return cls(handler, session_key, engine)
+
+    def _cache_key(self, session_key=None):
+        return self.key_prefix + (session_key or self._session_key)
+
+    async def load(self):
+        """读出session的dict，已经读过或者没有session key时不访问redis"""
+        try:
+            return self._session_cache
+        except AttributeError:
+            pass
+        data = None
+        if self._session_key is not None:
+            data = await self.engine.get(self._cache_key())
+        if data is None:
+            # 过期了或者是伪造的key，save的时候换一个新的
+            self._session_key = None
+            data = {}
+        self._session_cache = data
+        return data
+
+    async def exists(self, session_key):
+        return await self.engine.get(self._cache_key(session_key)) is not None
+
+    async def _get_new_session_key(self):
+        """SET NX占住一个没用过的key，不用先exists再写"""
+        while True:
+            session_key = get_session_key()
+            if await self.engine.add(self._cache_key(session_key), {},
+                                     self.get_expiry_age(expiry=None)):
+                return session_key
+
+    async def create(self):
+        self._session_key = await self._get_new_session_key()
+        self._key_changed = True
+        self.modified = True
+        if not hasattr(self, "_session_cache"):
+            self._session_cache = {}
+
+    def prepare_response(self):
+        """新session在这里先定下key写进cookie，save的时候再SET NX写进redis"""
+        if self.modified and self._session_key is None:
+            self._session_key = get_session_key()
+            self._must_create = True
+            self._key_changed = True
+        self._set_cookie()
+
+    def _set_cookie(self):
+        if self._key_changed:
+            self.handler.set_secure_cookie(self.cookie_name,
+                                           self._session_key)
+            self._key_changed = False
+
+    async def save(self):
+        """改过才整个写回(SETEX)，只读过的攒起来批量续期(EXPIRE)"""
+        if not (self.modified or self.accessed):
+            return
+        if self._session_key is None:
+            if not self.modified:
+                return
+            await self.create()
+        age = self.get_expiry_age()
+        if self._must_create:
+            self._must_create = False
+            self.modified = False
+            if not await self.engine.add(self._cache_key(), self._session,
+                                         age):
+                # 32位的key撞上了，cookie已经发出去，只能放弃这次的数据
+                logger.error("session key collision, data dropped")
+        elif self.modified:
+            await self.engine.set(self._cache_key(), self._session, age)
+            self.modified = False
+        else:
+            ExpiryRefresher.current().touch(self.engine, self._cache_key(),
+                                            age)
+        self._set_cookie()
+
+    async def delete(self, session_key=None):
+        if session_key is None:
+            if self._session_key is None:
+                return
+            session_key = self._session_key
+            self.handler.clear_cookie(self.cookie_name)
+        await self.engine.delete(self._cache_key(session_key))
+
+    @classmethod
+    def clear_expired(cls):
+        """redis自己会过期"""
+        pass
@@ -0,0 +1,89 @@
+# coding=utf-8
+"""
+CookieSessionStore的序列化，比pickle紧凑
+    b'M' msgpack(装了msgpack时)
+    b'J' json
+超过compress_threshold字节的在前面再加b'Z'，zlib压缩
+以b'\\x80'开头的是以前直接pickle.dumps的值，只读不写
+datetime(比如_session_expiry)按isoformat存，读回来还是datetime
+"""
+
+from datetime import datetime
+import json
+import pickle
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_DATETIME_EXT = 1
+_DATETIME_KEY = "__datetime__"
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(_DATETIME_EXT, obj.isoformat().encode("ascii"))
+    raise TypeError("can not serialize %r" % obj)
+
+
+def _msgpack_ext_hook(code, data):
+    if code == _DATETIME_EXT:
+        return datetime.fromisoformat(bytes(data).decode("ascii"))
+    return msgpack.ExtType(code, data)
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return {_DATETIME_KEY: obj.isoformat()}
+    raise TypeError("can not serialize %r" % obj)
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and _DATETIME_KEY in obj:
+        return datetime.fromisoformat(obj[_DATETIME_KEY])
+    return obj
+
+
+class SessionSerializer(object):
+    """
+    >>> serializer = SessionSerializer()
+    >>> serializer.loads(serializer.dumps({"uid": 1}))
+    {'uid': 1}
+    """
+
+    def __init__(self, compress_threshold=256):
+        self.compress_threshold = compress_threshold
+
+    def dumps(self, session_dict):
+        if msgpack is not None:
+            data = b'M' + msgpack.packb(session_dict, use_bin_type=True,
+                                        default=_msgpack_default)
+        else:
+            data = b'J' + json.dumps(session_dict, default=_json_default,
+                                     separators=(",", ":")).encode("utf-8")
+        if len(data) > self.compress_threshold:
+            compressed = b'Z' + zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+        return data
+
+    def loads(self, data):
+        tag = data[:1]
+        if tag == b'\x80':  # 以前pickle的
+            return pickle.loads(data)
+        if tag == b'Z':
+            data = zlib.decompress(memoryview(data)[1:])
+            tag = data[:1]
+        # memoryview切片不复制
+        if tag == b'M':
+            if msgpack is None:
+                raise ValueError("msgpack is required to load this session")
+            return msgpack.unpackb(memoryview(data)[1:], raw=False,
+                                   ext_hook=_msgpack_ext_hook)
+        if tag == b'J':
+            return json.loads(data[1:], object_hook=_json_object_hook)
+        raise ValueError("unknown session tag:%r" % tag)
+
+
+serializer = SessionSerializer()
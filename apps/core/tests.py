@@ -2,13 +2,37 @@
 
 from tornado.testing import AsyncTestCase
 from apps.core.models import (ModelBase,)
+from sqlalchemy.orm import Query
+from apps.core.models.base import dump_query, dump_json, iter_dicts
+from apps.core.service import (BaseService, ServiceError, COUNT_CACHED,
+                               COUNT_ESTIMATED, COUNT_HAS_MORE,
+                               encode_cursor, decode_cursor)
+from sqlalchemy import Column, Integer, String, DateTime, Numeric, Enum
 from tools_lib.transwrap.db import Session
 from tornado.options import options
 from apps.core.datastruct import QueryDict, lru_cache
 from tornado.testing import AsyncHTTPTestCase, gen_test
-from apps.core.crypto import get_random_string
-from apps.core.cache.base import CacheBase, cache as cache_proxy
-from tornado.gen import sleep
+from apps.core.crypto import get_random_string, TokenPool
+from apps.core.cache.base import (CacheBase, cache as cache_proxy, cached,
+                                  MISS, CacheProxy)
+from apps.core.cache.memory import LRUCache, SLRUCache, MemoryCache
+from apps.core.cache.redis import RedisCache
+from apps.core.cache.tiered import TieredCache
+from apps.core.cache.serializers import CacheSerializer
+from apps.core.session.cookie import CookieSessionStore
+from apps.core.session.redis import RedisSessionStore, ExpiryRefresher
+from apps.core.session.handler import SessionHandlerMixin
+from tornado.web import Application, RequestHandler
+from apps.core.views import JSONBaseHandler
+from apps.core.session.serializers import serializer as session_serializer
+import pickle
+import json
+import enum
+from datetime import datetime
+from decimal import Decimal
+import os
+import tempfile
+from tornado.gen import sleep, Task
 from mock import patch
 from apps.core.timezone import now
 from concurrent.futures import ThreadPoolExecutor
@@ -159,6 +183,117 @@ class TestCrypto(EngineTest):
         self.assertEqual(len(get_random_string(12)), 12)
         self.assertEqual(len(get_random_string(20)), 20)
         self.assertNotEqual(get_random_string(12), get_random_string(12))
+        self.assertTrue(set(get_random_string(100, "ab")) <= {"a", "b"})
+
+    def test_token_pool(self):
+        pool = TokenPool(length=8, size=10, low_water=5)
+        token = pool.get()  # 池空了现生成，并安排补满
+        self.assertEqual(len(token), 8)
+        pool.refill()
+        self.assertEqual(len(pool), 10)
+        tokens = set(pool.get() for _ in range(10))
+        self.assertEqual(len(tokens), 10)
+        self.assertEqual(len(pool), 0)
+
+
+class FakeCookieHandler(object):
+    """只记录secure cookie的读写"""
+
+    def __init__(self, cookies=None):
+        self.cookies = dict(cookies or {})
+        self.reads = 0
+        self.writes = 0
+
+    def get_secure_cookie(self, name):
+        self.reads += 1
+        return self.cookies.get(name)
+
+    def set_secure_cookie(self, name, value, **kwargs):
+        self.writes += 1
+        self.cookies[name] = value
+
+    def clear_cookie(self, name):
+        self.writes += 1
+        self.cookies.pop(name, None)
+
+
+class SessionTestCase(EngineTest):
+
+    def test_serializer(self):
+        expiry = now()
+        data = {"uid": 1, "_session_expiry": expiry, "name": "x" * 1000}
+        dumped = session_serializer.dumps(data)
+        self.assertEqual(dumped[:1], b"Z")  # 超过阈值压缩了
+        self.assertEqual(session_serializer.loads(dumped), data)
+        self.assertEqual(session_serializer.loads(pickle.dumps({"a": 1})),
+                         {"a": 1})
+
+    def test_cookie_lazy(self):
+        handler = FakeCookieHandler(
+            {"session": session_serializer.dumps({"uid": 1})})
+        session = CookieSessionStore(handler, "session")
+        session.save()
+        self.assertEqual((handler.reads, handler.writes), (0, 0))
+        self.assertEqual(session["uid"], 1)
+        session.save()  # 只读过，不重新签名
+        self.assertEqual((handler.reads, handler.writes), (1, 0))
+        session["uid"] = 2
+        session.save()
+        self.assertEqual(handler.writes, 1)
+        self.assertEqual(
+            session_serializer.loads(handler.cookies["session"]), {"uid": 2})
+        session.clear()
+        session.save()
+        self.assertNotIn("session", handler.cookies)
+
+
+class MemorySessionStore(RedisSessionStore):
+
+    @classmethod
+    def from_handler(cls, handler, engine=None):
+        return super(MemorySessionStore, cls).from_handler(
+            handler, handler.settings["session_engine"])
+
+
+class SessionSetHandler(SessionHandlerMixin, RequestHandler):
+    session_class = MemorySessionStore
+
+    async def get(self):
+        session = await self.get_session()
+        session["uid"] = int(self.get_argument("uid"))
+        self.write("ok")
+
+
+class SessionGetHandler(SessionHandlerMixin, RequestHandler):
+    session_class = MemorySessionStore
+
+    async def get(self):
+        session = await self.get_session()
+        self.write({"uid": session.get("uid")})
+
+
+class SessionHandlerTestCase(BaseTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        # 前面的用例configure过redis也要建出MemoryCache
+        CacheBase.configure("apps.core.cache.redis.RedisCache")
+        self.session_engine = MemoryCache(self.io_loop, force_instance=True)
+        self.assertIsInstance(self.session_engine, MemoryCache)
+        return Application([("/set", SessionSetHandler),
+                            ("/get", SessionGetHandler)],
+                           cookie_secret="secret",
+                           session_engine=self.session_engine)
+
+    def test_session(self):
+        response = self.fetch("/set?uid=3")
+        cookie = self._parse_cookie(response.headers["Set-Cookie"])
+        self.assertTrue(cookie.startswith(RedisSessionStore.cookie_name))
+        response = self.fetch("/get", headers={"Cookie": cookie})
+        self.assertEqual(json.loads(response.body), {"uid": 3})
+        # 只读过的不用再发cookie
+        self.assertNotIn("Set-Cookie", response.headers)
+        response = self.fetch("/get")
+        self.assertEqual(json.loads(response.body), {"uid": None})
 
 
 class TestTimeUtils(EngineTest):
@@ -196,6 +331,97 @@ class MemoryCacheTestCase(EngineTest):
         value = yield cache.get("somekey")
         self.assertEqual(value, 1)
 
+    def test_resolved(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop)
+        cache = CacheBase(self.io_loop)
+        future = cache.set("somekey", 1)
+        self.assertTrue(future.done())
+        future = cache.get("somekey")
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 1)
+        self.assertTrue(cache.delete("somekey").done())
+        self.assertEqual(cache.get_sync("somekey"), None)
+
+    @gen_test
+    def test_stats(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop,
+            defaults={"sync_sample_every": 1})
+        cache = CacheBase(self.io_loop)
+        cache.metrics.reset()
+        yield cache.set("user:1", 1)
+        yield cache.get("user:1")
+        yield cache.get("user:2")
+        yield cache.get("order:1")
+        stats = cache.stats()
+        self.assertEqual(stats["set"]["user"]["count"], 1)
+        self.assertEqual(stats["get"]["user"]["hits"], 1)
+        self.assertEqual(stats["get"]["user"]["misses"], 1)
+        self.assertEqual(stats["get"]["user"]["hit_ratio"], 0.5)
+        self.assertEqual(stats["get"]["order"]["misses"], 1)
+        # 缓存住的None也是命中，调用方的default照样返回
+        cache.metrics.reset()
+        yield cache.set("user:3", None)
+        value = yield cache.get("user:3")
+        self.assertIsNone(value)
+        value = yield cache.get("user:4", "x")
+        self.assertEqual(value, "x")
+        self.assertEqual(cache.get_sync("user:3", default="x"), None)
+        stats = cache.stats()
+        self.assertEqual(stats["get"]["user"]["hits"], 2)
+        self.assertEqual(stats["get"]["user"]["misses"], 1)
+
+    def test_stats_sampled(self):
+        # 同步操作抽样统计，抽中的一次按sync_sample_every次记
+        cache = MemoryCache(self.io_loop, force_instance=True,
+                            defaults={"sync_sample_every": 4})
+        with patch("apps.core.cache.metrics.random.random",
+                   side_effect=[0.1, 0.9, 0.9, 0.9]):
+            for _ in range(4):
+                cache.get_sync("user:1")
+        stats = cache.stats()["get"]["user"]
+        self.assertEqual(stats["count"], 4)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(sum(stats["histogram_ms"].values()), 4)
+
+    @gen_test
+    def test_negative(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop,
+            defaults={"negative_timeout": 1})
+        cache = CacheBase(self.io_loop)
+        value = yield cache.get("missing", MISS)
+        self.assertIs(value, MISS)
+        value = yield cache.get("missing", "default")
+        self.assertEqual(value, "default")
+        yield cache.set("missing", None)
+        value = yield cache.get("missing", MISS)
+        self.assertIsNone(value)
+        # None用的是较短的negative_timeout
+        yield sleep(1.1)
+        value = yield cache.get("missing", MISS)
+        self.assertIs(value, MISS)
+
+    @gen_test
+    def test_invalidate(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop)
+        cache = CacheBase(self.io_loop)
+        yield cache.set("user:1", 1, tags=["user"])
+        yield cache.set("user:2", 2, tags=["user", "shard:1"])
+        yield cache.set("order:1", 3, tags=["shard:1"])
+        keys = yield cache.invalidate_tags("user")
+        self.assertEqual(len(keys), 2)
+        value = yield cache.get("user:2")
+        self.assertIsNone(value)
+        value = yield cache.get("order:1")
+        self.assertEqual(value, 3)
+        keys = yield cache.invalidate_prefix("order:")
+        self.assertEqual(len(keys), 1)
+        self.assertNotIn("order:1", cache)
+        self.assertEqual(cache._key_tags, {})
+
     @gen_test
     def test_size_set(self):
         CacheBase.configure(
@@ -229,6 +455,24 @@ class MemoryCacheTestCase(EngineTest):
         value = yield cache.get("somekey2")
         self.assertEqual(value, None)
 
+    @gen_test
+    def test_size_bytes(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop,
+            defaults={"max_bytes": 4096})
+        cache = CacheBase()
+        yield cache.set("small", "x")
+        yield cache.set("big", "x" * 8192, tags=["blob"])  # 超过max_bytes不存
+        self.assertNotIn("big", cache)
+        self.assertEqual(cache._tags, {})
+        for i in range(20):
+            yield cache.set("blob%d" % i, "x" * 512)
+        stats = cache.size_stats()
+        self.assertLessEqual(stats["bytes"], 4096)
+        self.assertEqual(stats["max_bytes"], 4096)
+        self.assertGreater(stats["evictions"], 0)
+        self.assertEqual(stats["entries"], len(cache._cache))
+
     @gen_test
     def test_timeout(self):
         CacheBase.configure(
@@ -242,6 +486,23 @@ class MemoryCacheTestCase(EngineTest):
         self.assertNotIn("somekey", cache._cache)
         self.assertNotIn("somekey", cache)
 
+    @gen_test
+    def test_expire_sweep(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop,
+            defaults={"max_size": 100, "expire_resolution": 0.1})
+        cache = CacheBase()
+        for i in range(10):
+            yield cache.set("somekey%d" % i, i, 0.2)
+        yield cache.set("somekey0", 0, 10)  # 覆盖写，不应被回收
+        yield sleep(0.5)
+        self.assertEqual(len(cache._cache), 1)
+        stats = cache.expire_stats()
+        self.assertEqual(stats["reclaimed"], 9)
+        self.assertEqual(stats["pending"], 1)
+        # 只挂了一个定时器
+        self.assertIsNotNone(cache._sweep_handle)
+
     @gen_test
     def test_proxy(self):
         o = patch.object(options.mockable(),
@@ -261,6 +522,575 @@ class MemoryCacheTestCase(EngineTest):
         self.assertNotIn("somekey", cache_proxy)
 
 
+class CachedTestCase(MemoryCacheTestCase):
+
+    @gen_test
+    def test_single_flight(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop)
+        engine = CacheBase(self.io_loop)
+        calls = []
+
+        @cached(timeout=60, cache_engine=engine)
+        async def load(i):
+            calls.append(i)
+            await sleep(0.1)
+            return i * 2
+
+        results = yield [load(2) for _ in range(10)]
+        self.assertEqual(results, [4] * 10)
+        self.assertEqual(calls, [2])
+        value = yield load(2)
+        self.assertEqual(value, 4)
+        self.assertEqual(calls, [2])
+
+    @gen_test
+    def test_cache_none(self):
+        CacheBase.configure(
+            "apps.core.cache.memory.MemoryCache", io_loop=self.io_loop)
+        engine = CacheBase(self.io_loop)
+        calls = []
+
+        @cached(timeout=60, cache_engine=engine, lock=True)
+        async def load(i):
+            calls.append(i)
+            return None
+
+        yield [load(1) for _ in range(3)]
+        value = yield load(1)
+        self.assertEqual(value, None)
+        self.assertEqual(calls, [1])
+
+
+class RowCacheModel(ModelBase):
+    row_cache_timeout = 60
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+
+
+class RowCacheService(BaseService):
+    model_classs = RowCacheModel
+
+
+class ModelCacheTestCase(EngineTest):
+
+    def test_get(self):
+        RowCacheModel(id=1, name="a").save_object()
+        row_cache = RowCacheModel.row_cache()
+        self.assertEqual(RowCacheService.get_model(1).name, "a")
+        self.assertIn("rowcachemodels_tbl:1", row_cache._engine())
+        self.assertEqual(RowCacheService.get_model(1).name, "a")
+
+        obj = RowCacheService.get_model(1)
+        obj.name = "b"
+        obj.save_updates()
+        self.assertNotIn("rowcachemodels_tbl:1", row_cache._engine())
+        self.assertEqual(RowCacheService.get_model(1).name, "b")
+
+        RowCacheService.get_model(1).delete()
+        self.assertIsNone(RowCacheService.get_model(1))
+
+    def test_negative(self):
+        row_cache = RowCacheModel.row_cache()
+        self.assertIsNone(row_cache.get(2))
+        self.assertIn("rowcachemodels_tbl:2", row_cache._engine())
+        RowCacheModel.bulk_insert([{"id": 2, "name": "b"}])
+        self.assertEqual(row_cache.get(2).name, "b")
+
+    def test_get_many(self):
+        RowCacheModel.bulk_insert([{"id": 3, "name": "c"},
+                                   {"id": 4, "name": "d"}])
+        row_cache = RowCacheModel.row_cache()
+        row_cache.get(3)
+        result = row_cache.get_many([3, 4, 5])
+        self.assertEqual(sorted(result), [3, 4])
+        self.assertEqual(result[4].name, "d")
+        self.assertIn("rowcachemodels_tbl:5", row_cache._engine())
+
+    def test_pending_changes(self):
+        # session里已经有的对象不能被缓存里的旧值盖掉
+        RowCacheModel(id=7, name="g").save_object()
+        RowCacheService.get_model(7)
+        Session.remove()
+        obj = RowCacheService.get_model(7)  # 从缓存merge回session
+        obj.name = "h"
+        again = RowCacheService.get_model(7)
+        self.assertIs(again, obj)
+        self.assertEqual(again.name, "h")
+        again.save_updates()
+        Session.remove()
+        self.assertEqual(RowCacheModel.query().get(7).name, "h")
+
+    def test_redis_configured(self):
+        # 线上cache_engine是redis时，行缓存还是用进程内的MemoryCache
+        CacheBase.configure("apps.core.cache.redis.RedisCache")
+        RowCacheModel(id=6, name="f").save_object()
+        self.assertEqual(RowCacheService.get_model(6).name, "f")
+        row_cache = RowCacheModel.row_cache()
+        self.assertIsInstance(row_cache._engine(), MemoryCache)
+        self.assertIn("rowcachemodels_tbl:6", row_cache._engine())
+
+
+class SharedMemoryCacheTestCase(EngineTest):
+
+    def setUp(self):
+        super(SharedMemoryCacheTestCase, self).setUp()
+        fd, self.path = tempfile.mkstemp(suffix=".cache")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(SharedMemoryCacheTestCase, self).tearDown()
+
+    def _cache(self, **defaults):
+        defaults.setdefault("path", self.path)
+        defaults.setdefault("buckets", 4)
+        defaults.setdefault("ways", 2)
+        defaults.setdefault("slot_size", 256)
+        CacheBase.configure("apps.core.cache.shm.SharedMemoryCache",
+                            io_loop=self.io_loop)
+        return CacheBase(self.io_loop, force_instance=True,
+                         defaults=defaults)
+
+    @gen_test
+    def test_shared(self):
+        cache = self._cache()
+        other = self._cache()  # 相当于另一个进程打开同一个文件
+        yield cache.set("somekey", {"a": 1})
+        value = yield other.get("somekey")
+        self.assertEqual(value, {"a": 1})
+        added = yield other.add("somekey", 2)
+        self.assertFalse(added)
+        yield other.delete("somekey")
+        self.assertNotIn("somekey", cache)
+        value = yield cache.get("somekey", MISS)
+        self.assertIs(value, MISS)
+        cache.close()
+        other.close()
+
+    @gen_test
+    def test_timeout_oversize(self):
+        cache = self._cache()
+        yield cache.set("somekey", 1, 0.1)
+        stored = yield cache.set("big", "x" * 1024)
+        self.assertFalse(stored)
+        yield sleep(0.2)
+        self.assertNotIn("somekey", cache)
+        stats = cache.slot_stats()
+        self.assertEqual(stats["slots"], 8)
+        self.assertEqual(stats["expired"], 1)
+        self.assertEqual(stats["oversize"], 1)
+        cache.close()
+
+    @gen_test
+    def test_invalidate(self):
+        cache = self._cache()
+        yield cache.set("user:1", 1, tags=["user"])
+        yield cache.set("order:1", 2, tags=["shard:1"])
+        keys = yield cache.invalidate_tags("user")
+        self.assertEqual(len(keys), 1)
+        self.assertIn("order:1", cache)
+        keys = yield cache.invalidate_prefix("order:")
+        self.assertEqual(len(keys), 1)
+        self.assertNotIn("order:1", cache)
+        cache.close()
+
+
+class ListModel(ModelBase):
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    score = Column(Integer)
+
+
+class ListService(BaseService):
+    model_classs = ListModel
+    REPLACE_ATTR_MAP = {"title": "name"}
+
+
+class BakedListService(ListService):
+    BAKED_QUERIES = True
+
+
+class ListModelTestCase(EngineTest):
+
+    def setUp(self):
+        super(ListModelTestCase, self).setUp()
+        ListModel.bulk_insert([{"id": i, "name": "n%d" % (i % 2),
+                                "score": i % 3} for i in range(1, 11)])
+
+    def test_list(self):
+        query, total = ListService.list_model({"title": "n1", "size": 2,
+                                               "page": 2})
+        self.assertEqual(total, 5)
+        self.assertEqual(len(query.all()), 2)
+
+    def test_count(self):
+        _, total = ListService.list_model({"title": "n1"}, count=COUNT_CACHED)
+        self.assertEqual(total, 5)
+        ListModel.bulk_insert([{"id": 11, "name": "n1", "score": 0}])
+        _, total = ListService.list_model({"title": "n1"}, count=COUNT_CACHED)
+        self.assertEqual(total, 5)  # 还是缓存的
+        _, total = ListService.list_model({"title": "n0"}, count=COUNT_CACHED)
+        self.assertEqual(total, 5)
+        ListService.invalidate_counts()
+        # sqlite没有估计值，退回cached
+        _, total = ListService.list_model({"title": "n1"},
+                                          count=COUNT_ESTIMATED)
+        self.assertEqual(total, 6)
+        rows, has_more = ListService.list_model(
+            {"size": 4, "page": 2}, count=COUNT_HAS_MORE)
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(has_more)
+        rows, has_more = ListService.list_model(
+            {"size": 4, "page": 3}, count=COUNT_HAS_MORE)
+        self.assertEqual(len(rows), 3)
+        self.assertFalse(has_more)
+
+    def test_count_redis_configured(self):
+        # cache_engine是redis时，count的缓存还是进程内的MemoryCache
+        CacheBase.configure("apps.core.cache.redis.RedisCache")
+        _, total = ListService.list_model({"title": "n1"}, count=COUNT_CACHED)
+        self.assertEqual(total, 5)
+        _, total = ListService.list_model({"title": "n0"},
+                                          count=COUNT_ESTIMATED)
+        self.assertEqual(total, 5)
+
+    def test_baked(self):
+        for _ in range(2):  # 第二次用缓存的SQL
+            result, total = BakedListService.list_model(
+                {"title": "n1", "score": 1, "size": 1, "page": 2})
+            self.assertEqual(total, 2)
+            self.assertEqual([row.id for row in result], [7])
+            self.assertIsInstance(result, Query)
+        # 返回的和不用baked时一样是Query
+        for service in (ListService, BakedListService):
+            query = service.list_model({"title": "n1", "size": 2},
+                                       count=False)
+            self.assertIsInstance(query, Query)
+            self.assertEqual(query.count(), 2)
+        _, total = BakedListService.list_model({"title": "n1"},
+                                               count=COUNT_CACHED)
+        self.assertEqual(total, 5)
+        rows, has_more = BakedListService.list_model(
+            {"size": 4, "page": 3}, count=COUNT_HAS_MORE)
+        self.assertEqual(len(rows), 2)
+        self.assertFalse(has_more)
+        ListModel.bulk_insert([{"id": 11, "name": None, "score": 0}])
+        for service in (ListService, BakedListService):
+            _, total = service.list_model({"title": None})
+            self.assertEqual(total, 1)
+
+    def test_seek(self):
+        seen = []
+        cursor = None
+        while True:
+            rows, cursor = ListService.seek_model(
+                {"size": 3, "after": cursor}, order_by=("-score", "id"))
+            seen.extend((row.score, row.id) for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(seen, sorted(((i % 3, i) for i in range(1, 11)),
+                                      key=lambda x: (-x[0], x[1])))
+        rows, cursor = ListService.seek_model({"size": 10, "title": "n0"})
+        self.assertEqual([row.id for row in rows], [2, 4, 6, 8, 10])
+        self.assertIsNone(cursor)
+        with self.assertRaises(ServiceError):
+            ListService.seek_model({"after": "not-a-cursor"})
+
+
+class DumpLevel(enum.Enum):
+    low = 1
+    high = 2
+
+
+class DumpModel(ModelBase):
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    price = Column(Numeric(10, 2))
+    level = Column(Enum(DumpLevel))
+    created_at = Column(DateTime)
+
+
+class DumpService(BaseService):
+    model_classs = DumpModel
+
+
+class DumpQueryTestCase(EngineTest):
+
+    def setUp(self):
+        super(DumpQueryTestCase, self).setUp()
+        DumpModel.bulk_insert([
+            {"id": 1, "name": "a", "price": Decimal("1.50"),
+             "level": DumpLevel.low, "created_at": datetime(2020, 1, 1)},
+            {"id": 2, "name": None, "price": None, "level": None,
+             "created_at": None},
+        ])
+
+    def test_same_as_to_dict(self):
+        for show_time in (False, True):
+            expected = [i.to_dict(show_time=show_time) for i in
+                        DumpModel.query().order_by(DumpModel.id)]
+            self.assertEqual(dump_query(DumpModel.query().order_by(
+                DumpModel.id), show_time), expected)
+        self.assertEqual(dump_query(DumpModel.query().order_by(DumpModel.id)),
+                         [{"id": 1, "name": "a", "price": 1.5, "level": "low"},
+                          {"id": 2, "name": None, "price": None,
+                           "level": None, "created_at": None}])
+        self.assertEqual(json.loads(dump_json(DumpModel.query().filter(
+            DumpModel.id == 1), show_time=True).decode("utf-8"))[0][
+                "created_at"], "2020-01-01T00:00:00")
+
+    def test_chunks(self):
+        # 跨批次的结果一样，session里还没flush的也查得到
+        DumpModel.get_session().add(DumpModel(id=3, name="c"))
+        query = DumpModel.query().order_by(DumpModel.id)
+        rows = list(iter_dicts(query, chunk_size=2))
+        self.assertEqual([row["id"] for row in rows], [1, 2, 3])
+        self.assertEqual(rows, dump_query(query))
+
+    def test_estimated_count_datetime(self):
+        # EXPLAIN编译不了或者执行失败时退回cached
+        engine = ModelBase.get_bind()[DumpModel.shard_id]
+        with patch.object(engine.dialect, "name", "mysql"):
+            _, total = DumpService.list_model(
+                {"created_at": datetime(2020, 1, 1)}, count=COUNT_ESTIMATED)
+        self.assertEqual(total, 1)
+
+    def test_seek_cursor(self):
+        # Enum、datetime的排序键编码进游标再原样解码回来
+        columns = [DumpModel.level.property.columns[0],
+                   DumpModel.created_at.property.columns[0]]
+        values = [DumpLevel.high, datetime(2020, 1, 2, 3, 4, 5)]
+        self.assertEqual(decode_cursor(encode_cursor(values), columns), values)
+        with self.assertRaises(ServiceError):
+            decode_cursor(encode_cursor(["middle", None]), columns)
+        DumpModel.bulk_insert([
+            {"id": i, "name": "s", "created_at": datetime(2020, 1, i),
+             "level": DumpLevel.high if i % 2 else DumpLevel.low}
+            for i in range(3, 9)])
+        seen = []
+        cursor = None
+        while True:
+            rows, cursor = DumpService.seek_model(
+                {"name": "s", "size": 2, "after": cursor},
+                order_by=("level", "-created_at"))
+            seen.extend(row.id for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [row.id for row in DumpModel.query().filter(
+            DumpModel.name == "s").order_by(DumpModel.level,
+                                            DumpModel.created_at.desc())])
+
+    def test_fallback(self):
+        # 查的不是单个model时还是原来的逻辑
+        rows = dump_query(DumpModel.query(DumpModel.id, DumpModel.name)
+                          .order_by(DumpModel.id))
+        self.assertEqual(rows, [{"id": 1, "name": "a"},
+                                {"id": 2, "name": None}])
+
+
+class StreamHandler(JSONBaseHandler):
+
+    async def get(self):
+        if self.get_argument("source") == "query":
+            rows = ListModel.query().order_by(ListModel.id)
+        else:
+            rows = ({"id": i} for i in range(int(self.get_argument("n"))))
+        await self.json_stream(rows, chunk_size=3, total=-1)
+
+
+class JSONStreamTestCase(EngineTest, AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Application([("/stream", StreamHandler)])
+
+    def setUp(self):
+        super(JSONStreamTestCase, self).setUp()
+        ListModel.bulk_insert([{"id": i, "name": "n%d" % (i % 2),
+                                "score": i % 3} for i in range(1, 11)])
+
+    def test_stream(self):
+        response = self.fetch("/stream?source=query")
+        body = json.loads(response.body)
+        self.assertEqual(body["code"], 200)
+        self.assertEqual(body["total"], -1)
+        self.assertEqual([row["id"] for row in body["data"]],
+                         list(range(1, 11)))
+        self.assertEqual(body["data"][0], {"id": 1, "name": "n1", "score": 1})
+        # 正好整块和空的
+        for n in (0, 6):
+            response = self.fetch("/stream?source=iter&n=%d" % n)
+            self.assertEqual(json.loads(response.body)["data"],
+                             [{"id": i} for i in range(n)])
+
+
+class LRUCacheTestCase(EngineTest):
+
+    def test_evict(self):
+        lru = LRUCache(2)
+        lru["a"] = 1
+        lru["b"] = 2
+        evicted = []
+        lru.on_evict = evicted.append
+        lru["c"] = 3
+        self.assertNotIn("a", lru)
+        self.assertEqual(list(lru), ["b", "c"])
+        self.assertEqual(evicted, ["a"])
+        self.assertEqual(lru.evictions, 1)
+
+    def test_get_refresh(self):
+        lru = LRUCache(2)
+        lru["a"] = 1
+        lru["b"] = 2
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("x", 0), 0)
+        lru["c"] = 3  # b被挤出
+        self.assertEqual(list(lru), ["a", "c"])
+
+    def test_getitem_refresh(self):
+        lru = LRUCache(2)
+        lru["a"] = 1
+        lru["b"] = 2
+        self.assertEqual(lru["a"], 1)
+        lru["c"] = 3
+        self.assertEqual(list(lru), ["a", "c"])
+        with self.assertRaises(KeyError):
+            lru["b"]
+
+    def test_overwrite_delete(self):
+        lru = LRUCache(2)
+        lru["a"] = 1
+        lru["b"] = 2
+        lru["a"] = 3
+        self.assertEqual(list(lru), ["b", "a"])
+        del lru["b"]
+        lru["c"] = 4
+        lru["d"] = 5
+        self.assertEqual(list(lru), ["c", "d"])
+
+
+    def test_pop(self):
+        lru = LRUCache(3)
+        lru["a"] = 1
+        lru["b"] = 2
+        lru["c"] = 3
+        self.assertEqual(lru.pop("b"), 2)
+        self.assertEqual(lru.pop("b", 0), 0)
+        with self.assertRaises(KeyError):
+            lru.pop("b")
+        self.assertEqual(lru.popitem(), ("c", 3))
+        self.assertEqual(lru.popitem(last=False), ("a", 1))
+        with self.assertRaises(KeyError):
+            lru.popitem()
+        self.assertEqual(lru.setdefault("d", 4), 4)
+        self.assertEqual(lru.setdefault("d", 5), 4)
+        copied = lru.copy()
+        self.assertEqual((list(copied.items()), copied.maxsize),
+                         ([("d", 4)], 3))
+
+
+class SLRUCacheTestCase(EngineTest):
+
+    def test_scan_resistant(self):
+        slru = SLRUCache(4)
+        slru["hot"] = 1
+        self.assertIn("hot", slru._probation)  # 新写的在probation
+        self.assertEqual(slru["hot"], 1)  # 写入之后第一次读就升到protected
+        self.assertIn("hot", slru._protected)
+        for i in range(10):  # 一次遍历挤不掉hot
+            slru["scan%d" % i] = i
+        self.assertIn("hot", slru._protected)
+        self.assertEqual(len(slru), 4)
+        self.assertEqual(slru.evictions, 7)
+
+    def test_weight(self):
+        slru = SLRUCache(10, sizer=lambda key, value: len(value))
+        slru["a"] = "xxxx"
+        slru["b"] = "xxxx"
+        slru["c"] = "xxxx"  # a被挤出
+        self.assertNotIn("a", slru)
+        self.assertEqual(slru.weight, 8)
+        slru["d"] = "x" * 11  # 比capacity还大，不存
+        self.assertNotIn("d", slru)
+        self.assertEqual(slru.pop("b"), "xxxx")
+        self.assertEqual(slru.weight, 4)
+        slru.clear()
+        self.assertEqual((len(slru), slru.weight), (0, 0))
+
+
+class CacheSerializerTestCase(EngineTest):
+
+    def test_pickle(self):
+        serializer = CacheSerializer()
+        data = serializer.dumps({"asd": 123, "zxc": "啊"})
+        self.assertEqual(data[:1], b"P")
+        self.assertDictEqual(serializer.loads(data), {"asd": 123, "zxc": "啊"})
+
+    def test_compress(self):
+        serializer = CacheSerializer(compress="zlib", compress_threshold=10)
+        value = ["asd"] * 100
+        data = serializer.dumps(value)
+        self.assertEqual(data[:1], b"Z")
+        self.assertLess(len(data), len(pickle.dumps(value)))
+        # 换了配置，旧值还能读
+        self.assertEqual(CacheSerializer().loads(data), value)
+
+    def test_legacy(self):
+        serializer = CacheSerializer()
+        self.assertEqual(serializer.loads(pickle.dumps([1, 2])), [1, 2])
+
+
+class ClientPoolTestCase(EngineTest):
+
+    def test_lease(self):
+        from tools_lib.redisclient import ClientPool
+        pool = ClientPool(io_loop=self.io_loop, max_clients=1)
+        first = pool.acquire()
+        self.assertTrue(first.done())
+        second = pool.acquire()
+        self.assertFalse(second.done())
+        self.assertDictEqual(pool.stats(), {"created": 1, "in_use": 1,
+                                            "idle": 0, "waiters": 1,
+                                            "reconnects": 0})
+        pool.release(first.result())
+        # 同一个连接直接交给了排队的
+        self.assertIs(second.result(), first.result())
+        pool.release(second.result())
+        self.assertEqual(pool.stats()["in_use"], 0)
+        self.assertEqual(pool.stats()["idle"], 1)
+
+    @gen_test
+    def test_discard(self):
+        from tools_lib.redisclient import ClientPool
+        from tornadoredis.exceptions import ConnectionError, ResponseError
+        pool = ClientPool(io_loop=self.io_loop, max_clients=1)
+        leased = []
+        waiters = []
+
+        async def use(error):
+            async with pool.lease() as client:
+                leased.append(client)
+                waiters.append(pool.acquire())
+                raise error
+
+        # 出错的client不放回去，排队的拿到新建的
+        with self.assertRaises(ConnectionError):
+            yield use(ConnectionError("closed"))
+        waiter = waiters[0]
+        self.assertIsNot(waiter.result(), leased[0])
+        self.assertEqual(pool.stats()["created"], 1)
+        self.assertEqual(pool.stats()["in_use"], 1)
+        pool.release(waiter.result())
+        # redis返回的错误不影响连接，照样还回去(交给了排队的)
+        with self.assertRaises(ResponseError):
+            yield use(ResponseError("WRONGTYPE"))
+        self.assertIs(leased[1], waiter.result())
+        self.assertIs(waiters[1].result(), leased[1])
+        pool.release(waiters[1].result())
+        self.assertEqual(pool.stats()["idle"], 1)
+        self.assertEqual(pool.stats()["in_use"], 0)
+
+
 class A(object):
     def __init__(self, i):
         self.i = i
@@ -292,6 +1122,51 @@ class RedisCacheTest(BaseTestCase):
         value = yield cache.get("testkey",)
         self.assertEqual(value, None)
 
+    @gen_test
+    def test_negative(self):
+        CacheBase.configure("apps.core.cache.redis.RedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+        yield cache.delete("testnegative")
+        value = yield cache.get("testnegative", MISS)
+        self.assertIs(value, MISS)
+        yield cache.set("testnegative", None)
+        value = yield cache.get("testnegative", MISS)
+        self.assertIsNone(value)
+        values = yield cache.get_many(["testnegative"])
+        self.assertEqual(values, {"testnegative": None})
+        yield cache.delete("testnegative")
+
+    @gen_test
+    def test_invalidate(self):
+        CacheBase.configure("apps.core.cache.redis.RedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+        yield cache.set("testtag:1", 1, tags=["testtag"])
+        yield cache.set_many({"testtag:2": 2, "testtag:3": 3},
+                             tags=["testtag"])
+        keys = yield cache.invalidate_tags("testtag")
+        self.assertEqual(len(keys), 3)
+        value = yield cache.get("testtag:2")
+        self.assertIsNone(value)
+        # 过期了的key在下次写这个tag时从zset里删掉，tag不会一直变大
+        yield cache.set("testtag:4", 4, timeout=1, tags=["testtag"])
+        yield sleep(1.1)
+        yield cache.set("testtag:5", 5, tags=["testtag"])
+        client = yield cache.pool.acquire()
+        size = yield Task(client.zcard, cache._tag_key("testtag"))
+        cache.pool.release(client)
+        self.assertEqual(size, 1)
+        keys = yield cache.invalidate_tags("testtag")
+        self.assertEqual(keys, [cache._make_key("testtag:5")])
+        yield cache.set("testprefix:1", 1)
+        keys = yield cache.invalidate_prefix("testprefix:")
+        self.assertEqual(len(keys), 1)
+        value = yield cache.get("testprefix:1")
+        self.assertIsNone(value)
+
     @gen_test
     def test_set_object(self):
         CacheBase.configure("apps.core.cache.redis.RedisCache",
@@ -344,3 +1219,319 @@ class RedisCacheTest(BaseTestCase):
         value = yield cache.get("testkey2",)
         self.assertTrue(isinstance(value["zxc"], bytes))
         self.assertEqual(value["zxc"], b"\x00\x01\x02")
+
+    @gen_test
+    def test_many(self):
+        CacheBase.configure("apps.core.cache.redis.RedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+
+        yield cache.set_many({"testkey": 1, "testkey2": {"a": 2}})
+        value = yield cache.get_many(["testkey", "testkey2", "testkey3"])
+        self.assertDictEqual(value, {"testkey": 1, "testkey2": {"a": 2}})
+        yield cache.delete_many(["testkey", "testkey2"])
+        value = yield cache.get_many(["testkey", "testkey2"])
+        self.assertDictEqual(value, {})
+
+    @gen_test
+    def test_pipeline(self):
+        CacheBase.configure("apps.core.cache.redis.RedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+
+        pipe = cache.pipeline()
+        pipe.set("testkey", "value")
+        pipe.get("testkey")
+        pipe.delete("testkey")
+        pipe.get("testkey")
+        results = yield pipe.execute()
+        self.assertEqual(results[1], "value")
+        self.assertEqual(results[3], None)
+
+    @gen_test
+    def test_session(self):
+        CacheBase.configure("apps.core.cache.redis.RedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+        handler = FakeCookieHandler()
+        session = RedisSessionStore(handler, engine=cache)
+        yield session.load()
+        session["uid"] = 1
+        yield session.save()
+        session_key = handler.cookies[RedisSessionStore.cookie_name]
+        self.assertEqual(session_key, session.session_key)
+        value = yield cache.get("session:" + session_key)
+        self.assertEqual(value, {"uid": 1})
+
+        session = RedisSessionStore(handler, session_key, engine=cache)
+        with self.assertRaises(RuntimeError):
+            session["uid"]
+        data = yield session.load()
+        self.assertEqual(data, {"uid": 1})
+        yield session.save()  # 没改过，只排队续期
+        self.assertEqual(handler.writes, 1)
+        refresher = ExpiryRefresher.current()
+        yield refresher.flush()
+        self.assertEqual(refresher.flushes, 1)
+
+        yield session.flush()
+        exists = yield session.exists(session_key)
+        self.assertFalse(exists)
+        self.assertNotIn(RedisSessionStore.cookie_name, handler.cookies)
+
+    @gen_test
+    def test_list(self):
+        CacheBase.configure("apps.core.cache.redis.RedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+        yield cache.delete("testlist")
+        items = [str(i) for i in range(25)]
+        length = yield cache.rpush("testlist", items, chunk_size=10)
+        self.assertEqual(length, 25)
+        pages = []
+        iterator = cache.lrange_iter("testlist", chunk_size=10)
+        while True:
+            try:
+                page = yield iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            pages.append(page)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), items)
+        value = yield cache.lpop("testlist")
+        self.assertEqual(value, "0")
+        values = yield cache.rpop("testlist", 3)
+        self.assertEqual(values, ["24", "23", "22"])
+        yield cache.ltrim("testlist", 0, 4)
+        values = yield cache.lpop("testlist", 10)
+        self.assertEqual(values, ["1", "2", "3", "4", "5"])
+        values = yield cache.lpop("testlist", 10)
+        self.assertEqual(values, [])
+
+    @gen_test
+    def test_pool_reuse(self):
+        CacheBase.configure("apps.core.cache.redis.RedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+        for _ in range(5):
+            yield cache.get("key_not_exist")
+        stats = cache.pool_stats()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["in_use"], 0)
+
+
+class TieredCacheTest(BaseTestCase):
+
+    @gen_test
+    def test_get(self):
+        CacheBase.configure("apps.core.cache.tiered.TieredCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield sleep(0.1)
+        yield cache.set("testkey", {"a": 1})
+        value = yield cache.get("testkey")
+        self.assertDictEqual(value, {"a": 1})
+        stats = cache.tier_stats()
+        self.assertEqual(stats["local_hits"], 1)
+        self.assertEqual(stats["remote_hits"], 0)
+
+        cache.local.delete_sync("testkey")
+        value = yield cache.get("testkey")
+        self.assertDictEqual(value, {"a": 1})
+        self.assertEqual(cache.tier_stats()["remote_hits"], 1)
+
+        yield cache.delete("testkey")
+        value = yield cache.get("testkey")
+        self.assertEqual(value, None)
+        self.assertEqual(cache.tier_stats()["remote_misses"], 1)
+        yield cache.close()
+
+    @gen_test
+    def test_proxy(self):
+        # TieredCache里直接建的MemoryCache、RedisCache不能又变成TieredCache
+        with patch.object(options.mockable(), "cache_engine",
+                          "apps.core.cache.tiered.TieredCache"):
+            proxy = CacheProxy()
+            yield proxy.set("testkey", 1)
+            value = yield proxy.get("testkey")
+            self.assertEqual(value, 1)
+            self.assertIsInstance(proxy.engine, TieredCache)
+            self.assertIsInstance(proxy.engine.local, MemoryCache)
+            self.assertIsInstance(proxy.engine.remote, RedisCache)
+            yield proxy.delete("testkey")
+            yield proxy.engine.close()
+
+    @gen_test
+    def test_resubscribe(self):
+        from tornadoredis.client import Message
+        CacheBase.configure("apps.core.cache.tiered.TieredCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop, force_instance=True)
+        yield sleep(0.1)
+        first = cache._subscriber
+        cache.local.set_sync("testkey", 1)
+        # 断开后清空一级cache，退避之后重新订阅
+        cache._on_message(Message(kind="disconnect", channel={cache.channel},
+                                  body=None, pattern=None))
+        self.assertNotIn("testkey", cache.local)
+        self.assertIsNone(cache._subscriber)
+        yield sleep(cache.RESUBSCRIBE_DELAY + 0.2)
+        self.assertIsNot(cache._subscriber, first)
+        self.assertIn(cache.channel, cache._subscriber.subscribed)
+        self.assertEqual(cache._retries, 0)
+        yield cache.close()
+        self.assertIsNone(cache._subscriber)
+
+
+class AsyncRedisCacheTest(BaseTestCase):
+
+    def get_new_ioloop(self):
+        from tornado.platform.asyncio import AsyncIOLoop
+        return AsyncIOLoop()
+
+    @gen_test
+    def test_set(self):
+        CacheBase.configure("apps.core.cache.asyncredis.AsyncRedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        obj = {"asd": 123, "zxc": b"\x00\x01\x02"}
+        yield cache.set("testkey", obj)
+        value = yield cache.get("testkey",)
+        self.assertDictEqual(value, obj)
+        deleted = yield cache.delete("testkey")
+        self.assertEqual(deleted, 1)  # 和RedisCache一样是删掉的个数
+        value = yield cache.get("testkey",)
+        self.assertEqual(value, None)
+
+    @gen_test
+    def test_invalidate(self):
+        CacheBase.configure("apps.core.cache.asyncredis.AsyncRedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield cache.set("testtag:1", 1, timeout=1, tags=["testtag"])
+        yield cache.set_many({"testtag:2": 2, "testtag:3": 3},
+                             tags=["testtag"])
+        yield sleep(1.1)
+        yield cache.set("testtag:4", 4, tags=["testtag"])
+        size = yield cache._execute("ZCARD", cache._tag_key("testtag"))
+        self.assertEqual(size, 3)
+        keys = yield cache.invalidate_tags("testtag")
+        self.assertEqual(keys, [cache._make_key("testtag:%d" % i)
+                                for i in (2, 3, 4)])
+        value = yield cache.get("testtag:2")
+        self.assertIsNone(value)
+
+    @gen_test
+    def test_cancel_discards_connection(self):
+        # 回复还没读完就被取消的连接不能再借给别人
+        import asyncio
+        from tools_lib.asyncredis import ConnectionPool
+
+        async def slow_pong(reader, writer):
+            while await reader.read(1024):
+                await asyncio.sleep(0.2)
+                writer.write(b"+PONG\r\n")
+            writer.close()
+
+        async def ping(pool):
+            async with pool.lease() as connection:
+                return await connection.execute("PING")
+
+        server = yield asyncio.start_server(slow_pong, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        pool = ConnectionPool(max_connections=1, host="127.0.0.1", port=port)
+        with self.assertRaises(asyncio.TimeoutError):
+            yield asyncio.wait_for(ping(pool), 0.05)
+        self.assertEqual(pool.stats()["created"], 0)
+        value = yield ping(pool)
+        self.assertEqual(value, b"PONG")
+        self.assertEqual(pool.stats()["idle"], 1)
+        server.close()
+
+    @gen_test
+    def test_reply_error_keeps_connection(self):
+        from tools_lib.asyncredis import ReplyError
+        CacheBase.configure("apps.core.cache.asyncredis.AsyncRedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield cache.set("testkey", "value")
+        created = cache.pool_stats()["created"]
+        with self.assertRaises(ReplyError):
+            yield cache._execute("INCR", cache._make_key("testkey"))
+        # -ERR回复已经读完了，连接还回去接着用
+        self.assertEqual(cache.pool_stats()["created"], created)
+        self.assertEqual(cache.pool_stats()["in_use"], 0)
+        yield cache.delete("testkey")
+
+    @gen_test
+    def test_cancelled_waiter(self):
+        # 连接交给等着的协程之后它才被取消，连接要还回池子
+        import asyncio
+        from tools_lib.asyncredis import ConnectionPool
+        pool = ConnectionPool(max_connections=1)
+
+        async def cancel_after_handoff():
+            connection = await pool.acquire()
+            waiter = asyncio.ensure_future(pool.acquire())
+            await asyncio.sleep(0)
+            pool.release(connection)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            return connection
+
+        connection = yield asyncio.ensure_future(cancel_after_handoff())
+        self.assertEqual(pool.stats()["in_use"], 0)
+        self.assertEqual(pool.stats()["idle"], 1)
+        again = yield pool.acquire()
+        self.assertIs(again, connection)
+
+    @gen_test
+    def test_pipeline(self):
+        CacheBase.configure("apps.core.cache.asyncredis.AsyncRedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        pipe = cache.pipeline()
+        pipe.set("testkey", "value")
+        pipe.get("testkey")
+        pipe.rpush("testlist", ["a", "b"])
+        pipe.lrange("testlist", 0, -1)
+        pipe.delete("testkey", "testlist")
+        results = yield pipe.execute()
+        self.assertEqual(results[1], "value")
+        self.assertEqual(results[3], ["a", "b"])
+        self.assertEqual(cache.pool_stats()["in_use"], 0)
+
+    @gen_test
+    def test_list(self):
+        CacheBase.configure("apps.core.cache.asyncredis.AsyncRedisCache",
+                            defaults=options.cache_options)
+        cache = CacheBase(self.io_loop)
+        yield cache.delete("testlist")
+        items = [str(i) for i in range(25)]
+        length = yield cache.rpush("testlist", items, chunk_size=10)
+        self.assertEqual(length, 25)
+        pages = []
+        iterator = cache.lrange_iter("testlist", chunk_size=10)
+        while True:
+            try:
+                page = yield iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            pages.append(page)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), items)
+        value = yield cache.lpop("testlist")
+        self.assertEqual(value, "0")
+        values = yield cache.rpop("testlist", 3)
+        self.assertEqual(values, ["24", "23", "22"])
+        yield cache.ltrim("testlist", 0, 4)
+        values = yield cache.lpop("testlist", 10)
+        self.assertEqual(values, ["1", "2", "3", "4", "5"])
+        values = yield cache.lpop("testlist", 10)
+        self.assertEqual(values, [])
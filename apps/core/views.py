@@ -2,7 +2,9 @@
 
 from tornado.web import RequestHandler
 from tornado.options import options
-from apps.core.models.base import clean_db_session
+from tornado.escape import json_encode
+from sqlalchemy.orm import Query
+from apps.core.models.base import clean_db_session, iter_dicts
 from tools_lib.utils.profile import WithProfile
 
 
@@ -34,6 +36,35 @@ class JSONBaseHandler(RequestHandler):
         self.write(data)
         self.finish()
 
+    async def json_stream(self, rows, code=200, show_time=False,
+                          chunk_size=500, **kwargs):
+        """大结果集边查边输出，格式和json_respon一样:{"code": code, "data": [...]}
+        rows是query时按chunk_size用yield_per分批从数据库取，
+        也可以是model、dict、Row的迭代器
+        每chunk_size行write+flush一次，内存占用和结果集大小无关
+        开始输出之后再出错只能断开连接，客户端拿到的JSON不完整
+        """
+        if isinstance(rows, Query):
+            rows = rows.yield_per(chunk_size)
+        head = {"code": code}
+        head.update(kwargs)
+        head.pop("data", None)
+        self.add_header("Content-Type", "application/json")
+        self.write(json_encode(head)[:-1] + ',"data":[')
+        chunk = []
+        sep = ""
+        for row in iter_dicts(rows, show_time):
+            chunk.append(json_encode(row))
+            if len(chunk) >= chunk_size:
+                self.write(sep + ",".join(chunk))
+                sep = ","
+                chunk = []
+                await self.flush()
+        if chunk:
+            self.write(sep + ",".join(chunk))
+        self.write("]}")
+        self.finish()
+
     def json_error_respon(self, json=None, code=400, **kwargs):
         if json is not None:
             result = {"message": json, "code": code}
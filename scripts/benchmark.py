@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""性能基准测试
+使用：
+python scripts/benchmark.py            # 跑全部
+python scripts/benchmark.py lru        # 只跑lru
+"""
+
+import os
+import sys
+import argparse
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """注册一个benchmark,name作为子命令"""
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def timeit(func, number):
+    """返回单次调用的平均耗时(微秒)"""
+    start = default_timer()
+    for _ in range(number):
+        func()
+    return (default_timer() - start) / number * 1e6
+
+
+@benchmark("lru")
+def bench_lru(number=100000):
+    """LRUCache命中和未命中的耗时应该和容量无关"""
+    from apps.core.cache.memory import LRUCache
+    print("%10s %12s %12s" % ("size", "hit(us)", "miss(us)"))
+    for size in (1000, 10000, 100000, 1000000):
+        lru = LRUCache(size)
+        for i in range(size):
+            lru[i] = i
+        keys = iter(range(number * 2))
+
+        def hit():
+            lru.get(next(keys) % size)
+
+        def miss():
+            lru.get(-1)
+        print("%10d %12.3f %12.3f" % (size,
+                                      timeit(hit, number),
+                                      timeit(miss, number)))
+
+
+@benchmark("memory_get")
+def bench_memory_get(number=100000):
+    """MemoryCache.get返回已完成的Future，和get_sync只差一次Future分配"""
+    from tornado.ioloop import IOLoop
+    from apps.core.cache.base import CacheBase
+    io_loop = IOLoop.current()
+    CacheBase.configure("apps.core.cache.memory.MemoryCache",
+                        io_loop=io_loop, defaults={"max_size": 1000})
+    cache = CacheBase(io_loop, force_instance=True)
+    cache.set_sync("somekey", 1)
+
+    async def awaited():
+        start = default_timer()
+        for _ in range(number):
+            await cache.get("somekey")
+        return (default_timer() - start) / number * 1e6
+
+    print("%20s %12s" % ("op", "cost(us)"))
+    print("%20s %12.3f" % ("get_sync",
+                           timeit(lambda: cache.get_sync("somekey"), number)))
+    print("%20s %12.3f" % ("await get", io_loop.run_sync(awaited)))
+
+
+@benchmark("token")
+def bench_token(number=100000):
+    """32位session key每秒能生成多少个"""
+    from tornado.ioloop import IOLoop
+    from apps.core.crypto import (get_random_string, random, ALPHANUMERIC,
+                                  TokenPool)
+    io_loop = IOLoop.current()
+    pool = TokenPool(32, size=number, low_water=number // 4)
+    pool.refill()
+
+    def choice():
+        return ''.join(random.choice(ALPHANUMERIC) for i in range(32))
+
+    async def pooled():
+        start = default_timer()
+        for _ in range(number):
+            pool.get()
+        return (default_timer() - start) / number * 1e6
+
+    print("%20s %12s %14s" % ("generator", "cost(us)", "tokens/s"))
+    for name, cost in (("choice", timeit(choice, number // 10)),
+                       ("urandom", timeit(lambda: get_random_string(32),
+                                          number)),
+                       ("pool", io_loop.run_sync(pooled))):
+        print("%20s %12.3f %14d" % (name, cost, 1e6 / cost))
+
+
+def define_missing(**defaults):
+    """部署的配置里才define的option，单独跑脚本时补上默认值"""
+    from tornado.options import options, define
+    for name, default in defaults.items():
+        if name not in options:
+            define(name, default=default)
+
+
+_bench_model = []
+
+
+def sqlite_model(rows=10000):
+    """绑定sqlite内存库，建一张rows行的表，返回model，只建一次"""
+    if _bench_model:
+        return _bench_model[0]
+    from datetime import datetime
+    from decimal import Decimal
+    import enum
+    from mock import patch
+    from tornado.options import options
+    from sqlalchemy import Column, Integer, String, DateTime, Numeric, Enum
+    import apps.conf  # noqa
+    from apps.core.models import ModelBase
+    define_missing(databases={}, db_kwargs={})
+
+    class Level(enum.Enum):
+        low = 1
+        high = 2
+
+    with patch.object(options.mockable(), "databases",
+                      {"default": "sqlite:///"}):
+        class BenchModel(ModelBase):
+            id = Column(Integer, primary_key=True)
+            name = Column(String(32))
+            score = Column(Integer)
+            price = Column(Numeric(10, 2))
+            level = Column(Enum(Level))
+            created_at = Column(DateTime)
+
+        for engine in ModelBase.get_session().shards.values():
+            ModelBase.metadata.create_all(engine)
+    created_at = datetime(2020, 1, 1)
+    BenchModel.bulk_insert([{"id": i, "name": "n%d" % (i % 10),
+                             "score": i % 7, "price": Decimal("9.99"),
+                             "level": Level.low if i % 2 else Level.high,
+                             "created_at": created_at}
+                            for i in range(1, rows + 1)])
+    _bench_model.append(BenchModel)
+    return BenchModel
+
+
+@benchmark("list_model")
+def bench_list_model(number=2000):
+    """list_model每次请求的CPU耗时，BAKED_QUERIES对比，sqlite内存库"""
+    from apps.core.service import BaseService, COUNT_EXACT, COUNT_HAS_MORE
+
+    class PlainService(BaseService):
+        model_classs = sqlite_model()
+
+    class BakedService(PlainService):
+        BAKED_QUERIES = True
+
+    print("%20s %12s %12s" % ("service", "count(us)", "has_more(us)"))
+    for service in (PlainService, BakedService):
+        def counted():
+            query, total = service.list_model(
+                {"name": "n3", "score": 2, "size": 20, "page": 2},
+                count=COUNT_EXACT)
+            query.all()
+
+        def has_more():
+            service.list_model({"name": "n3", "score": 2, "size": 20,
+                                "page": 2}, count=COUNT_HAS_MORE)
+        counted()  # 预热，baked的第一次要编译
+        has_more()
+        print("%20s %12.3f %12.3f" % (service.__name__,
+                                      timeit(counted, number),
+                                      timeit(has_more, number)))
+
+
+@benchmark("dump_query")
+def bench_dump_query(rows=10000, number=5):
+    """dump 10k行: 逐个to_dict和按列的dump_query对比，sqlite内存库"""
+    from apps.core.models.base import dump_query, dump_json, clean_db_session
+    model = sqlite_model(rows)
+
+    def to_dict():
+        [i.to_dict(show_time=True) for i in model.query().limit(rows)]
+        clean_db_session()  # 不让identity map里的实例帮下一轮省事
+
+    def columnar():
+        dump_query(model.query().limit(rows), show_time=True)
+
+    def json_bytes():
+        dump_json(model.query().limit(rows), show_time=True)
+
+    print("%20s %12s %12s" % ("%d rows" % rows, "cost(ms)", "rows/s"))
+    for func in (to_dict, columnar, json_bytes):
+        cost = timeit(func, number) / 1000
+        print("%20s %12.3f %12d" % (func.__name__, cost, rows / cost * 1000))
+
+
+def redis_cache(io_loop, engine="apps.core.cache.redis.RedisCache"):
+    from apps.core.cache.base import CacheBase
+    CacheBase.configure(engine, io_loop=io_loop)
+    return CacheBase(io_loop, force_instance=True,
+                     defaults={"host": os.environ.get("REDIS_HOST",
+                                                      "localhost"),
+                               "port": int(os.environ.get("REDIS_PORT",
+                                                          6379))})
+
+
+@benchmark("redis_many")
+def bench_redis_many(keys=20, number=200):
+    """20个key逐个GET和一次MGET/pipeline的对比，需要本地redis-server"""
+    from tornado.ioloop import IOLoop
+    io_loop = IOLoop.current()
+    cache = redis_cache(io_loop)
+    names = ["bench:%d" % i for i in range(keys)]
+
+    async def one_by_one():
+        for name in names:
+            await cache.get(name)
+
+    async def many():
+        await cache.get_many(names)
+
+    async def pipelined():
+        pipe = cache.pipeline()
+        for name in names:
+            pipe.get(name)
+        await pipe.execute()
+
+    async def run(func):
+        await cache.set_many({name: name for name in names})
+        start = default_timer()
+        for _ in range(number):
+            await func()
+        return (default_timer() - start) / number * 1e6
+
+    print("%20s %12s" % ("%d keys" % keys, "cost(us)"))
+    for func in (one_by_one, many, pipelined):
+        print("%20s %12.3f" % (func.__name__,
+                               io_loop.run_sync(lambda: run(func))))
+
+
+@benchmark("redis_backends")
+def bench_redis_backends(number=2000):
+    """tornadoredis和asyncio原生客户端的对比，需要本地redis-server"""
+    from tornado.platform.asyncio import AsyncIOMainLoop
+    from tornado.ioloop import IOLoop
+    AsyncIOMainLoop().install()
+    io_loop = IOLoop.current()
+    value = {"data": list(range(100))}
+
+    async def run(cache):
+        await cache.set("bench:backend", value)
+        start = default_timer()
+        for _ in range(number):
+            await cache.get("bench:backend")
+        get_cost = (default_timer() - start) / number * 1e6
+        start = default_timer()
+        for _ in range(number):
+            await cache.set("bench:backend", value)
+        set_cost = (default_timer() - start) / number * 1e6
+        return get_cost, set_cost
+
+    print("%20s %12s %12s" % ("backend", "get(us)", "set(us)"))
+    for engine in ("apps.core.cache.redis.RedisCache",
+                   "apps.core.cache.asyncredis.AsyncRedisCache"):
+        cache = redis_cache(io_loop, engine)
+        get_cost, set_cost = io_loop.run_sync(lambda: run(cache))
+        print("%20s %12.3f %12.3f" % (engine.rsplit(".", 1)[-1],
+                                      get_cost, set_cost))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", nargs="*",
+                        help="benchmark名字，不写则全部运行:%s" %
+                        ",".join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark:%s" % name)
+        print("== %s ==" % name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# coding=utf-8
+"""基于asyncio的redis客户端(RESP2)
+只做了cache需要的部分：单条命令、pipeline、连接池
+收发都是bytes，不经过str
+"""
+
+import asyncio
+from collections import deque
+import logging
+logger = logging.getLogger("tornado.application")
+
+
+class RedisError(Exception):
+    pass
+
+
+class ReplyError(RedisError):
+    """redis返回的-ERR"""
+    pass
+
+
+class ConnectionError(RedisError):
+    pass
+
+
+class ProtocolError(RedisError):
+    """回复解析不了"""
+    pass
+
+
+# 出了这些异常的连接不能再借出去
+_DISCARD_ERRORS = (ConnectionError, ProtocolError, asyncio.CancelledError)
+
+
+def _encode(arg):
+    if isinstance(arg, bytes):
+        return arg
+    if isinstance(arg, str):
+        return arg.encode("utf-8")
+    if isinstance(arg, (int, float)):
+        return repr(arg).encode("ascii")
+    raise TypeError("redis argument must be bytes, str, int or float: %r"
+                    % type(arg))
+
+
+def pack_command(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        arg = _encode(arg)
+        parts.append(b"$%d\r\n" % len(arg))
+        parts.append(arg)
+        parts.append(b"\r\n")
+    return b"".join(parts)
+
+
+class Connection(object):
+    """一个连接同时只能被一个协程使用，由ConnectionPool借出"""
+
+    def __init__(self, host="localhost", port=6379, password=None, db=0,
+                 connect_timeout=10):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.connect_timeout = connect_timeout
+        self._reader = None
+        self._writer = None
+        self.connect_count = 0
+
+    def connected(self):
+        return self._writer is not None
+
+    async def connect(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectionError(str(e))
+        self.connect_count += 1
+        # AUTH和SELECT只在连接上之后发一次
+        if self.password:
+            await self.execute("AUTH", self.password)
+        if self.db:
+            await self.execute("SELECT", self.db)
+
+    def disconnect(self):
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by redis")
+        head, body = line[:1], line[1:-2]
+        if head == b"$":
+            length = int(body)
+            if length == -1:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if head == b"+":
+            return body
+        if head == b":":
+            return int(body)
+        if head == b"*":
+            length = int(body)
+            if length == -1:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        if head == b"-":
+            return ReplyError(body.decode("utf-8", "replace"))
+        raise ProtocolError("unknown reply type:%r" % line)
+
+    async def _roundtrip(self, data, count):
+        if not self.connected():
+            await self.connect()
+        try:
+            self._writer.write(data)
+            await self._writer.drain()
+            return [await self._read_reply() for _ in range(count)]
+        except (OSError, asyncio.IncompleteReadError, ConnectionError) as e:
+            # 断开的连接下次借出去的时候重连
+            logger.warning("redis disconnect:%s", e)
+            self.disconnect()
+            raise ConnectionError(str(e))
+        except (ValueError, ProtocolError) as e:
+            # 回复解析不了，后面的数据对不上了
+            self.disconnect()
+            raise ProtocolError(str(e))
+        except BaseException:
+            # 被取消(超时、客户端断开)的时候回复可能没读完，
+            # 留着的话下一个借到的人会读到这次的回复
+            self.disconnect()
+            raise
+
+    async def execute(self, *args):
+        reply, = await self._roundtrip(pack_command(*args), 1)
+        if isinstance(reply, ReplyError):
+            raise reply
+        return reply
+
+    async def execute_many(self, commands):
+        """RESP pipelining：所有命令一次写出，再按顺序读回
+        出错的命令对应位置是ReplyError实例，不抛出
+        """
+        if not commands:
+            return []
+        data = b"".join(pack_command(*args) for args in commands)
+        return await self._roundtrip(data, len(commands))
+
+
+class _Lease(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+
+    async def __aenter__(self):
+        self.connection = await self.pool.acquire()
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and issubclass(exc_type, _DISCARD_ERRORS):
+            # 不知道连接上还有没有没读的回复，关掉不放回去
+            self.pool.discard(self.connection)
+        else:
+            # ReplyError和调用方自己的异常不影响连接，接着用
+            self.pool.release(self.connection)
+        self.connection = None
+
+
+class ConnectionPool(object):
+    """和tools_lib.redisclient.ClientPool一样的借还方式
+    >>> async with pool.lease() as conn:
+    ...     value = await conn.execute("GET", key)
+    """
+
+    def __init__(self, max_connections=200, **connect_kwargs):
+        self.max_connections = max_connections
+        self.connect_kwargs = connect_kwargs
+        self._idle = deque()
+        self._waiters = deque()
+        self._connections = []
+        self.in_use = 0
+
+    async def acquire(self):
+        if self._idle:
+            connection = self._idle.pop()
+        elif len(self._connections) < self.max_connections:
+            connection = Connection(**self.connect_kwargs)
+            self._connections.append(connection)
+        else:
+            waiter = asyncio.Future()
+            self._waiters.append(waiter)
+            try:
+                return await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 连接已经交过来了，协程才被取消，还回去给下一个
+                    self.release(waiter.result())
+                raise
+        self.in_use += 1
+        return connection
+
+    def release(self, connection):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():  # 取消了的跳过
+                waiter.set_result(connection)
+                return
+        self.in_use -= 1
+        self._idle.append(connection)
+
+    def discard(self, connection):
+        """关掉借出去的连接，不放回空闲队列，空出的名额给等着的人建新连接"""
+        connection.disconnect()
+        self._connections.remove(connection)
+        self.in_use -= 1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():  # 取消了的跳过
+                connection = Connection(**self.connect_kwargs)
+                self._connections.append(connection)
+                self.in_use += 1
+                waiter.set_result(connection)
+                return
+
+    def lease(self):
+        return _Lease(self)
+
+    def stats(self):
+        return {
+            "created": len(self._connections),
+            "in_use": self.in_use,
+            "idle": len(self._idle),
+            "waiters": len(self._waiters),
+            "reconnects": sum(max(c.connect_count - 1, 0)
+                              for c in self._connections),
+        }
@@ -1,27 +1,132 @@
 # coding=utf-8
 
 from tornadoredis import Client
+from tornadoredis.exceptions import ResponseError
+from tornado.concurrent import Future
+from collections import deque
 import logging
 logger = logging.getLogger("tornado.application")
 
 
 class ReconnectClient(Client):
     """重连
+    断开之后，下一条命令执行时Client.execute_command会自己connect，
+    重新connect后AUTH和SELECT也会按connection.info重新发
     """
-    pass
-    # connect_kwargs = {}
-
-    # def on_disconnect(self):
-    #     """
-    #     close时所有已存在的回调函数都会以None被调用：cb(None)
-    #     并且置为空
-    #     然后才调用该方法
-    #     """
-    #     # connect_kwargs如果有callback参数会和self.connect的callback冲突
-    #     #
-    #     logger.warning("redis disconnect,try to connect")
-    #     self._io_loop.call_later(1, self.connect,
-    #                              )
-
-
-# class
+    lease_pool = None  # 由ClientPool创建时指向它，用于统计重连次数
+    connect_count = 0
+
+    def on_connect(self):
+        self.connect_count += 1
+        if self.connect_count > 1:
+            logger.warning("redis reconnected:%r", self)
+            if self.lease_pool is not None:
+                self.lease_pool.reconnects += 1
+
+    def on_disconnect(self):
+        """
+        close时所有已存在的回调函数都会以None被调用：cb(None)
+        并且置为空
+        然后才调用该方法
+        """
+        logger.warning("redis disconnect,reconnect on next command")
+        self.connection.disconnect()
+        # 父类会抛ConnectionError，让正在执行的命令失败而不是一直挂着
+        super(ReconnectClient, self).on_disconnect()
+
+
+class _Lease(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = await self.pool.acquire()
+        return self.client
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None or issubclass(exc_type, ResponseError):
+            self.pool.release(self.client)
+        else:
+            # 断开、超时的时候命令可能还在路上，回复会被下一个借到的人读到，
+            # 和asyncredis的连接池一样关掉不放回去
+            self.pool.discard(self.client)
+        self.client = None
+
+
+class ClientPool(object):
+    """长连接的client池
+    每个client独占一个一直不关的connection，第一次用的时候AUTH和SELECT，
+    之后借出去的时候不用再发。
+    client不够用时，超过max_clients的请求排队等别人还回来
+    >>> async with pool.lease() as client:
+    ...     value = await Task(client.get, key)
+    """
+
+    def __init__(self, io_loop=None, max_clients=200, stop_after=None,
+                 password=None, selected_db=None, **connect_kwargs):
+        self.io_loop = io_loop
+        self.max_clients = max_clients
+        self.stop_after = stop_after
+        self.password = password
+        self.selected_db = selected_db
+        self.connect_kwargs = connect_kwargs
+        self._idle = deque()
+        self._waiters = deque()
+        self.created = 0
+        self.in_use = 0
+        self.reconnects = 0
+
+    def _make_client(self):
+        client = ReconnectClient(io_loop=self.io_loop,
+                                 password=self.password,
+                                 selected_db=self.selected_db,
+                                 **self.connect_kwargs)
+        client.connection.timeout = self.stop_after
+        client.lease_pool = self
+        self.created += 1
+        return client
+
+    def acquire(self):
+        future = Future()
+        if self._idle:
+            client = self._idle.pop()  # 后进先出，常用的连接保持热的
+        elif self.created < self.max_clients:
+            client = self._make_client()
+        else:
+            self._waiters.append(future)
+            return future
+        self.in_use += 1
+        future.set_result(client)
+        return future
+
+    def release(self, client):
+        if self._waiters:
+            # 直接交给排队的，in_use不变
+            self._waiters.popleft().set_result(client)
+        else:
+            self.in_use -= 1
+            self._idle.append(client)
+
+    def discard(self, client):
+        """断开借出去的client，不放回去，空出的名额给等着的人建新的"""
+        client.connection.disconnect()
+        self.created -= 1
+        if self._waiters:
+            # 直接交给排队的，in_use不变
+            self._waiters.popleft().set_result(self._make_client())
+        else:
+            self.in_use -= 1
+
+    def lease(self):
+        return _Lease(self)
+
+    def stats(self):
+        return {
+            "created": self.created,
+            "in_use": self.in_use,
+            "idle": len(self._idle),
+            "waiters": len(self._waiters),
+            "reconnects": self.reconnects,
+        }
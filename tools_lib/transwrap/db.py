@@ -66,6 +66,19 @@ class VerticalShardedQuery(Query):
             # were done, this is where it would happen
             return iter_for_shard(shard_id)
 
+    def execute_rows(self):
+        """和迭代query一样选shard、autoflush，但不经过ORM的loading，
+        直接返回ResultProxy，按下标取值，只查列的时候用
+        """
+        if self._autoflush and not self._populate_existing:
+            self.session._autoflush()
+        shard_id = self._shard_id
+        if shard_id is None:
+            shard_id = self.query_chooser(self)
+        return self._connection_from_session(
+            mapper=self._mapper_zero(),
+            shard_id=shard_id).execute(self.statement)
+
     def get(self, ident, **kwargs):
         if self._shard_id is not None:
             return super(VerticalShardedQuery, self).get(ident)